@@ -0,0 +1,224 @@
+# =========================
+#  Module: Batch question answering
+# =========================
+"""
+Answer many questions at once, e.g. to generate FAQ or run a regression
+suite, for throughput rather than latency of every question:
+
+1. all questions are embedded in one batch,
+2. searched in one FAISS search, or concurrently in IDOL,
+3. answered by `BATCH_LLM_WORKERS` concurrent generations for ollama, or
+   `LLM_WORKERS` for models in this process, ordered so that prompts in a
+   row share their beginning when there is one worker.
+
+    python batch.py questions.txt
+    python batch.py questions.jsonl --output answers.jsonl
+
+Questions are lines of text, or JSON lines with "query" or "question",
+other fields are copied to the answer.
+"""
+import argparse
+import hashlib
+import json
+import threading
+import timeit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List
+import box
+import yaml
+from dotenv import find_dotenv, load_dotenv
+from src.embeddings import embed_queries
+from src.llm import pool_size
+from src.query_cache import CachedRetrievalQA
+from src.utils import setup_dbqa
+
+# Load environment variables from .env file
+load_dotenv(find_dotenv())
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+
+def read_questions(path: str) -> List[Dict[str, Any]]:
+    questions = []
+    with open(path, 'r', encoding='utf8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith('.jsonl'):
+                item = json.loads(line)
+                item['query'] = item.pop('query', None) or item.pop('question')
+            else:
+                item = {'query': line}
+            questions.append(item)
+    return questions
+
+
+def llm_workers() -> int:
+    """ concurrent generations, models in this process generate `LLM_WORKERS` at a time
+    """
+    return max(1, cfg.BATCH_LLM_WORKERS) if cfg.MODEL_TYPE == 'ollama' and not cfg.SEARCH_ONLY else pool_size()
+
+
+def schedule(items: List[Dict[str, Any]], workers: int) -> List[Dict[str, Any]]:
+    """
+    Order of generations: with one worker, prompts with the same chunks
+    follow each other so the LLM reuses their evaluated beginning; with
+    more, longest prompts go first so no worker is left with one at the end.
+    """
+    if workers == 1:
+        key = lambda item: [hashlib.sha1(doc.page_content.encode('utf-8')).digest()
+                            for doc in item['docs']]
+        return sorted(items, key=key)
+    return sorted(items, key=lambda item: -sum(len(doc.page_content) for doc in item['docs']))
+
+
+class BatchQA:
+    """ stages of RetrievalQA run for all questions at once
+    """
+
+    def __init__(self, dbqa: Any):
+        self.cache = None
+        if isinstance(dbqa, CachedRetrievalQA):
+            self.cache = dbqa
+            dbqa = dbqa.chain
+        self.dbqa = dbqa
+        self.vectorstore = dbqa.retriever.vectorstore
+        self.embeddings = self.cache.embeddings if self.cache else self.vectorstore.embeddings
+
+
+    def embed(self, items: List[Dict[str, Any]]) -> float:
+        start = timeit.default_timer()
+        vectors = embed_queries(self.embeddings, [item['query'] for item in items])
+        seconds = timeit.default_timer() - start
+        for item, vector in zip(items, vectors):
+            item['vector'] = vector
+            # share of batch
+            item['timings'] = {'embed': seconds / len(items)}
+        return seconds
+
+
+    def lookup(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """ answer questions from cache, returns the others
+        """
+        if self.cache is None:
+            return items
+        self.cache._check_version()
+        rest = []
+        for item in items:
+            response = self.cache.cache.lookup(item['query'], item['vector'])
+            if response is None:
+                rest.append(item)
+            else:
+                item.update(response, cached=True)
+        return rest
+
+
+    def retrieve(self, items: List[Dict[str, Any]]) -> float:
+        start = timeit.default_timer()
+        retriever = self.dbqa.retriever
+        k = retriever.search_kwargs.get('k', cfg.VECTOR_COUNT)
+        if hasattr(self.vectorstore, 'batch_search') and retriever.search_type == 'similarity':
+            # one search of FAISS index for all questions
+            results = self.vectorstore.batch_search([item['query'] for item in items],
+                                                    [item['vector'] for item in items], k)
+            seconds = timeit.default_timer() - start
+            for item, docs in zip(items, results):
+                item['docs'] = docs
+                item['timings']['retrieve'] = seconds / len(items)
+            return seconds
+
+        # concurrent queries of IDOL, or searches FAISS can't batch
+        def search(item):
+            begin = timeit.default_timer()
+            if retriever.search_type == 'similarity' and hasattr(self.vectorstore, '_query'):
+                # IDOL, with embedding of batch
+                docs = [doc for doc, _, _ in self.vectorstore._query(item['query'], k, item['vector'])]
+            else:
+                docs = retriever.get_relevant_documents(item['query'])
+            item['docs'] = docs
+            item['timings']['retrieve'] = timeit.default_timer() - begin
+
+        with ThreadPoolExecutor(cfg.BATCH_RETRIEVAL_THREADS) as pool:
+            for future in as_completed([pool.submit(search, item) for item in items]):
+                future.result()
+        return timeit.default_timer() - start
+
+
+    def generate(self, items: List[Dict[str, Any]], write: Any) -> float:
+        start = timeit.default_timer()
+        chain = self.dbqa.combine_documents_chain
+        workers = llm_workers()
+
+        def answer(item):
+            begin = timeit.default_timer()
+            item['timings']['queue'] = begin - start
+            item['result'] = chain.run(input_documents=item['docs'], question=item['query'])
+            item['timings']['llm'] = timeit.default_timer() - begin
+            if self.cache is not None:
+                response = {'query': item['query'], 'result': item['result']}
+                if self.dbqa.return_source_documents:
+                    response['source_documents'] = item['docs']
+                self.cache.cache.store(item['query'], response, item['vector'])
+            return item
+
+        print(f'INFO: generating {len(items)} answers with {workers} workers')
+        with ThreadPoolExecutor(workers) as pool:
+            futures = [pool.submit(answer, item) for item in schedule(items, workers)]
+            for future in as_completed(futures):
+                write(future.result())
+        return timeit.default_timer() - start
+
+
+def to_json(item: Dict[str, Any]) -> str:
+    item = dict(item)
+    item.pop('vector', None)
+    docs = item.pop('docs', None) or item.pop('source_documents', None) or []
+    if cfg.RETURN_SOURCE_DOCUMENTS:
+        item['source_documents'] = [{'page_content': doc.page_content, 'metadata': doc.metadata}
+                                    for doc in docs]
+    return json.dumps(item, ensure_ascii=False)
+
+
+def run_batch(path: str, output: str) -> None:
+    items = read_questions(path)
+    if not items:
+        print(f'INFO: no questions in {path}')
+        return
+    batch = BatchQA(setup_dbqa())
+
+    out = open(output, 'w', encoding='utf8')
+    lock = threading.Lock()
+    start = timeit.default_timer()
+
+    def write(item):
+        item['timings']['total'] = timeit.default_timer() - start
+        with lock:
+            out.write(to_json(item) + '\n')
+            out.flush()
+
+    stages = {'embed': batch.embed(items)}
+    rest = batch.lookup(items)
+    for item in items:
+        if item.get('cached'):
+            write(item)
+    if rest:
+        stages['retrieve'] = batch.retrieve(rest)
+        stages['generate'] = batch.generate(rest, write)
+    seconds = timeit.default_timer() - start
+    out.close()
+
+    print(f'INFO: {len(items)} questions, {len(items) - len(rest)} from cache, '
+          f'{seconds:.2f}s, {len(items) / seconds:.2f} questions/s')
+    print('INFO: ' + ', '.join(f'{stage} {elapsed:.2f}s' for stage, elapsed in stages.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('questions', help='text file with a question per line, or JSON lines')
+    parser.add_argument('--output', default='answers.jsonl', help='JSON lines of answers')
+    args = parser.parse_args()
+
+    run_batch(args.questions, args.output)
@@ -0,0 +1,95 @@
+# =========================
+#  Module: ChatGLM load mode benchmark
+# =========================
+"""
+Load the chatglm model of MODEL_BIN_PATH in every load mode, each in its
+own process so peak memory is its own, answer synthetic prompts and print
+load time, peak RSS, time to first token and tokens per second of every
+mode, to choose CHATGLM_LOAD_MODE and how many instances fit on a host.
+
+    python -m bench.chatglm_modes
+    python -m bench.chatglm_modes --modes fp32 bf16 int8 --prompts 4 --threads 8
+"""
+import argparse
+import json
+import subprocess
+import sys
+import timeit
+from typing import Any, Dict, List, Optional
+import box
+import yaml
+from bench.llm_pool import prompts
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+MODES = ['fp32', 'bf16', 'int8', 'native']
+
+
+def measure(mode: str, count: int, max_tokens: int, threads: int, low_cpu_mem_usage: bool) -> Dict[str, Any]:
+    """ load and generate in this process, with mode
+    """
+    from src.chatglm import ChatGLM, peak_rss_mb
+
+    llm = ChatGLM(model=cfg.MODEL_BIN_PATH,
+                  config={'max_length': max_tokens, 'temperature': cfg.TEMPERATURE},
+                  threads=threads, load_mode=mode, low_cpu_mem_usage=low_cpu_mem_usage)
+    first_tokens, tokens, decode = [], 0, 0.0
+    for prompt in prompts(count, 3):
+        start = timeit.default_timer()
+        first, text = None, []
+        for chunk in llm._stream(prompt):
+            if first is None:
+                first = timeit.default_timer()
+            text.append(chunk.text)
+        end = timeit.default_timer()
+        if first is not None:
+            first_tokens.append(first - start)
+            # tokens after the first one, generated in decode time
+            tokens += max(0, len(llm.chatglm_tokenizer.encode(''.join(text), add_special_tokens=False)) - 1)
+            decode += end - first
+    return {'mode': mode,
+            'load_seconds': llm.load['seconds'],
+            'peak_rss_mb': peak_rss_mb(),
+            'first_token_seconds': sum(first_tokens) / len(first_tokens) if first_tokens else None,
+            'tokens_per_second': tokens / decode if decode else None}
+
+
+def number(value: Optional[float], digits: int = 1) -> str:
+    return '-' if value is None else f'{value:.{digits}f}'
+
+
+def run(modes: List[str], count: int, max_tokens: int, threads: int, low_cpu_mem_usage: bool) -> None:
+    print(f'{cfg.MODEL_BIN_PATH}, {count} prompts')
+    print(f'{"mode":>7} {"load s":>7} {"peak MB":>8} {"first s":>7} {"tokens/s":>8}')
+    for mode in modes:
+        command = [sys.executable, '-m', 'bench.chatglm_modes', '--child', mode,
+                   '--prompts', str(count), '--max-tokens', str(max_tokens), '--threads', str(threads)]
+        if low_cpu_mem_usage:
+            command.append('--low-cpu-mem-usage')
+        child = subprocess.run(command, capture_output=True, text=True)
+        lines = child.stdout.strip().splitlines()
+        if child.returncode or not lines:
+            print(f'ERROR: mode {mode} failed: {child.stderr.strip().splitlines()[-1:]}')
+            continue
+        r = json.loads(lines[-1])
+        print(f'{mode:>7} {number(r["load_seconds"]):>7} {number(r["peak_rss_mb"], 0):>8} '
+              f'{number(r["first_token_seconds"], 2):>7} {number(r["tokens_per_second"]):>8}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES[:3])
+    parser.add_argument('--prompts', type=int, default=4)
+    parser.add_argument('--max-tokens', type=int, default=2048, help='max_length of generations, prompt included')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 for the default')
+    parser.add_argument('--low-cpu-mem-usage', action='store_true', help='needs accelerate')
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = measure(args.child, args.prompts, args.max_tokens, args.threads, args.low_cpu_mem_usage)
+        print(json.dumps(result))
+    else:
+        run(args.modes, args.prompts, args.max_tokens, args.threads, args.low_cpu_mem_usage)
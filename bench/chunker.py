@@ -0,0 +1,94 @@
+# =========================
+#  Module: Text splitter benchmark
+# =========================
+"""
+Split a corpus with langchain's CharacterTextSplitter and with
+RegexTextSplitter, check that both give the same chunks and compare their
+time.
+
+    python -m bench.chunker
+    python -m bench.chunker --data data/ --chunk-size 500 1000 --chunk-overlap 0 50
+"""
+import argparse
+import os
+import timeit
+from typing import Any, List
+import box
+import yaml
+from langchain.docstore.document import Document
+from langchain.text_splitter import CharacterTextSplitter
+from bench.idol_index import synthetic_corpus
+from src.chunker import RegexTextSplitter
+from src.pipeline import LOADERS, load_source
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+
+def load_corpus(data: str, docs: int) -> List[Any]:
+    """ pages of documents in data, or synthetic paragraphs with separators
+    """
+    if data:
+        return [page for name in sorted(os.listdir(data))
+                if os.path.splitext(name)[1].lower() in LOADERS
+                for page in load_source(os.path.join(data, name))]
+    texts, metadatas = synthetic_corpus(docs)
+    # pages of 10 paragraphs, sentences of 12 words
+    pages = []
+    for i in range(0, len(texts), 10):
+        paragraphs = ['. '.join(' '.join(words[j:j + 12]) for j in range(0, len(words), 12)) + '.'
+                      for words in (text.split() for text in texts[i:i + 10])]
+        pages.append(Document(page_content='\n\n'.join(paragraphs),
+                              metadata=dict(metadatas[i], page=i // 10)))
+    return pages
+
+
+def timed(splitter: Any, pages: List[Any], repeat: int) -> Any:
+    best, chunks = None, None
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        chunks = splitter.split_documents(pages)
+        seconds = timeit.default_timer() - start
+        best = seconds if best is None else min(best, seconds)
+    return chunks, best
+
+
+def offsets_valid(splitter: RegexTextSplitter, pages: List[Any]) -> bool:
+    """ start_index of every chunk points at it in its page
+    """
+    return all(page.page_content.startswith(chunk.page_content, chunk.metadata['start_index'])
+               for page in pages for chunk in splitter.split_documents([page]))
+
+
+def run(data: str, docs: int, separator: str, sizes: List[int], overlaps: List[int], repeat: int) -> None:
+    pages = load_corpus(data, docs)
+    characters = sum(len(page.page_content) for page in pages)
+    print(f'{len(pages)} pages, {characters / 1024 / 1024:.1f} MB of text, separator {separator!r}')
+    print(f'{"size":>6} {"overlap":>7} {"chunks":>7} {"langchain s":>11} {"offsets s":>9} {"speedup":>7}  same')
+    for size in sizes:
+        for overlap in overlaps:
+            if overlap > size:
+                continue
+            expected, before = timed(CharacterTextSplitter(separator=separator, is_separator_regex=True,
+                                                           keep_separator=True, chunk_size=size,
+                                                           chunk_overlap=overlap), pages, repeat)
+            splitter = RegexTextSplitter(separator=separator, chunk_size=size, chunk_overlap=overlap)
+            chunks, after = timed(splitter, pages, repeat)
+            same = [c.page_content for c in chunks] == [c.page_content for c in expected] \
+                and offsets_valid(splitter, pages)
+            print(f'{size:>6} {overlap:>7} {len(chunks):>7} {before:>11.3f} {after:>9.3f} '
+                  f'{before / after:>7.1f}  {same}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', help='folder of documents, synthetic pages by default')
+    parser.add_argument('--docs', type=int, default=20000, help='paragraphs of synthetic corpus')
+    parser.add_argument('--separator', default=cfg.REG_SEPARATORS or '\n\n', help='regex, REG_SEPARATORS by default')
+    parser.add_argument('--chunk-size', type=int, nargs='+', default=[cfg.CHUNK_SIZE])
+    parser.add_argument('--chunk-overlap', type=int, nargs='+', default=[cfg.CHUNK_OVERLAP])
+    parser.add_argument('--repeat', type=int, default=3, help='best of repeated runs')
+    args = parser.parse_args()
+
+    run(args.data, args.docs, args.separator, args.chunk_size, args.chunk_overlap, args.repeat)
@@ -0,0 +1,97 @@
+# =========================
+#  Module: Embedding engine benchmark
+# =========================
+"""
+Embed chunks of a corpus with the torch model of EMBEDDINGS_MODEL and with
+its ONNX export, with and without int8 weights. Prints texts per second of
+every engine, cosine similarity of their vectors with torch ones, and how
+many of the 10 nearest chunks of a chunk they keep. Exits with an error if
+any vector is less similar than EMBEDDINGS_MIN_COSINE.
+
+    python -m bench.embeddings
+    python -m bench.embeddings --data data/ --batch-size 16 32 64 --threads 4
+"""
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+from typing import List
+import box
+import numpy as np
+import yaml
+from langchain.embeddings import HuggingFaceEmbeddings
+from bench.idol_index import synthetic_corpus
+from db_build import build_text_splitter
+from src.onnx_embeddings import OnnxEmbeddings, cosine, export_onnx
+from src.pipeline import LOADERS, load_source
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+
+def load_texts(data: str, docs: int) -> List[str]:
+    """ chunks of documents in data as db_build.py splits them, or synthetic texts
+    """
+    if not data:
+        return synthetic_corpus(docs)[0]
+    pages = [page for name in sorted(os.listdir(data))
+             if os.path.splitext(name)[1].lower() in LOADERS
+             for page in load_source(os.path.join(data, name))]
+    return [chunk.page_content for chunk in build_text_splitter().split_documents(pages)][:docs]
+
+
+def neighbors(vectors: np.ndarray, k: int = 10, queries: int = 200) -> np.ndarray:
+    """ k nearest chunks of the first chunks, by cosine
+    """
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    similarity = vectors[:queries] @ vectors.T
+    return np.argsort(-similarity, axis=1)[:, 1:k + 1]
+
+
+def run(data: str, docs: int, batch_sizes: List[int], threads: int, folder: str) -> bool:
+    texts = load_texts(data, docs)
+    print(f'{len(texts)} texts, model {cfg.EMBEDDINGS_MODEL}')
+    # int8 model is kept whatever its similarity, to measure it
+    export_onnx(cfg.EMBEDDINGS_MODEL, folder, quantize=True, min_cosine=0)
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+
+    print(f'{"engine":>10} {"batch":>5} {"texts/s":>8} {"min cos":>8} {"mean cos":>8} {"top-10":>6}')
+    reference, expected, ok = None, None, True
+    for batch_size in batch_sizes:
+        engines = [('torch', HuggingFaceEmbeddings(model_name=cfg.EMBEDDINGS_MODEL,
+                                                   model_kwargs={'device': 'cpu'},
+                                                   encode_kwargs={'batch_size': batch_size})),
+                   ('onnx', OnnxEmbeddings(folder, quantized=False, batch_size=batch_size, threads=threads)),
+                   ('onnx-int8', OnnxEmbeddings(folder, quantized=True, batch_size=batch_size, threads=threads))]
+        for name, embeddings in engines:
+            start = timeit.default_timer()
+            vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+            seconds = timeit.default_timer() - start
+            if reference is None:
+                reference, expected = vectors, neighbors(vectors)
+            similarity = cosine(reference, vectors)
+            found = neighbors(vectors)
+            kept = np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(expected, found)])
+            ok = ok and similarity.min() >= cfg.EMBEDDINGS_MIN_COSINE
+            print(f'{name:>10} {batch_size:>5} {len(texts) / seconds:>8.1f} {similarity.min():>8.4f} '
+                  f'{similarity.mean():>8.4f} {kept:>6.1%}')
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', help='folder of documents, synthetic texts by default')
+    parser.add_argument('--docs', type=int, default=2000, help='max number of texts')
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[cfg.EMBEDDINGS_BATCH_SIZE])
+    parser.add_argument('--threads', type=int, default=cfg.EMBEDDINGS_THREADS, help='0 for all cores')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        ok = run(args.data, args.docs, args.batch_size, args.threads, folder)
+    if not ok:
+        print(f'ERROR: vectors less than {cfg.EMBEDDINGS_MIN_COSINE} cosine similar to torch ones')
+        sys.exit(1)
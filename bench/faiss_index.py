@@ -0,0 +1,111 @@
+# =========================
+#  Module: FAISS index benchmark
+# =========================
+"""
+Build FAISS index types on synthetic clustered vectors and compare their
+recall@k against exact Flat search, search latency and size, to choose
+FAISS_INDEX_TYPE and its parameters for a corpus size.
+
+    python -m bench.faiss_index --vectors 200000 --dim 384
+    python -m bench.faiss_index --vectors 1000000 --nlist 4096 --nprobe 8 32
+"""
+import argparse
+import os
+import tempfile
+import timeit
+from typing import List, Tuple
+import faiss
+import numpy as np
+from src.faiss_store import factory_string, min_train_size, tune_index
+
+
+def clustered_vectors(count: int, dim: int, clusters: int = 256, seed: int = 0) -> np.ndarray:
+    """ vectors around random centers, closer to real embeddings than uniform noise
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim), dtype=np.float32)
+    labels = rng.integers(0, clusters, count)
+    vectors = centers[labels] + 0.3 * rng.standard_normal((count, dim), dtype=np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def index_size(index: faiss.Index) -> int:
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'index.faiss')
+        faiss.write_index(index, path)
+        return os.path.getsize(path)
+
+
+def search(index: faiss.Index, queries: np.ndarray, k: int) -> Tuple[np.ndarray, List[float]]:
+    """ one query at a time, as the application does
+    """
+    labels = np.empty((len(queries), k), dtype=np.int64)
+    seconds = []
+    for i, query in enumerate(queries):
+        start = timeit.default_timer()
+        _, labels[i] = index.search(query[None, :], k)
+        seconds.append(timeit.default_timer() - start)
+    return labels, seconds
+
+
+def recall(labels: np.ndarray, truth: np.ndarray) -> float:
+    k = truth.shape[1]
+    return np.mean([len(set(row) & set(exact)) / k for row, exact in zip(labels, truth)])
+
+
+def run(count: int, dim: int, queries: int, k: int, nlist: int, pq_m: int,
+        hnsw_m: int, nprobe: List[int], ef_search: List[int], train: int) -> None:
+    vectors = clustered_vectors(count + queries, dim)
+    vectors, queries = vectors[:count], vectors[count:]
+
+    configs = [('Flat', None, {}),
+               ('Flat', 'SQ8', {})]
+    configs += [('IVFFlat', None, {'nprobe': n}) for n in nprobe]
+    configs += [('IVFFlat', 'SQ8', {'nprobe': n}) for n in nprobe]
+    configs += [('IVFPQ', None, {'nprobe': n}) for n in nprobe]
+    configs += [('HNSW', None, {'ef_search': ef}) for ef in ef_search]
+
+    truth = None
+    built = {}
+    print(f'{"index":>24} {"params":>14} {"build s":>8} {"MB":>8} '
+          f'{"recall@" + str(k):>9} {"p50 ms":>7} {"p95 ms":>7}')
+    for index_type, sq, params in configs:
+        description = factory_string(index_type, nlist, pq_m, hnsw_m, sq)
+        if description not in built:
+            start = timeit.default_timer()
+            index = faiss.index_factory(dim, description, faiss.METRIC_L2)
+            if not index.is_trained:
+                sample = vectors[:max(train, min_train_size(index))]
+                index.train(sample)
+            index.add(vectors)
+            built[description] = (index, timeit.default_timer() - start, index_size(index))
+        index, build, size = built[description]
+        tune_index(index, params.get('nprobe'), params.get('ef_search'))
+
+        labels, seconds = search(index, queries, k)
+        if truth is None:
+            # first config is exact search
+            truth = labels
+        p50, p95 = np.percentile(seconds, [50, 95]) * 1000
+        label = ' '.join(f'{key}={value}' for key, value in params.items())
+        print(f'{description:>24} {label:>14} {build:8.2f} {size / 1024 / 1024:8.1f} '
+              f'{recall(labels, truth):9.3f} {p50:7.3f} {p95:7.3f}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vectors', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=6, help='same as VECTOR_COUNT')
+    parser.add_argument('--nlist', type=int, default=1024)
+    parser.add_argument('--pq-m', type=int, default=48)
+    parser.add_argument('--hnsw-m', type=int, default=32)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 16, 64])
+    parser.add_argument('--ef-search', type=int, nargs='+', default=[32, 64, 128])
+    parser.add_argument('--train', type=int, default=65536, help='vectors to train with')
+    args = parser.parse_args()
+
+    run(args.vectors, args.dim, args.queries, args.k, args.nlist, args.pq_m,
+        args.hnsw_m, args.nprobe, args.ef_search, args.train)
@@ -0,0 +1,127 @@
+# =========================
+#  Module: IDOL indexing benchmark
+# =========================
+"""
+Index a synthetic corpus into the local IDOL stub with different numbers of
+concurrent DREADDDATA batches, or compare with IDX built the way it was
+before (string concatenation, full repr of floats).
+
+    python -m bench.idol_index --docs 5000 --latency 50 --concurrency 1 4 8
+    python -m bench.idol_index --docs 20000 --latency 0 --legacy
+"""
+import argparse
+import hashlib
+import random
+import timeit
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+from bench.idol_stub import start_stub
+from src.idol import IDOL
+
+
+class RandomEmbeddings(Embeddings):
+    """ deterministic pseudo embeddings, costs nearly nothing
+    """
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+    def embed_query(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha1(text.encode('utf-8')).digest()[:4], 'little')
+        return np.random.default_rng(seed).standard_normal(self.dim, dtype=np.float32).tolist()
+
+
+class LegacyIDOL(IDOL):
+    """ IDX built by repeated f-string concatenation, vectors by str(float)
+    """
+
+    def add_embeddings(
+        self,
+        text_embeddings: Any,
+        metadatas: Optional[List[Dict]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        text_embeddings = list(text_embeddings)
+        ids = kwargs.get('ids') or self._references(metadatas, len(text_embeddings))
+        index = ''
+        documents = 0
+        for ref, (content, embedding) in zip(ids, text_embeddings):
+            if index and self.index_batch_size < len(index):
+                self._index(index, documents)
+                index = ''
+                documents = 0
+            vector = ','.join([str(x) for x in embedding])
+            index = f"""{index}
+#DREREFERENCE {ref}
+#DREFIELD {self.vector_field}="{vector}"
+#DREDBNAME {self.database}
+#DRECONTENT
+{content}
+#DREENDDOC
+"""
+            documents += 1
+        if index:
+            self._index(index, documents)
+        return ids
+
+
+def synthetic_corpus(docs: int, size: int = 500, seed: int = 0):
+    """ texts of about `size` characters and their metadatas
+    """
+    rng = random.Random(seed)
+    words = [''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(2, 10)))
+             for _ in range(5000)]
+    texts, metadatas = [], []
+    for i in range(docs):
+        text = []
+        while sum(len(w) + 1 for w in text) < size:
+            text.append(rng.choice(words))
+        texts.append(' '.join(text))
+        metadatas.append({'source': f'data/synthetic_{i // 50}.pdf'})
+    return texts, metadatas
+
+
+def run(docs: int, latency: float, concurrency: List[int], batch_size: int,
+        legacy: bool = False, precision: Optional[int] = 6) -> None:
+    texts, metadatas = synthetic_corpus(docs)
+    embeddings = RandomEmbeddings()
+    # vectors are computed once, only indexing is measured
+    vectors = embeddings.embed_documents(texts)
+
+    variants: List[Tuple[str, Any, Optional[int]]] = [('writer', IDOL, precision)]
+    if legacy:
+        variants.insert(0, ('legacy', LegacyIDOL, None))
+
+    print(f'{"variant":>8} {"concurrency":>11} {"seconds":>8} {"docs/s":>8} {"MB":>6}  report')
+    for name, cls, digits in variants:
+        for n in concurrency:
+            server, store, url = start_stub(latency=latency / 1000)
+            idol = cls(embeddings, url, index_batch_size=batch_size,
+                       index_concurrency=n, vector_precision=digits)
+            start = timeit.default_timer()
+            idol.add_embeddings(zip(texts, vectors), metadatas)
+            idol._sync()
+            seconds = timeit.default_timer() - start
+            server.shutdown()
+            assert len(store.documents) == docs, f'{len(store.documents)} of {docs} indexed'
+            print(f'{name:>8} {n:>11} {seconds:8.2f} {docs / seconds:8.0f} '
+                  f'{idol.report.bytes / 1024 / 1024:6.1f}  {idol.report}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--docs', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=50, help='ms of stub per request')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--batch-size', type=int, default=2621440, help='bytes of a DREADDDATA batch')
+    parser.add_argument('--precision', type=int, default=6, help='significant digits of vectors')
+    parser.add_argument('--legacy', action='store_true', help='compare with IDX built as before')
+    args = parser.parse_args()
+
+    run(args.docs, args.latency, args.concurrency, args.batch_size, args.legacy, args.precision)
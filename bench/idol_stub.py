@@ -0,0 +1,217 @@
+# =========================
+#  Module: Local stub of IDOL Content ACI
+# =========================
+"""
+In-memory stand-in for the IDOL Content actions used by `src/idol.py`:
+DREADDDATA, DREDELETEREF, DRESYNC and query. Good enough to benchmark and
+test indexing and search offline, not a search engine.
+
+    python -m bench.idol_stub --port 9100 --latency 20 --fail-rate 0.05
+"""
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+
+_VECTOR = re.compile(r'VECTOR\{([^}]*)\}:(\w+)')
+_WORD = re.compile(r'\w+')
+
+
+class IdolStore:
+    """ documents indexed into the stub, by reference
+    """
+
+    def __init__(self):
+        self.documents: Dict[str, Dict] = {}
+        self.lock = threading.Lock()
+        self.requests: Dict[str, int] = {}
+
+
+    def count(self, action: str) -> None:
+        with self.lock:
+            self.requests[action] = self.requests.get(action, 0) + 1
+
+
+    def add(self, idx: str) -> int:
+        added = 0
+        for block in idx.split('#DREENDDOC'):
+            doc = {'fields': {}, 'content': ''}
+            lines = block.strip('\n').split('\n')
+            for i, line in enumerate(lines):
+                if line.startswith('#DREREFERENCE '):
+                    doc['reference'] = line[len('#DREREFERENCE '):]
+                elif line.startswith('#DREFIELD '):
+                    name, _, value = line[len('#DREFIELD '):].partition('=')
+                    doc['fields'][name] = value.strip('"')
+                elif line.startswith('#DREDBNAME '):
+                    doc['database'] = line[len('#DREDBNAME '):]
+                elif line == '#DRECONTENT':
+                    doc['content'] = '\n'.join(lines[i + 1:])
+                    break
+            if 'reference' in doc:
+                with self.lock:
+                    self.documents[doc['reference']] = doc
+                added += 1
+        return added
+
+
+    def delete(self, refs: List[str]) -> int:
+        with self.lock:
+            return sum(self.documents.pop(ref, None) is not None for ref in refs)
+
+
+    def query(self, text: str, maxresults: int) -> List[Tuple[float, Dict]]:
+        match = _VECTOR.search(text)
+        vector = [float(x) for x in match.group(1).split(',')] if match else None
+        field = match.group(2) if match else None
+        words = {w.lower() for w in _WORD.findall(_VECTOR.sub(' ', text))} - {'and', 'or', 'not'}
+
+        hits = []
+        with self.lock:
+            documents = list(self.documents.values())
+        for doc in documents:
+            content = doc['content'].lower()
+            keyword = sum(w in content for w in words) / len(words) if words else None
+            if keyword == 0:
+                continue
+            if vector is not None and field in doc['fields']:
+                other = [float(x) for x in doc['fields'][field].split(',')]
+                dot = sum(a * b for a, b in zip(vector, other))
+                norm = math.sqrt(sum(a * a for a in vector) * sum(b * b for b in other)) or 1.0
+                weight = (dot / norm + 1) * 50
+            elif vector is not None:
+                continue
+            else:
+                weight = keyword * 100
+            hits.append((weight, doc))
+        hits.sort(key=lambda h: -h[0])
+        return hits[:maxresults]
+
+
+class IdolHandler(BaseHTTPRequestHandler):
+    """ ACI actions, in path style "/a=query&..." or query string style
+    """
+
+    store: IdolStore = None
+    latency: float = 0.0
+    fail_rate: float = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def _params(self) -> Tuple[str, Dict[str, str]]:
+        parts = urlsplit(self.path)
+        path = parts.path.lstrip('/')
+        query = parts.query
+        action = path
+        if '=' in path:
+            # "/a=query&text=..."
+            query = f'{path}&{query}' if query else path
+            action = ''
+        params = {k.lower(): v for k, v in parse_qsl(query, keep_blank_values=True)}
+        action = action or params.get('a') or params.get('action', '')
+        return action.upper(), params
+
+
+    def _reply(self, status: int, body: str, content_type: str = 'text/plain') -> None:
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', f'{content_type}; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def _handle(self, body: bytes) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+        action, params = self._params()
+        self.store.count(action)
+        if self.fail_rate and random.random() < self.fail_rate:
+            self._reply(503, 'ERROR: stub failure')
+            return
+
+        if action == 'DREADDDATA':
+            text = body.decode('utf-8')
+            added = self.store.add(text.replace('#DREENDDATAREFERENCE', ''))
+            self._reply(200, f'INDEXID={added}')
+        elif action == 'DREDELETEREF':
+            form = dict(parse_qsl(body.decode('utf-8'))) if body else {}
+            docs = form.get('Docs') or params.get('docs', '')
+            refs = [unquote(ref) for ref in docs.split()]
+            self._reply(200, f'INDEXID={self.store.delete(refs)}')
+        elif action == 'DRESYNC':
+            self._reply(200, 'INDEXID=0')
+        elif action == 'QUERY':
+            self._query(params)
+        else:
+            self._reply(400, f'ERROR: unknown action {action}')
+
+
+    def _query(self, params: Dict[str, str]) -> None:
+        hits = self.store.query(params.get('text', ''), int(params.get('maxresults', 6)))
+        printfields = [f for f in params.get('printfields', '').split(',') if f]
+        result = []
+        for weight, doc in hits:
+            document = {'DRECONTENT': [{'$': doc['content']}]}
+            for name in printfields:
+                if name in doc['fields']:
+                    document[name] = [{'$': doc['fields'][name]}]
+            result.append({'autn:reference': {'$': doc['reference']},
+                           'autn:weight': {'$': f'{weight:.2f}'},
+                           'autn:content': {'DOCUMENT': [document]}})
+        data = {'autnresponse': {'action': {'$': 'QUERY'},
+                                 'response': {'$': 'SUCCESS'},
+                                 'responsedata': {'autn:numhits': {'$': str(len(result))},
+                                                  'autn:hit': result}}}
+        self._reply(200, json.dumps(data, ensure_ascii=False), 'application/json')
+
+
+    def do_GET(self):
+        self._handle(b'')
+
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self._handle(self.rfile.read(length))
+
+
+def start_stub(port: int = 0, latency: float = 0.0, fail_rate: float = 0.0):
+    """
+    Run stub in a background thread.
+
+    Returns
+    -------
+    (ThreadingHTTPServer, IdolStore, str)
+        server, its documents and url.
+
+    """
+    handler = type('Handler', (IdolHandler,), {'store': IdolStore(),
+                                               'latency': latency,
+                                               'fail_rate': fail_rate})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, handler.store, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--latency', type=float, default=0, help='ms added to every request')
+    parser.add_argument('--fail-rate', type=float, default=0, help='fraction of requests failed with 503')
+    args = parser.parse_args()
+
+    server, _, url = start_stub(args.port, args.latency / 1000, args.fail_rate)
+    print(f'IDOL stub listening on {url}, serves both index and search actions')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
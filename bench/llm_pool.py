@@ -0,0 +1,106 @@
+# =========================
+#  Module: LLM worker pool benchmark
+# =========================
+"""
+Generate answers of synthetic prompts concurrently with the model of
+MODEL_TYPE and MODEL_BIN_PATH, for layouts of workers and threads, and
+print aggregate tokens per second, latency of answers and memory used by
+every layout, to choose LLM_WORKERS, LLM_WORKER_THREADS and
+LLM_PIN_CORES for a host.
+
+    python -m bench.llm_pool
+    python -m bench.llm_pool --layouts 1x8 2x4 4x2 8x1 --prompts 16 --pin
+"""
+import argparse
+import gc
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+import numpy as np
+import src.llm
+from bench.idol_index import synthetic_corpus
+from src.context import token_counter
+from src.llm_pool import available_cores
+from src.prompts import qa_template
+
+
+def parse_layout(text: str) -> Tuple[int, int]:
+    """ workers and threads of a layout like '2x4'
+    """
+    workers, _, threads = text.lower().partition('x')
+    return int(workers), int(threads or 0)
+
+
+def memory_mb() -> Optional[float]:
+    """ proportional set size of this process, None where /proc is missing;
+    unlike RSS it counts pages of a file mapped by several workers once
+    """
+    try:
+        with open('/proc/self/smaps_rollup', 'r', encoding='utf8') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def prompts(count: int, chunks: int) -> List[str]:
+    """ prompts of the application with synthetic chunks, none sharing its context
+    """
+    texts = synthetic_corpus(count * chunks)[0]
+    return [qa_template.format(context='\n\n'.join(texts[i * chunks:(i + 1) * chunks]),
+                               question=f'What does chunk {i} say about {texts[i * chunks].split()[0]}?')
+            for i in range(count)]
+
+
+def run(layouts: List[str], count: int, chunks: int, max_tokens: int, pin: bool) -> None:
+    cfg = src.llm.cfg
+    cfg.MAX_NEW_TOKENS = max_tokens
+    texts = prompts(count, chunks)
+    print(f'{cfg.MODEL_TYPE} {cfg.MODEL_BIN_PATH}, {len(available_cores())} cores, {count} prompts')
+    print(f'{"layout":>7} {"load s":>7} {"mem MB":>7} {"tokens/s":>8} {"p50 s":>7} {"p95 s":>7}')
+    for layout in layouts:
+        workers, threads = parse_layout(layout)
+        cfg.LLM_WORKERS, cfg.LLM_WORKER_THREADS, cfg.LLM_PIN_CORES = workers, threads, pin
+        before = memory_mb()
+        start = timeit.default_timer()
+        llm = src.llm.build_llm()
+        load = timeit.default_timer() - start
+        count_tokens = token_counter(llm)
+
+        def answer(prompt):
+            begin = timeit.default_timer()
+            text = llm(prompt)
+            return count_tokens(text), timeit.default_timer() - begin
+
+        start = timeit.default_timer()
+        with ThreadPoolExecutor(workers) as pool:
+            results = list(pool.map(answer, texts))
+        seconds = timeit.default_timer() - start
+        tokens = sum(n for n, _ in results)
+        p50, p95 = np.percentile([s for _, s in results], [50, 95])
+        # mapped weights are read at first generation
+        after = memory_mb()
+        memory = after - before if before is not None and after is not None else 0
+        print(f'{layout:>7} {load:>7.1f} {memory:>7.0f} {tokens / seconds:>8.1f} {p50:>7.2f} {p95:>7.2f}')
+        del llm, count_tokens
+        gc.collect()
+
+
+if __name__ == "__main__":
+    cores = len(available_cores())
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--layouts', nargs='+',
+                        default=[f'{w}x{cores // w}' for w in (1, 2, 4) if cores // w],
+                        help='WORKERSxTHREADS, threads 0 for cores divided by workers')
+    parser.add_argument('--prompts', type=int, default=8)
+    parser.add_argument('--chunks', type=int, default=3, help='chunks in context of a prompt')
+    parser.add_argument('--max-tokens', type=int, default=64, help='MAX_NEW_TOKENS of answers')
+    parser.add_argument('--pin', action='store_true', help='pin workers to their own cores')
+    args = parser.parse_args()
+
+    if src.llm.cfg.MODEL_TYPE == 'ollama' or src.llm.cfg.SEARCH_ONLY:
+        print('ERROR: no model in this process, set MODEL_TYPE to chatglm, chatglm_cpp or a ctransformers model')
+    else:
+        run(args.layouts, args.prompts, args.chunks, args.max_tokens, args.pin)
@@ -0,0 +1,426 @@
+# =========================
+#  Module: Retrieval and generation benchmark suite
+# =========================
+"""
+Build an index of a corpus with the settings of every run of a suite file,
+and measure build throughput, index size, retrieval latency percentiles,
+recall@k of a labeled question set, and LLM tokens/s. Results are appended
+as JSON lines to compare settings, and commits, across runs.
+
+    python -m bench.suite
+    python -m bench.suite --data data/ --questions questions.jsonl --runs chunk-500 idol
+    python -m bench.suite --compare
+
+Every run overrides keys of config/config.yml, see bench/suite.yml.
+`EMBEDDINGS_MODEL: hash` and `MODEL_TYPE: echo` are stand-ins of models
+which run offline, and `VECTOR_DB: IDOL` is served by the local IDOL stub.
+
+Without `--data`, a synthetic corpus is generated. Without `--questions`,
+questions are phrases picked from the corpus, labeled with their document.
+Labeled questions are JSON lines with "query", and "source" (file name),
+"page" or "text" contained in a relevant chunk.
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import zipfile
+from typing import Any, Dict, Iterator, List, Mapping, Optional
+from xml.sax.saxutils import escape
+import box
+import numpy as np
+import yaml
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.llms.base import LLM
+from langchain.schema.embeddings import Embeddings
+# every module with config is loaded before configure() overrides it
+import db_build
+import src.context
+import src.embeddings
+import src.faiss_store
+import src.idol
+import src.llm
+import src.utils
+from bench.idol_index import synthetic_corpus
+from bench.idol_stub import start_stub
+from src.bm25 import tokenize
+from src.pipeline import load_source
+from src.shards import ShardedFAISS
+from src.tracing import Tracer
+from src.utils import build_trace_handler, setup_dbqa
+
+
+_SPACES = re.compile(r'\s+')
+
+
+class HashEmbeddings(Embeddings):
+    """ bag of hashed words, similar texts get similar vectors without a model
+    """
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in tokenize(text):
+            h = int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+            vector[h % self.dim] += 1.0 if h >> 63 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+
+class EchoLLM(LLM):
+    """ streams the end of its prompt back, to run the chain without a model
+    """
+
+    max_tokens: int = 64
+
+    @property
+    def _llm_type(self) -> str:
+        return "echo-llm"
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        words = prompt.split()[-self.max_tokens:]
+        for word in words:
+            if run_manager:
+                run_manager.on_llm_new_token(word + ' ')
+        return ' '.join(words)
+
+    @property
+    def _identifying_params(self) -> Mapping[str, Any]:
+        return {"max_tokens": self.max_tokens}
+
+
+@contextlib.contextmanager
+def configure(settings: Dict[str, Any]) -> Iterator[None]:
+    """
+    Override config of every module which loaded config/config.yml, and
+    replace models by stand-ins if asked to.
+    """
+    modules = [m for m in list(sys.modules.values()) if isinstance(getattr(m, 'cfg', None), box.Box)]
+    saved = [(m, dict(m.cfg)) for m in modules]
+    builders = [(db_build, 'build_embeddings', db_build.build_embeddings),
+                (src.utils, 'build_embeddings', src.utils.build_embeddings),
+                (src.utils, 'build_llm', src.utils.build_llm)]
+    for m in modules:
+        m.cfg.update(settings)
+    if settings.get('EMBEDDINGS_MODEL') == 'hash':
+        db_build.build_embeddings = src.utils.build_embeddings = HashEmbeddings
+    if settings.get('MODEL_TYPE') == 'echo' and not settings.get('SEARCH_ONLY'):
+        src.utils.build_llm = EchoLLM
+    try:
+        yield
+    finally:
+        for m, cfg in saved:
+            m.cfg.clear()
+            m.cfg.update(cfg)
+        for m, name, builder in builders:
+            setattr(m, name, builder)
+
+
+# parts of the smallest DOCX file Docx2txtLoader reads
+DOCX_PARTS = {
+    '[Content_Types].xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/word/document.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+        '</Types>',
+    '_rels/.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="word/document.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>',
+}
+
+
+def write_docx(path: str, paragraphs: List[str]) -> None:
+    """ DOCX file of paragraphs of plain text
+    """
+    body = ''.join(f'<w:p><w:r><w:t xml:space="preserve">{escape(text)}</w:t></w:r></w:p>'
+                   for text in paragraphs)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as f:
+        for name, xml in DOCX_PARTS.items():
+            f.writestr(name, xml)
+        f.writestr('word/document.xml',
+                   '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                   '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                   f'<w:body>{body}</w:body></w:document>')
+
+
+def write_synthetic(folder: str, docs: int, seed: int = 0) -> None:
+    """ DOCX files of 50 paragraphs of random words each, a format db_build.py indexes
+    """
+    texts, metadatas = synthetic_corpus(docs, seed=seed)
+    files: Dict[str, List[str]] = {}
+    for text, metadata in zip(texts, metadatas):
+        name = os.path.splitext(os.path.basename(metadata['source']))[0] + '.docx'
+        files.setdefault(name, []).append(text)
+    os.makedirs(folder, exist_ok=True)
+    for name, paragraphs in files.items():
+        write_docx(os.path.join(folder, name), paragraphs)
+
+
+def sample_questions(sources: List[str], count: int, words: int = 8, seed: int = 0) -> List[Dict[str, Any]]:
+    """ phrases of documents as queries, labeled with document and middle of phrase
+    """
+    rng = random.Random(seed)
+    pages = [doc for source in sources for doc in load_source(source)]
+    questions = []
+    for _ in range(count * 10):
+        if len(questions) == count or not pages:
+            break
+        doc = rng.choice(pages)
+        # within a paragraph, chunks are not cut there
+        paragraphs = [p.split() for p in re.split(r'\n\s*\n', doc.page_content) if len(p.split()) >= words]
+        if not paragraphs:
+            continue
+        tokens = rng.choice(paragraphs)
+        start = rng.randrange(len(tokens) - words + 1)
+        phrase = tokens[start:start + words]
+        questions.append({'query': ' '.join(phrase),
+                          'source': os.path.basename(doc.metadata['source']),
+                          'text': ' '.join(phrase[words // 2 - 1:words // 2 + 1])})
+    return questions
+
+
+def read_jsonl(path: str) -> List[Dict[str, Any]]:
+    with open(path, 'r', encoding='utf8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def relevant(doc: Any, label: Dict[str, Any]) -> bool:
+    # IDOL returns reference "{source}#{section}" as source
+    source = os.path.basename(str(doc.metadata.get('source', '')).rsplit('#', 1)[0])
+    if label.get('source') and source != os.path.basename(label['source']):
+        return False
+    if 'page' in label and doc.metadata.get('page') != label['page']:
+        return False
+    if label.get('text'):
+        return _SPACES.sub(' ', label['text']).lower() in _SPACES.sub(' ', doc.page_content).lower()
+    return True
+
+
+def folder_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(folder, name))
+               for folder, _, names in os.walk(path) for name in names)
+
+
+def percentiles(seconds: List[float]) -> Dict[str, Optional[float]]:
+    if not seconds:
+        return {'p50': None, 'p95': None, 'p99': None}
+    p50, p95, p99 = np.percentile(seconds, [50, 95, 99]) * 1000
+    return {'p50': p50, 'p95': p95, 'p99': p99}
+
+
+def run(name: str, settings: Dict[str, Any], data: str, questions: List[Dict[str, Any]],
+        k: int, llm_queries: int, folder: str) -> Dict[str, Any]:
+    """
+    Parameters
+    ----------
+    name : str
+        name of run.
+    settings : Dict[str, Any]
+        keys of config to override.
+    data : str
+        folder of corpus.
+    questions : List[Dict[str, Any]]
+        labeled questions.
+    k : int
+        chunks retrieved per question, VECTOR_COUNT.
+    llm_queries : int
+        questions answered by LLM, the first ones.
+    folder : str
+        folder for index of run.
+
+    Returns
+    -------
+    Dict[str, Any]
+        result of run.
+
+    """
+    settings = dict({'DATA_PATH': data,
+                     'DB_FAISS_PATH': os.path.join(folder, name, 'db_faiss'),
+                     'MANIFEST_PATH': os.path.join(folder, name, 'manifest.json'),
+                     'EMBEDDING_CACHE_PATH': '',
+                     'PARSED_CACHE_PATH': '',
+                     'QUERY_CACHE_PATH': '',
+                     'TRACE_PATH': '',
+                     'VECTOR_COUNT': k}, **settings)
+    stub = None
+    if settings.get('VECTOR_DB') == 'IDOL' and 'IDOL_INDEX_URL' not in settings:
+        stub, store, url = start_stub()
+        settings.update(IDOL_INDEX_URL=url, IDOL_SEARCH_URL=url, IDOL_DATABASE='bench')
+
+    result: Dict[str, Any] = {'name': name, 'settings': settings}
+    try:
+        with configure(settings):
+            start = timeit.default_timer()
+            vectorstore = db_build.run_db_build(rebuild=True)
+            result['build_seconds'] = timeit.default_timer() - start
+            if stub is not None:
+                result['chunks'] = len(store.documents)
+                result['index_bytes'] = vectorstore.report.bytes
+            else:
+                result['chunks'] = vectorstore.ntotal if isinstance(vectorstore, ShardedFAISS) \
+                    else vectorstore.index.ntotal
+                result['index_bytes'] = folder_size(settings['DB_FAISS_PATH'])
+            result['chunks_per_second'] = result['chunks'] / result['build_seconds']
+
+            start = timeit.default_timer()
+            dbqa = setup_dbqa()
+            result['load_seconds'] = timeit.default_timer() - start
+
+            # retrieval, one question at a time as main.py does
+            seconds, hits = [], 0
+            for question in questions:
+                start = timeit.default_timer()
+                docs = dbqa.retriever.get_relevant_documents(question['query'])
+                seconds.append(timeit.default_timer() - start)
+                hits += any(relevant(doc, question) for doc in docs[:k])
+            result['retrieve_ms'] = percentiles(seconds)
+            result[f'recall@{k}'] = hits / len(questions) if questions else None
+
+            if not settings.get('SEARCH_ONLY') and llm_queries:
+                result.update(generate(dbqa, questions[:llm_queries]))
+    finally:
+        if stub is not None:
+            stub.shutdown()
+    return result
+
+
+def generate(dbqa: Any, questions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """ answer questions, timed by tracing
+    """
+    tracer = Tracer()
+    handler = build_trace_handler(dbqa)
+    totals, first_tokens = [], []
+    tokens, decode = 0, 0.0
+    for question in questions:
+        with tracer.trace('query') as trace:
+            dbqa({'query': question['query']}, callbacks=[handler])
+        totals.append(trace.seconds)
+        for s in trace.spans:
+            if s['name'] == 'prefill':
+                first_tokens.append(s['start'] + s['seconds'])
+            elif s['name'] == 'decode':
+                tokens += s['tokens']
+                decode += s['seconds']
+    return {'answer_ms': percentiles(totals),
+            'first_token_ms': percentiles(first_tokens),
+            'tokens_per_second': tokens / decode if decode else None}
+
+
+def available(settings: Dict[str, Any]) -> bool:
+    """ models of run are stand-ins or downloaded
+    """
+    model = settings.get('EMBEDDINGS_MODEL')
+    if model and model != 'hash' and model.startswith('models/') and not os.path.exists(model):
+        print(f'INFO: {model} not found')
+        return False
+    return True
+
+
+def commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(results: List[Dict[str, Any]]) -> None:
+    def number(value, digits=1):
+        return '-' if value is None else f'{value:.{digits}f}'
+
+    print(f'{"run":>14} {"commit":>8} {"chunks":>7} {"build s":>8} {"chunks/s":>9} {"MB":>7} '
+          f'{"p50 ms":>7} {"p95 ms":>7} {"p99 ms":>7} {"recall":>7} {"tok/s":>7}')
+    for r in results:
+        retrieve = r.get('retrieve_ms', {})
+        recall = next((value for key, value in r.items() if key.startswith('recall@')), None)
+        print(f'{r["name"]:>14} {r.get("commit") or "-":>8} {r.get("chunks", 0):>7} '
+              f'{number(r.get("build_seconds"), 2):>8} {number(r.get("chunks_per_second"), 0):>9} '
+              f'{number(r.get("index_bytes", 0) / 1024 / 1024, 2):>7} '
+              f'{number(retrieve.get("p50"), 2):>7} {number(retrieve.get("p95"), 2):>7} '
+              f'{number(retrieve.get("p99"), 2):>7} {number(recall, 3):>7} '
+              f'{number(r.get("tokens_per_second")):>7}')
+
+
+def run_suite(suite: str, runs: Optional[List[str]], data: Optional[str], docs: int,
+              questions: Optional[str], count: int, k: int, llm_queries: int, output: str) -> None:
+    with open(suite, 'r', encoding='utf8') as f:
+        config = yaml.safe_load(f)
+    names = runs or list(config['runs'])
+
+    with tempfile.TemporaryDirectory() as folder:
+        corpus = {'data': data, 'docs': None}
+        if data is None:
+            data = os.path.join(folder, 'data')
+            write_synthetic(data, docs)
+            corpus = {'data': 'synthetic', 'docs': docs}
+        if questions:
+            labeled = read_jsonl(questions)
+            corpus['questions'] = questions
+        else:
+            sources = sorted(os.path.join(data, name) for name in os.listdir(data)
+                             if os.path.splitext(name)[1].lower() in db_build.LOADERS)
+            labeled = sample_questions(sources, count)
+            corpus['questions'] = f'{len(labeled)} sampled'
+
+        results = []
+        for name in names:
+            settings = dict(config.get('defaults') or {}, **(config['runs'][name] or {}))
+            if not available(settings):
+                print(f'INFO: skip {name}')
+                continue
+            print(f'INFO: run {name}')
+            result = run(name, settings, data, labeled, k, llm_queries, folder)
+            result.update(time=time.time(), commit=commit(), corpus=corpus)
+            results.append(result)
+            with open(output, 'a', encoding='utf8') as f:
+                f.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+    print_table(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--suite', default='bench/suite.yml', help='runs and their settings')
+    parser.add_argument('--runs', nargs='+', help='names of runs in suite, all by default')
+    parser.add_argument('--data', help='folder of corpus, synthetic corpus by default')
+    parser.add_argument('--docs', type=int, default=2000, help='paragraphs of synthetic corpus')
+    parser.add_argument('--questions', help='JSON lines of labeled questions')
+    parser.add_argument('--count', type=int, default=200, help='questions sampled from corpus')
+    parser.add_argument('--k', type=int, default=4, help='chunks retrieved, VECTOR_COUNT')
+    parser.add_argument('--llm-queries', type=int, default=20, help='questions answered by LLM')
+    parser.add_argument('--output', default='bench/results.jsonl', help='results are appended to it')
+    parser.add_argument('--compare', action='store_true', help='print results of output and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        print_table(read_jsonl(args.output))
+    else:
+        run_suite(args.suite, args.runs, args.data, args.docs, args.questions, args.count,
+                  args.k, args.llm_queries, args.output)
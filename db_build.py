@@ -1,58 +1,353 @@
 # =========================
 #  Module: Vector DB Build
 # =========================
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 import box
 import yaml
 from langchain.vectorstores import FAISS
-from langchain.text_splitter import RecursiveCharacterTextSplitter, CharacterTextSplitter
-from langchain.document_loaders import PyPDFLoader, Docx2txtLoader, DirectoryLoader
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.schema.document import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from src.chunker import RegexTextSplitter
+from src.embeddings import build_embeddings, embeddings_id
+from src.faiss_store import (config_factory_string, create_store, load_store,
+                             needs_training, save_store, supports_remove)
 from src.idol import IDOL
+from src.manifest import Manifest, chunk_hash
+from src.pipeline import IngestPipeline, LOADERS, ParsedTextCache
+from src.shards import shard_of, shard_path
+from src.snapshots import Snapshots, link_tree, release
 
 # Import config vars
 with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
     cfg = box.Box(yaml.safe_load(ymlfile))
 
 
-# Build vector database
-def run_db_build():
-    loaders = [DirectoryLoader(cfg.DATA_PATH,
-                             glob='*.pdf',
-                             loader_cls=PyPDFLoader),
-               DirectoryLoader(cfg.DATA_PATH,
-                                        glob='*.docx',
-                                        loader_cls=Docx2txtLoader)]
-    documents = [doc for ld in loaders for doc in ld.load()]
+def list_sources():
+    """ documents under data path, named the same way as DirectoryLoader
+    """
+    return sorted(str(p) for ext in LOADERS
+                  for p in Path(cfg.DATA_PATH).glob(f'*{ext}')
+                  if p.is_file())
+
 
+def build_text_splitter():
     if cfg.REG_SEPARATORS:
-        text_splitter = CharacterTextSplitter(separator=cfg.REG_SEPARATORS,
-                                              is_separator_regex=True,
-                                              keep_separator=True,
-                                              chunk_size=cfg.CHUNK_SIZE,
-                                              chunk_overlap=cfg.CHUNK_OVERLAP)
-    else:
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=cfg.CHUNK_SIZE,
-                                                       chunk_overlap=cfg.CHUNK_OVERLAP)
+        # same chunks as CharacterTextSplitter with the separator kept, see bench/chunker.py
+        return RegexTextSplitter(separator=cfg.REG_SEPARATORS,
+                                 chunk_size=cfg.CHUNK_SIZE,
+                                 chunk_overlap=cfg.CHUNK_OVERLAP)
+    return RecursiveCharacterTextSplitter(chunk_size=cfg.CHUNK_SIZE,
+                                          chunk_overlap=cfg.CHUNK_OVERLAP)
+
+
+def build_shards():
+    """ number of FAISS shards, IDOL distributes its databases itself
+    """
+    return 1 if cfg.VECTOR_DB == 'IDOL' else max(cfg.FAISS_SHARDS, 1)
+
+
+def build_settings(embeddings):
+    """ settings which change vectors, index is rebuilt if any of them changes
+    """
+    settings = {'VECTOR_DB': cfg.VECTOR_DB,
+                'TARGET': cfg.IDOL_DATABASE if cfg.VECTOR_DB == 'IDOL' else cfg.DB_FAISS_PATH,
+                'EMBEDDINGS_MODEL': embeddings_id(embeddings),
+                'REG_SEPARATORS': cfg.REG_SEPARATORS,
+                'CHUNK_SIZE': cfg.CHUNK_SIZE,
+                'CHUNK_OVERLAP': cfg.CHUNK_OVERLAP,
+                'FAISS_INDEX': config_factory_string()}
+    if build_shards() > 1:
+        # manifests of unsharded indexes stay valid
+        settings['FAISS_SHARDS'] = build_shards()
+    return settings
+
+
+class IndexWriter:
+    """ last stage of ingestion pipeline
+
+    FAISS is created on first vectors, or on first FAISS_TRAIN_SAMPLE vectors
+    if its index type needs training.
+    """
+
+    def __init__(self, vectorstore, embeddings):
+        self.vectorstore = vectorstore
+        self.embeddings = embeddings
+        self.deleted = 0
+        self.known = None
+        if isinstance(vectorstore, FAISS):
+            self.known = set(vectorstore.index_to_docstore_id.values())
+        # vectors waiting to train a new index
+        self.sample = ([], [], [], [])
+        self.sample_size = cfg.FAISS_TRAIN_SAMPLE if needs_training(config_factory_string()) else 0
+
+
+    def delete(self, ids):
+        if self.known is not None:
+            # FAISS.delete fails on unknown ids
+            ids = [ref for ref in ids if ref in self.known]
+            self.known.difference_update(ids)
+        elif self.vectorstore is None:
+            return
+        if ids:
+            self.vectorstore.delete(ids)
+            self.deleted += len(ids)
+
+
+    def add(self, texts, metadatas, ids, vectors):
+        if self.known is not None and 'unkown#0' in self.known:
+            self.delete(['unkown#0'])
+        if self.vectorstore is None:
+            for sample, items in zip(self.sample, (texts, metadatas, ids, vectors)):
+                sample.extend(items)
+            if len(self.sample[0]) >= self.sample_size:
+                self.close()
+        else:
+            self.vectorstore.add_embeddings(zip(texts, vectors), metadatas, ids=ids)
+            if self.known is not None:
+                self.known.update(ids)
+
+
+    def close(self):
+        """ create FAISS with vectors still waiting for training
+        """
+        if self.vectorstore is None and self.sample[0]:
+            texts, metadatas, ids, vectors = self.sample
+            self.vectorstore = create_store(self.embeddings, texts, vectors, metadatas, ids)
+            self.known = set(ids)
+            self.sample = ([], [], [], [])
+
+
+class ShardedWriter:
+    """ IndexWriter of every shard being built, chunks go to the shard of
+    their document
+    """
+
+    def __init__(self, writers, shards):
+        self.writers = writers
+        self.shards = shards
+
+
+    @property
+    def deleted(self):
+        return sum(writer.deleted for writer in self.writers.values())
 
-    if not documents:
-        documents = [Document(page_content='unkown', metadata={'source': 'unkown'})]
 
-    texts = text_splitter.split_documents(documents)
+    def _by_shard(self, ids):
+        rows = {}
+        for row, ref in enumerate(ids):
+            rows.setdefault(shard_of(ref.rsplit('#', 1)[0], self.shards), []).append(row)
+        return rows.items()
 
-    embeddings = HuggingFaceEmbeddings(model_name=cfg.EMBEDDINGS_MODEL,
-                                       model_kwargs={'device': cfg.DEVICE})
 
+    def delete(self, ids):
+        for shard, rows in self._by_shard(ids):
+            self.writers[shard].delete([ids[row] for row in rows])
+
+
+    def add(self, texts, metadatas, ids, vectors):
+        for shard, rows in self._by_shard(ids):
+            self.writers[shard].add(*([items[row] for row in rows]
+                                      for items in (texts, metadatas, ids, vectors)))
+
+
+# Build vector database
+def run_db_build(rebuild=False, shards=None):
+    """ index new and changed documents, of all shards or of shards given,
+    returns the vector store
+    """
+    count = build_shards()
+    selected = sorted(set(shards)) if shards else list(range(count))
+    if selected[0] < 0 or selected[-1] >= count:
+        print(f'ERROR: shards {selected} not in 0 to {count - 1}, see FAISS_SHARDS')
+        return None
+
+    embeddings = build_embeddings()
+    manifest = Manifest.load(cfg.MANIFEST_PATH, build_settings(embeddings))
+    # references of chunks indexed before, to delete from IDOL
+    forgotten = [c['id'] for entry in manifest.stale.values() for c in entry['chunks']]
+
+    def forget(dropped):
+        """ forget documents of shards whose index is dropped """
+        for source in [s for s in manifest.files if shard_of(s, count) in dropped]:
+            forgotten.extend(manifest.remove(source))
+
+    if rebuild:
+        forget(selected)
+
+    stores = {}
+    snapshots, base, reader = Snapshots(cfg.DB_FAISS_PATH), None, None
     if cfg.VECTOR_DB == 'IDOL' :
-        IDOL.from_documents(texts, embeddings, url = cfg.IDOL_INDEX_URL,
-                            field = cfg.IDOL_VECTOR_FIELD,
-                            database = cfg.IDOL_DATABASE,
-                            index_batch_size = cfg.IDOL_INDEX_BATCH_SIZE,
-                            search_type = cfg.IDOL_SEARCH_TYPE)
+        stores[0] = IDOL(embeddings, url = cfg.IDOL_INDEX_URL,
+                         vector_field = cfg.IDOL_VECTOR_FIELD,
+                         database = cfg.IDOL_DATABASE,
+                         index_batch_size = cfg.IDOL_INDEX_BATCH_SIZE,
+                         search_type = cfg.IDOL_SEARCH_TYPE,
+                         index_concurrency = cfg.IDOL_INDEX_CONCURRENCY,
+                         timeout = cfg.IDOL_TIMEOUT,
+                         retries = cfg.IDOL_RETRIES,
+                         vector_precision = cfg.IDOL_VECTOR_PRECISION)
+        # IDOL keeps documents of a manifest dropped, sections beyond the
+        # new number of chunks of a document and removed documents included
+        if forgotten:
+            print(f'INFO: deleting {len(forgotten)} chunks indexed before from IDOL')
+            if not stores[0].delete(forgotten):
+                print('ERROR: chunks indexed before not deleted from IDOL, index not built')
+                return None
     else:
-        vectorstore = FAISS.from_documents(texts, embeddings)
-        vectorstore.save_local(cfg.DB_FAISS_PATH)
+        # read current snapshot, it's not collected by other builds meanwhile
+        version, reader = snapshots.open()
+        base = snapshots.folder(version)
+        paths = {shard: shard_path(base, shard, count) for shard in selected}
+        indexed = {shard_of(s, count) for s in manifest.files}
+        existing = [shard for shard in selected
+                    if shard in indexed and os.path.exists(os.path.join(paths[shard], 'index.faiss'))]
+        with ThreadPoolExecutor(max(len(existing), 1)) as pool:
+            stores = dict(zip(existing, pool.map(
+                lambda shard: load_store(paths[shard], embeddings, writable=True), existing)))
+        # index is missing, manifest is useless
+        forget([shard for shard in selected if shard not in stores])
+
+    def diff():
+        sources = [s for s in list_sources() if shard_of(s, count) in selected]
+        changed, removed = manifest.diff(sources)
+        removed = [s for s in removed if shard_of(s, count) in selected]
+        return changed, removed, {shard_of(s, count) for s in sources}
+
+    changed, removed, needed = diff()
+    print(f'INFO: {len(changed)} new or changed, {len(removed)} removed documents')
+    if not rebuild and not changed and not removed and all(stores.get(shard) is not None
+                                                           for shard in (needed if count > 1 else [0])):
+        if reader is not None:
+            release(reader)
+        return built_store(stores, embeddings)
+    touched = {shard_of(s, count) for s in [source for source, _ in changed] + removed}
+    if rebuild:
+        # shards without documents left are dropped, not linked from the current snapshot
+        touched.update(selected)
+    unremovable = [shard for shard in touched
+                   if isinstance(stores.get(shard), FAISS) and not supports_remove(stores[shard].index)]
+    if unremovable:
+        print(f'INFO: index type can\'t delete vectors, rebuild all documents of shards {unremovable}')
+        for shard in unremovable:
+            stores[shard] = None
+        forget(unremovable)
+        changed, removed, _ = diff()
+        touched.update(unremovable)
+
+    writer = ShardedWriter({shard: IndexWriter(stores.get(shard), embeddings) for shard in selected},
+                           count)
+    # vectors of removed documents
+    writer.delete([ref for source in removed for ref in manifest.remove(source)])
+
+    text_splitter = build_text_splitter()
+    # chunk hashes of last build and chunks split so far, of documents being split
+    splitting = {}
+
+    def split(source, digest, documents, last):
+        """ only chunks which are new or changed in place are embedded,
+        pages of a document come in order, in one or more parts
+        """
+        if source not in splitting:
+            splitting[source] = ({c['id']: c['hash'] for c in manifest.chunks(source)}, [])
+        old, records = splitting[source]
+        deletes, chunks = [], []
+        for chunk in text_splitter.split_documents(documents):
+            ref = f'{source}#{len(records)}'
+            h = chunk_hash(chunk.page_content)
+            records.append({'id': ref, 'hash': h})
+            previous = old.pop(ref, None)
+            if previous == h:
+                continue
+            if previous is not None and cfg.VECTOR_DB != 'IDOL':
+                # IDOL replaces documents with same reference
+                deletes.append(ref)
+            chunks.append((chunk.page_content, chunk.metadata, ref))
+        if last:
+            deletes.extend(old)
+            manifest.update(source, digest, records)
+            del splitting[source]
+        return deletes, chunks
+
+    cache = ParsedTextCache(cfg.PARSED_CACHE_PATH) if cfg.PARSED_CACHE_PATH else None
+    pipeline = IngestPipeline(split, embeddings.embed_documents,
+                              writer.delete, writer.add,
+                              workers=cfg.BUILD_WORKERS,
+                              queue_size=cfg.BUILD_QUEUE_SIZE,
+                              batch_size=cfg.EMBED_BATCH_SIZE,
+                              pages_per_task=cfg.PDF_PAGES_PER_TASK,
+                              cache=cache)
+    for stats in pipeline.run(changed):
+        print(f'INFO: {stats}')
+    if cache is not None:
+        # text of files removed or changed
+        cache.prune({entry['hash'] for entry in manifest.files.values()})
+
+    # shards waiting for training sample are trained in parallel
+    writers = writer.writers
+    with ThreadPoolExecutor(len(writers)) as pool:
+        list(pool.map(lambda w: w.close(), writers.values()))
+    if count == 1 and writers[0].vectorstore is None:
+        # nothing to index
+        writers[0].add(['unkown'], [{'source': 'unkown'}], ['unkown#0'],
+                       embeddings.embed_documents(['unkown']))
+        writers[0].close()
+    print(f'INFO: {pipeline.stats[-1].count} chunks embedded, {writer.deleted} vectors deleted')
+
+    stores = {shard: w.vectorstore for shard, w in writers.items()}
+    if cfg.VECTOR_DB == 'IDOL':
+        stores[0]._sync()
+        print(f'INFO: {stores[0].report}')
+        failed = manifest.invalidate(stores[0].report.failed_refs)
+        if failed:
+            print(f'ERROR: {len(failed)} documents not fully indexed, run db_build.py again '
+                  f'to index them: {failed}')
+    else:
+        # new snapshot, running queries keep reading the current one
+        version = snapshots.create()
+        target = snapshots.building(version)
+        if count == 1:
+            touched = {0}
+        saved = [shard for shard in sorted(touched) if stores[shard] is not None]
+        with ThreadPoolExecutor(max(len(saved), 1)) as pool:
+            list(pool.map(lambda shard: save_store(stores[shard], shard_path(target, shard, count)),
+                          saved))
+        # shards not changed are shared with the current snapshot, shards
+        # of removed documents only are left out
+        for shard in range(count):
+            if count > 1 and shard not in touched and os.path.isdir(shard_path(base, shard, count)):
+                link_tree(shard_path(base, shard, count), shard_path(target, shard, count))
+        snapshots.publish(version)
+        release(reader)
+        print(f'INFO: index snapshot {version} published' +
+              (f', shards {saved} of {count} saved' if count > 1 else ''))
+    manifest.save()
+    if cfg.VECTOR_DB != 'IDOL':
+        removed = snapshots.collect()
+        if removed:
+            print(f'INFO: snapshots {removed} removed')
+    return built_store(stores, embeddings)
+
+
+def built_store(stores, embeddings):
+    """ IDOL store which indexed, with its report, or FAISS of the current
+    snapshot as main.py and server.py load it """
+    if cfg.VECTOR_DB == 'IDOL':
+        return stores[0]
+    from src.utils import build_vectordb
+    return build_vectordb(embeddings)
 
 
 if __name__ == "__main__":
-    run_db_build()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rebuild',
+                        action='store_true',
+                        help='Ignore manifest and index all documents again')
+    parser.add_argument('--shard',
+                        type=int,
+                        nargs='+',
+                        help='Index only documents of these shards of FAISS_SHARDS')
+    args = parser.parse_args()
+
+    run_db_build(args.rebuild, args.shard)
@@ -6,7 +6,8 @@ from dotenv import find_dotenv, load_dotenv
 import atexit
 import os
 import readline
-from src.utils import setup_dbqa
+from src.daemon import ask, connect, serve
+from src.tracing import Tracer, breakdown, span
 
 # Load environment variables from .env file
 load_dotenv(find_dotenv())
@@ -16,6 +17,40 @@ with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
     cfg = box.Box(yaml.safe_load(ymlfile))
 
 
+class DaemonPrinter:
+    """
+    Print tokens of answer from daemon, same attributes as TokenPrinter
+    """
+    def __init__(self):
+        self.start = timeit.default_timer()
+        self.first_token = None
+        self.tokens = 0
+
+    def __call__(self, token):
+        if self.first_token is None:
+            self.first_token = timeit.default_timer()
+        self.tokens += 1
+        print(token, end='', flush=True)
+
+    @property
+    def time_to_first_token(self):
+        return None if self.first_token is None else self.first_token - self.start
+
+
+def load_dbqa(profile_startup):
+    # imports of langchain and models are the slow part of a cold start
+    start = timeit.default_timer()
+    with span('imports'):
+        from src.utils import setup_dbqa, StartupProfile
+    profile = StartupProfile()
+    profile.add('imports', timeit.default_timer() - start)
+
+    dbqa = setup_dbqa(profile)
+    if profile_startup:
+        print(f'INFO: startup profile\n{profile}')
+    return dbqa
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('input',
@@ -23,11 +58,37 @@ if __name__ == "__main__":
                         type=str,
                         default='',
                         help='Enter the query to pass into the LLM')
+    parser.add_argument('--daemon',
+                        action='store_true',
+                        help='keep models loaded and answer queries of other runs on DAEMON_SOCKET')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='print seconds spent in each stage of startup')
     args = parser.parse_args()
 
-    # Setup DBQA
-    dbqa = setup_dbqa()
-    
+    # spans of every query, written to TRACE_PATH
+    tracer = Tracer(cfg.TRACE_PATH)
+
+    if args.daemon:
+        with tracer.trace('startup'):
+            dbqa = load_dbqa(args.profile)
+        from src.utils import start_reloader
+        start_reloader(dbqa)
+        serve(dbqa, cfg.DAEMON_SOCKET, tracer)
+        raise SystemExit
+
+    # one-shot query is answered by running daemon without loading models
+    daemon = connect(cfg.DAEMON_SOCKET) if args.input else None
+    if daemon is None:
+        # Setup DBQA
+        with tracer.trace('startup'):
+            dbqa = load_dbqa(args.profile)
+        from src.utils import TokenPrinter, build_trace_handler, start_reloader
+        trace_handler = build_trace_handler(dbqa)
+        if not args.input:
+            # new index snapshots of db_build.py are used by next query
+            start_reloader(dbqa)
+
     # query loop
     query = args.input
     if not query:
@@ -48,10 +109,32 @@ if __name__ == "__main__":
             query = input('\nEnter the query: ')
             continue
 
-        start = timeit.default_timer()
-        response = dbqa({'query': query})
+        print('='*50)
+        print(f'\nQuestion: {query}\n')
+        print('\nAnswer: ', end='', flush=True)
+
+        # answer is printed while generating
+        if daemon is not None:
+            printer = DaemonPrinter()
+            start = printer.start
+            response = ask(daemon, query, printer)
+            trace = response.get('trace')
+        else:
+            printer = TokenPrinter()
+            start = printer.start
+            context = getattr(dbqa.combine_documents_chain, 'stats', None)
+            queries = context.queries if context else 0
+            llm = dbqa.combine_documents_chain.llm_chain.llm
+            prefill = getattr(llm, 'prefill', None)
+            with tracer.trace('query', query=query) as trace:
+                response = dbqa({'query': query}, callbacks=[printer, trace_handler])
+            trace = trace.to_dict()
         end = timeit.default_timer()
-    
+        if not printer.tokens:
+            # cached, or search only
+            print(response['result'], end='')
+        print('\n')
+
         # Process source documents
         source_docs = response['source_documents'] if 'source_documents' in response else []
         for i, doc in enumerate(source_docs):
@@ -63,14 +146,27 @@ if __name__ == "__main__":
                 print(f'Document Name: {doc.metadata["source"]}')
             if 'page' in doc.metadata:
                 print(f'Page Number: {doc.metadata["page"]}\n')
-        
-        print('='*50)
-        print(f'\nQuestion: {query}\n')
-        print(f'\nAnswer: {response["result"]}\n')
+
         if cfg.TIMING:
             print('='*20)
+            if daemon is None and context and context.queries > queries:
+                report = context.last
+                print(f"Prompt tokens: {report['prompt_tokens']}, "
+                      f"context tokens: {report['context_tokens']} of {report['retrieved_tokens']} retrieved "
+                      f"in {report['kept_chunks']} of {report['chunks']} chunks")
+                if report['saved_seconds'] is not None:
+                    print(f"Prefill time saved (estimated): {report['saved_seconds']}")
+            if daemon is None and getattr(llm, 'prefill', None) is not prefill and llm.prefill['prompt_tokens']:
+                report = llm.prefill
+                print(f"Prompt tokens reused from last query: {report['reused_tokens']} of {report['prompt_tokens']}")
+                if report['saved_seconds'] is not None:
+                    print(f"Prefill time saved by reuse (estimated): {report['saved_seconds']}")
+            if printer.time_to_first_token is not None:
+                print(f"Time to first token: {printer.time_to_first_token}")
             print(f"Time to retrieve response: {end - start}")
-        
+            if trace is not None:
+                print(breakdown(trace))
+
         if args.input:
             break
         print('='* 80)
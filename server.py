@@ -0,0 +1,345 @@
+# =========================
+#  Module: HTTP query server
+# =========================
+import asyncio
+import timeit
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+import box
+import numpy as np
+import uvicorn
+import yaml
+from dotenv import find_dotenv, load_dotenv
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from langchain.callbacks.base import BaseCallbackHandler
+from pydantic import BaseModel
+from src.embeddings import embed_queries
+from src.idol import IDOL
+from src.llm import pool_size
+from src.query_cache import CachedRetrievalQA
+from src.tracing import Trace, Tracer, bind, span
+from src.utils import build_trace_handler, setup_dbqa, start_reloader
+
+# Load environment variables from .env file
+load_dotenv(find_dotenv())
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+
+class Query(BaseModel):
+    query: str
+
+
+class LatencyStats:
+    """ latency percentiles of recent requests per stage
+    """
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self.samples: Dict[str, deque] = {}
+        self.counts: Dict[str, int] = {}
+
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.samples.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+        self.counts[stage] = self.counts.get(stage, 0) + 1
+
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        result = {}
+        for stage, samples in self.samples.items():
+            p50, p95, p99 = np.percentile(np.fromiter(samples, dtype=float), [50, 95, 99])
+            result[stage] = {'count': self.counts[stage],
+                             'p50': p50, 'p95': p95, 'p99': p99}
+        return result
+
+
+class TokenQueue(BaseCallbackHandler):
+    """ pass tokens generated in LLM thread to event loop
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, token)
+
+
+class EmbeddingBatcher:
+    """ embed concurrent queries in one call
+
+    Queries arriving within `wait` seconds, up to `batch_size`, are embedded
+    together in the thread pool.
+    """
+
+    def __init__(self, embeddings: Any, executor: ThreadPoolExecutor,
+                 batch_size: int = 32, wait: float = 0.01):
+        self.embeddings = embeddings
+        self.executor = executor
+        self.batch_size = batch_size
+        self.wait = wait
+        self._pending: List[Any] = []
+        self._flusher = None
+
+
+    async def embed(self, query: str) -> List[float]:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((query, future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._flusher is None:
+            self._flusher = asyncio.get_running_loop().call_later(self.wait, self._flush)
+        return await future
+
+
+    def _flush(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+
+    async def _run(self, batch: List[Any]) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            vectors = await loop.run_in_executor(self.executor, embed_queries, self.embeddings,
+                                                 [query for query, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), vector in zip(batch, vectors):
+            future.set_result(vector)
+
+
+class QAService:
+    """ RetrievalQA split into stages which run concurrently
+
+    Query embeddings are micro-batched, retrieval runs in a thread pool and
+    at most `SERVER_LLM_CONCURRENCY` generations, or `LLM_WORKERS` of a model
+    in this process if more, run at a time with at most
+    `SERVER_LLM_QUEUE` waiting. Every query is traced.
+    """
+
+    def __init__(self, dbqa: Any):
+        self.cache = None
+        if isinstance(dbqa, CachedRetrievalQA):
+            self.cache = dbqa
+            dbqa = dbqa.chain
+        self.dbqa = dbqa
+        self.embeddings = self.cache.embeddings if self.cache else dbqa.retriever.vectorstore.embeddings
+        self.retrieval_pool = ThreadPoolExecutor(cfg.SERVER_RETRIEVAL_THREADS,
+                                                 thread_name_prefix='retrieval')
+        concurrency = max(cfg.SERVER_LLM_CONCURRENCY, pool_size())
+        self.llm_pool = ThreadPoolExecutor(concurrency, thread_name_prefix='llm')
+        self.batcher = EmbeddingBatcher(self.embeddings, self.retrieval_pool,
+                                        cfg.SERVER_BATCH_SIZE,
+                                        cfg.SERVER_BATCH_WAIT_MS / 1000)
+        self.llm_slots = asyncio.Semaphore(concurrency)
+        self.waiting = 0
+        self.generating = 0
+        self.latency = LatencyStats()
+        self.tracer = Tracer(cfg.TRACE_PATH)
+        self.trace_handler = build_trace_handler(dbqa)
+
+
+    async def _timed(self, stage: str, awaitable: Any, trace: Optional[Trace] = None) -> Any:
+        start = timeit.default_timer()
+        try:
+            return await awaitable
+        finally:
+            seconds = timeit.default_timer() - start
+            self.latency.add(stage, seconds)
+            if trace is not None:
+                trace.add(stage, start, seconds)
+
+
+    @staticmethod
+    def _traced(stage: str, fn: Callable, trace: Trace) -> Callable:
+        """ fn for thread pool, recording its spans under stage in trace
+        """
+        def run():
+            with span(stage) as attrs:
+                result = fn()
+                if isinstance(result, list):
+                    attrs['chunks'] = len(result)
+                return result
+        return bind(run, trace)
+
+
+    async def _retrieve(self, query: str, vector: List[float], trace: Trace) -> List[Any]:
+        loop = asyncio.get_running_loop()
+        # retriever is swapped when index is reloaded
+        retriever = self.dbqa.retriever
+        vectorstore = retriever.vectorstore
+        kwargs = retriever.search_kwargs
+        keyword = isinstance(vectorstore, IDOL) or getattr(vectorstore, 'search_type', 'VECTOR') != 'VECTOR'
+        if keyword or retriever.search_type == 'similarity_score_threshold':
+            # keyword search needs query text, query embedding is cached
+            search = lambda: retriever.get_relevant_documents(query)
+        elif retriever.search_type == 'mmr':
+            search = lambda: vectorstore.max_marginal_relevance_search_by_vector(vector, **kwargs)
+        else:
+            search = lambda: vectorstore.similarity_search_by_vector(vector, **kwargs)
+        return await loop.run_in_executor(self.retrieval_pool, self._traced('retrieve', search, trace))
+
+
+    def check_capacity(self) -> None:
+        if self.waiting >= cfg.SERVER_LLM_QUEUE:
+            raise HTTPException(status_code=503, detail='too many queries waiting for LLM')
+
+
+    async def _generate(self, query: str, docs: List[Any], trace: Trace,
+                        callbacks: List[Any] = None) -> str:
+        self.check_capacity()
+        self.waiting += 1
+        try:
+            await self._timed('llm_wait', self.llm_slots.acquire(), trace)
+        finally:
+            self.waiting -= 1
+        self.generating += 1
+        try:
+            loop = asyncio.get_running_loop()
+            chain = self.dbqa.combine_documents_chain
+            callbacks = (callbacks or []) + [self.trace_handler]
+            generate = bind(lambda: chain.run(input_documents=docs, question=query,
+                                              callbacks=callbacks), trace)
+            return await self._timed('llm', loop.run_in_executor(self.llm_pool, generate))
+        finally:
+            self.generating -= 1
+            self.llm_slots.release()
+
+
+    def _lookup(self, query: str, vector: List[float]) -> Dict[str, Any]:
+        if self.cache is None:
+            return None
+        self.cache._check_version()
+        response = self.cache.cache.lookup(query, vector)
+        if response is not None:
+            response['query'] = query
+            response['cached'] = True
+        return response
+
+
+    def _store(self, query: str, vector: List[float], docs: List[Any], result: str) -> Dict[str, Any]:
+        response = {'query': query, 'result': result}
+        if self.dbqa.return_source_documents:
+            response['source_documents'] = docs
+        if self.cache is not None:
+            self.cache.cache.store(query, response, vector)
+        return response
+
+
+    async def answer(self, query: str) -> Dict[str, Any]:
+        start = timeit.default_timer()
+        trace = Trace('query', query=query)
+        try:
+            vector = await self._timed('embed', self.batcher.embed(query), trace)
+            response = self._lookup(query, vector)
+            if response is None:
+                docs = await self._timed('retrieve', self._retrieve(query, vector, trace))
+                result = await self._generate(query, docs, trace)
+                response = self._store(query, vector, docs, result)
+        finally:
+            self.tracer.record(trace)
+        self.latency.add('total', timeit.default_timer() - start)
+        return response
+
+
+    async def stream(self, query: str) -> AsyncIterator[str]:
+        """ tokens of answer as they are generated
+        """
+        start = timeit.default_timer()
+        trace = Trace('query', query=query)
+        try:
+            vector = await self._timed('embed', self.batcher.embed(query), trace)
+            response = self._lookup(query, vector)
+            if response is not None:
+                self.latency.add('total', timeit.default_timer() - start)
+                yield response['result']
+                return
+
+            docs = await self._timed('retrieve', self._retrieve(query, vector, trace))
+            tokens = TokenQueue(asyncio.get_running_loop())
+            generation = asyncio.ensure_future(self._generate(query, docs, trace, [tokens]))
+            # end of stream, also on error
+            generation.add_done_callback(lambda _: tokens.queue.put_nowait(None))
+            first = True
+            while (token := await tokens.queue.get()) is not None:
+                if first:
+                    self.latency.add('first_token', timeit.default_timer() - start)
+                    first = False
+                yield token
+            self._store(query, vector, docs, await generation)
+            self.latency.add('total', timeit.default_timer() - start)
+        finally:
+            self.tracer.record(trace)
+
+
+    def metrics(self) -> Dict[str, Any]:
+        metrics = {'queue_depth': self.waiting,
+                   'generating': self.generating,
+                   'latency': self.latency.summary()}
+        stats = getattr(self.dbqa.combine_documents_chain, 'stats', None)
+        if stats is not None:
+            metrics['context'] = stats.summary()
+        return metrics
+
+
+service: QAService = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global service
+    # load models and index once for all requests
+    service = QAService(setup_dbqa())
+    # new index snapshots of db_build.py are loaded without restart
+    reloader = start_reloader(service.dbqa)
+    yield
+    if reloader is not None:
+        reloader.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.post('/query')
+async def query(q: Query) -> Dict[str, Any]:
+    response = await service.answer(q.query)
+    if 'source_documents' in response:
+        response['source_documents'] = [{'page_content': doc.page_content,
+                                         'metadata': doc.metadata}
+                                        for doc in response['source_documents']]
+    return response
+
+
+@app.post('/query/stream')
+async def query_stream(q: Query) -> StreamingResponse:
+    # reject before response starts
+    service.check_capacity()
+    return StreamingResponse(service.stream(q.query), media_type='text/plain; charset=utf-8')
+
+
+@app.get('/metrics')
+async def metrics() -> Dict[str, Any]:
+    return service.metrics()
+
+
+@app.get('/metrics/prometheus', response_class=PlainTextResponse)
+async def metrics_prometheus() -> str:
+    # stage latency histograms and token and chunk counters of traced queries
+    return service.tracer.prometheus()
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host=cfg.SERVER_HOST, port=cfg.SERVER_PORT)
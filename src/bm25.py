@@ -0,0 +1,128 @@
+# =========================
+#  Module: BM25 keyword index
+# =========================
+"""
+Inverted index of chunks for keyword search next to FAISS, kept in a few
+numpy arrays: postings sorted by term, with `offsets` to the postings of
+every term. Documents are numbered by their position in the FAISS index.
+"""
+import re
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+import numpy as np
+
+
+# Chinese, Japanese and Korean are written without spaces
+_CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af'
+# words, and part numbers like "AB-1234" or "v2.1" kept whole
+_TOKEN = re.compile(rf'(?P<cjk>[{_CJK}]+)|(?P<word>[^\W_{_CJK}]+(?:[-_./][^\W_{_CJK}]+)*)')
+_SEPARATORS = re.compile(r'[-_./]')
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lower case words, part numbers and also their parts, and bigrams of CJK
+    characters.
+    """
+    tokens = []
+    for match in _TOKEN.finditer(text.lower()):
+        if match.group('cjk'):
+            chars = match.group('cjk')
+            if len(chars) == 1:
+                tokens.append(chars)
+            tokens.extend(chars[i:i + 2] for i in range(len(chars) - 1))
+        else:
+            word = match.group('word')
+            tokens.append(word)
+            if _SEPARATORS.search(word):
+                tokens.extend(_SEPARATORS.split(word))
+    return tokens
+
+
+class BM25Index:
+    """ Okapi BM25 over an array backed inverted index
+    """
+
+    def __init__(self, terms: List[str], offsets: np.ndarray, docs: np.ndarray,
+                 tfs: np.ndarray, doc_len: np.ndarray, k1: float = 1.2, b: float = 0.75):
+        self.vocab: Dict[str, int] = {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.docs = docs
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.k1 = k1
+        self.b = b
+        self.count = len(doc_len)
+        # per document part of BM25 length normalization
+        avg_len = float(doc_len.mean()) if self.count else 1.0
+        self.norm = (k1 * (1 - b + b * doc_len / (avg_len or 1.0))).astype(np.float32)
+
+
+    @classmethod
+    def build(cls, texts: Iterable[str], k1: float = 1.2, b: float = 0.75) -> 'BM25Index':
+        """
+        Index texts, numbered by their order.
+        """
+        vocab: Dict[str, int] = {}
+        term_ids, docs, tfs, doc_len = array('i'), array('i'), array('H'), array('i')
+        for doc, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_len.append(sum(counts.values()))
+            for term, tf in counts.items():
+                term_ids.append(vocab.setdefault(term, len(vocab)))
+                docs.append(doc)
+                tfs.append(min(tf, 0xffff))
+
+        term_ids = np.frombuffer(term_ids, dtype=np.int32)
+        # stable, so postings of a term stay sorted by document
+        order = np.argsort(term_ids, kind='stable')
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(vocab)), out=offsets[1:])
+        return cls(list(vocab), offsets,
+                   np.frombuffer(docs, dtype=np.int32)[order],
+                   np.frombuffer(tfs, dtype=np.uint16)[order],
+                   np.frombuffer(doc_len, dtype=np.int32).copy(), k1, b)
+
+
+    def save(self, path: str) -> None:
+        terms = '\n'.join(self.vocab).encode('utf-8')
+        with open(path, 'wb') as f:
+            np.savez(f, terms=np.frombuffer(terms, dtype=np.uint8), offsets=self.offsets,
+                     docs=self.docs, tfs=self.tfs, doc_len=self.doc_len)
+
+
+    @classmethod
+    def load(cls, path: str, k1: float = 1.2, b: float = 0.75) -> 'BM25Index':
+        with np.load(path) as data:
+            terms = data['terms'].tobytes().decode('utf-8')
+            return cls(terms.split('\n') if terms else [], data['offsets'], data['docs'],
+                       data['tfs'], data['doc_len'], k1, b)
+
+
+    def search(self, query: str, k: int = 4) -> List[Tuple[int, float]]:
+        """
+        Returns
+        -------
+        List[Tuple[int, float]]
+            numbers of at most k documents matching any term of query, and
+            their BM25 scores, highest first.
+
+        """
+        scores = np.zeros(self.count, dtype=np.float32)
+        for term in set(tokenize(query)):
+            t = self.vocab.get(term)
+            if t is None:
+                continue
+            start, end = self.offsets[t], self.offsets[t + 1]
+            docs = self.docs[start:end]
+            tfs = self.tfs[start:end].astype(np.float32)
+            idf = np.log(1 + (self.count - len(docs) + 0.5) / (len(docs) + 0.5))
+            # a term occurs once in postings of a document
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + self.norm[docs])
+
+        hits = np.flatnonzero(scores)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        hits = hits[np.argsort(-scores[hits], kind='stable')]
+        return [(int(doc), float(scores[doc])) for doc in hits]
@@ -2,16 +2,90 @@
 #  Module: ChartGLM model
 # =========================
 import box
+import sys
+import timeit
+import torch
 import yaml
 from langchain.callbacks.manager import CallbackManagerForLLMRun
 from langchain.llms.base import LLM
-from typing import Any, Dict, List, Mapping, Optional
-from transformers import AutoTokenizer, AutoModel
+from langchain.schema.output import GenerationChunk
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple
+from transformers import AutoTokenizer, AutoModel, LogitsProcessorList
+from src.prefix_cache import FirstTokenTimer, common_prefix, prefill_report, reuse_or_fallback
 
 # Import config vars
 with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
     cfg = box.Box(yaml.safe_load(ymlfile))
 
+# dtype of weights at loading, by load mode, None for the default of transformers
+LOAD_DTYPES = {'fp32': None, 'bf16': torch.bfloat16, 'int8': None, 'native': 'auto'}
+
+
+def peak_rss_mb() -> Optional[float]:
+    """ peak resident memory of this process, None where unknown
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB elsewhere
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def load_model(path: str, mode: str = 'fp32', low_cpu_mem_usage: bool = False) -> Tuple[Any, Dict[str, Any]]:
+    """
+    Load ChatGLM model of transformers.
+
+    Parameters
+    ----------
+    path : str
+        name of the model in repo or directory.
+    mode : str
+        'fp32' casts all weights to float32, 'bf16' to bfloat16, 'int8'
+        quantizes weights of linear layers to int8 dynamically after
+        loading in float32, and 'native' keeps dtypes of the checkpoint,
+        e.g. int4 weights and float16 of chatglm2-6b-int4.
+    low_cpu_mem_usage : bool
+        load weights into the model without creating it with random ones
+        first, needs accelerate.
+
+    Returns
+    -------
+    Tuple[Any, Dict[str, Any]]
+        model, and load report with mode, seconds and peak RSS.
+
+    """
+    if mode not in LOAD_DTYPES:
+        raise ValueError(f'unknown load mode {mode}, one of {", ".join(LOAD_DTYPES)}')
+    if mode == 'int8' and cfg.DEVICE != 'cpu':
+        raise ValueError('load mode int8 quantizes for CPU only, use bf16 or native on GPU')
+    kwargs = {}
+    if LOAD_DTYPES[mode] is not None:
+        kwargs['torch_dtype'] = LOAD_DTYPES[mode]
+    if low_cpu_mem_usage:
+        kwargs['low_cpu_mem_usage'] = True
+    start = timeit.default_timer()
+    model = AutoModel.from_pretrained(path,
+                                      trust_remote_code=True,
+                                      device=cfg.DEVICE,
+                                      **kwargs)
+    if mode == 'fp32':
+        # parameters of quantized layers the checkpoint keeps in float16 too
+        model = model.float()
+    elif mode == 'bf16':
+        model = model.bfloat16()
+    elif mode == 'int8':
+        # in place, a copy would hold the float32 weights twice
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8,
+                                                       inplace=True)
+    report = {'mode': mode,
+              'seconds': timeit.default_timer() - start,
+              'peak_rss_mb': peak_rss_mb()}
+    print(f'INFO: loaded {path} as {mode} in {report["seconds"]:.1f}s'
+          + (f', peak RSS {report["peak_rss_mb"]:.0f} MB' if report['peak_rss_mb'] else ''))
+    return model.eval(), report
+
 
 class ChatGLM(LLM):
     """ models for THUDM/chatglm-6b or THUDM/chatglm2-6b
@@ -19,9 +93,16 @@ class ChatGLM(LLM):
     
     chatglm_model: Any  #: :meta private:
     chatglm_tokenizer: Any  #: :meta private:
+    prefix_cache: Any = None  #: :meta private:
         
     model: str = None
     config: Optional[Dict[str, Any]] = None
+    prefix: Optional[str] = None
+    threads: int = 0
+    load_mode: str = 'fp32'
+    low_cpu_mem_usage: bool = False
+    prefill: Optional[Dict[str, Any]] = None
+    load: Optional[Dict[str, Any]] = None
        
     def __init__(self, **kwargs: Any) -> LLM:
         """
@@ -29,6 +110,16 @@ class ChatGLM(LLM):
         ----------
         model : str
             The name of the model file in repo or directory.
+        prefix : Optional[str]
+            beginning shared by all prompts, its past key values are computed
+            once and reused by every generation, generating with
+            stream_generate instead of stream_chat.
+        threads : int
+            torch threads of generations, 0 for the default.
+        load_mode : str
+            'fp32', 'bf16', 'int8' or 'native', see `load_model`.
+        low_cpu_mem_usage : bool
+            load weights without initializing the model first.
 
         Returns
         -------
@@ -38,10 +129,7 @@ class ChatGLM(LLM):
         """
         super().__init__(**kwargs)
         
-        self.chatglm_model = AutoModel.from_pretrained(self.model,
-                                                       trust_remote_code=True,
-                                                       device=cfg.DEVICE).float()
-        self.chatglm_model = self.chatglm_model.eval()
+        self.chatglm_model, self.load = load_model(self.model, self.load_mode, self.low_cpu_mem_usage)
         self.chatglm_tokenizer = AutoTokenizer.from_pretrained(self.model, 
                                                                trust_remote_code=True,
                                                                device=cfg.DEVICE)
@@ -59,10 +147,124 @@ class ChatGLM(LLM):
         run_manager: Optional[CallbackManagerForLLMRun] = None,
         **kwargs: Any,
     ) -> str:
-        response, history = self.chatglm_model.chat(self.chatglm_tokenizer, 
-                                                    prompt, 
-                                                    **self.config)
-        return response
+        text = []
+        for chunk in self._stream(prompt, stop, run_manager, **kwargs):
+            text.append(chunk.text)
+        return ''.join(text)
+
+
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[GenerationChunk]:
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        input_ids = self._chat_input_ids(prompt) if self.prefix else None
+        cache = self._prefix_cache(input_ids) if input_ids else None
+        timer = FirstTokenTimer()
+        if cache is None:
+            responses = self._stream_chat(prompt)
+        else:
+            responses = reuse_or_fallback(self._stream_after_prefix(input_ids, *cache),
+                                          lambda: self._stream_chat_without_prefix(prompt), 'chatglm')
+
+        offset = 0
+        for response in responses:
+            token = response[offset:]
+            offset = len(response)
+            if not token:
+                continue
+            if timer.seconds is None:
+                timer.token()
+                self.prefill = prefill_report(len(input_ids or []),
+                                              len(cache[0]) if cache and self.prefix_cache else 0,
+                                              timer.seconds)
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+            yield GenerationChunk(text=token)
+
+
+    def _stream_chat(self, prompt: str) -> Iterator[str]:
+        # stream_chat yields whole response so far
+        for response, history in self.chatglm_model.stream_chat(self.chatglm_tokenizer, prompt,
+                                                                 **self.config):
+            yield response
+
+
+    def _stream_chat_without_prefix(self, prompt: str) -> Iterator[str]:
+        self.prefix_cache = False
+        return self._stream_chat(prompt)
+
+
+    def _chat_input_ids(self, query: str) -> Optional[List[int]]:
+        """ token ids of query in chat format as stream_chat builds them,
+        None for models without chat format of ChatGLM2 or ChatGLM3
+        """
+        tokenizer = self.chatglm_tokenizer
+        if hasattr(tokenizer, 'build_chat_input'):
+            # ChatGLM3
+            return tokenizer.build_chat_input(query, history=[], role='user')['input_ids'][0].tolist()
+        if hasattr(tokenizer, 'build_prompt'):
+            # ChatGLM2
+            return tokenizer([tokenizer.build_prompt(query, history=[])])['input_ids'][0]
+        return None
+
+
+    def _prefix_cache(self, input_ids: List[int]) -> Optional[Tuple[List[int], Any]]:
+        """ ids of prefix and their past key values, if prompt starts with them
+        """
+        if self.prefix_cache is None:
+            # tokens of prefix in chat format, but not those closing query
+            prefix_ids = input_ids[:common_prefix(self._chat_input_ids(self.prefix), input_ids,
+                                                  len(input_ids) - 1)]
+            with torch.no_grad():
+                outputs = self.chatglm_model(input_ids=torch.tensor([prefix_ids],
+                                                                    device=self.chatglm_model.device),
+                                             use_cache=True, return_dict=True)
+            # cache objects of newer transformers are extended in place
+            past = outputs.past_key_values
+            self.prefix_cache = (prefix_ids, past) if isinstance(past, tuple) and prefix_ids else False
+        if not self.prefix_cache:
+            return None
+        prefix_ids, past = self.prefix_cache
+        return self.prefix_cache if input_ids[:len(prefix_ids)] == prefix_ids else None
+
+
+    def _stream_after_prefix(self, input_ids: List[int], prefix_ids: List[int], past: Any) -> Iterator[str]:
+        """ stream_chat, but evaluating only tokens after prefix
+        """
+        model = self.chatglm_model
+        tokenizer = self.chatglm_tokenizer
+        n = len(prefix_ids)
+        config = dict(self.config or {})
+        # max_length of stream_generate counts only tokens after prefix
+        config['max_length'] = max(1, config.get('max_length', 8192) - n)
+        # defaults of stream_chat
+        config.setdefault('do_sample', True)
+        config.setdefault('top_p', 0.8)
+        # same logits processor and end of response as stream_chat
+        processor = getattr(sys.modules[type(model).__module__], 'InvalidScoreLogitsProcessor', None)
+        if processor is not None:
+            config['logits_processor'] = LogitsProcessorList([processor()])
+        eos_token_id = [tokenizer.eos_token_id]
+        if hasattr(tokenizer, 'get_command'):
+            eos_token_id += [tokenizer.get_command('<|user|>'), tokenizer.get_command('<|observation|>')]
+
+        rest = torch.tensor([input_ids[n:]], device=model.device)
+        for outputs in model.stream_generate(rest,
+                                             past_key_values=past,
+                                             position_ids=torch.arange(n, len(input_ids), device=model.device)[None, :],
+                                             attention_mask=torch.ones(1, len(input_ids), dtype=torch.long,
+                                                                       device=model.device),
+                                             eos_token_id=eos_token_id,
+                                             **config):
+            response = tokenizer.decode(outputs[0][rest.shape[1]:].tolist())
+            # wait for rest of multi-byte character
+            if response and response[-1] != '\ufffd':
+                yield response.strip()
 
 
     @property
@@ -3,8 +3,13 @@
 # =========================
 from langchain.callbacks.manager import CallbackManagerForLLMRun
 from langchain.llms.base import LLM
-from typing import Any, Dict, List, Mapping, Optional
+from langchain.schema.output import GenerationChunk
+from typing import Any, Dict, Iterator, List, Mapping, Optional
 import chatglm_cpp
+from src.prefix_cache import FirstTokenTimer, common_prefix, prefill_report, reuse_or_fallback
+
+# versions whose Pipeline.generate loop `_generate_reusing_prefix` follows
+REUSE_VERSIONS = ('0.2.',)
 
 
 class ChatGLMCPP(LLM):
@@ -12,9 +17,12 @@ class ChatGLMCPP(LLM):
     """
     
     chatglm_model: Any  #: :meta private:
+    past_ids: List[int] = []  #: :meta private:
         
     model: str = None
     config: Optional[Dict[str, Any]] = None
+    reuse_prefix: bool = False
+    prefill: Optional[Dict[str, Any]] = None
        
     def __init__(self, **kwargs: Any) -> LLM:
         """
@@ -22,6 +30,10 @@ class ChatGLMCPP(LLM):
         ----------
         model : str
             The name of the model file in repo or directory.
+        reuse_prefix : bool
+            evaluate only prompt tokens after those shared with last
+            generation, which are still in KV cache of model, with a
+            generation loop of its own instead of Pipeline.generate.
 
         Returns
         -------
@@ -46,8 +58,107 @@ class ChatGLMCPP(LLM):
         run_manager: Optional[CallbackManagerForLLMRun] = None,
         **kwargs: Any,
     ) -> str:
-        response = self.chatglm_model.generate(prompt, **self.config)
-        return response
+        text = []
+        for chunk in self._stream(prompt, stop, run_manager, **kwargs):
+            text.append(chunk.text)
+        return ''.join(text)
+
+
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[GenerationChunk]:
+        if self._can_reuse():
+            tokens = reuse_or_fallback(self._generate_reusing_prefix(prompt),
+                                       lambda: self._generate_without_reuse(prompt), 'chatglm_cpp')
+        else:
+            tokens = self._generate(prompt)
+        for token in tokens:
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+            yield GenerationChunk(text=token)
+
+
+    def _generate(self, prompt: str) -> Iterator[str]:
+        """ Pipeline.generate, evaluating the whole prompt
+        """
+        timer = FirstTokenTimer()
+        for token in self.chatglm_model.generate(prompt, stream=True, **self.config):
+            timer.token()
+            yield token
+        self.prefill = prefill_report(0, 0, timer.seconds)
+
+
+    def _generate_without_reuse(self, prompt: str) -> Iterator[str]:
+        self.reuse_prefix = False
+        # Pipeline.generate overwrites KV cache
+        self.past_ids = []
+        return self._generate(prompt)
+
+
+    def _can_reuse(self) -> bool:
+        if not self.reuse_prefix:
+            return False
+        if not chatglm_cpp.__version__.startswith(REUSE_VERSIONS) or \
+                not hasattr(getattr(chatglm_cpp, '_C', None), 'GenerationConfig'):
+            print(f'ERROR: prompt prefix isn\'t reused with chatglm_cpp {chatglm_cpp.__version__}, '
+                  f'only with versions {REUSE_VERSIONS}')
+            self.reuse_prefix = False
+            return False
+        model = self.chatglm_model.model
+        # first ChatGLM model encodes positions relative to end of prompt
+        return hasattr(model, 'generate_next_token') and model.config.model_type_name != 'ChatGLM'
+
+
+    def _generate_reusing_prefix(self, prompt: str) -> Iterator[str]:
+        """ Pipeline.generate, but starting with KV cache of last generation
+        """
+        config = dict(self.config or {})
+        config.pop('stream', None)
+        gen_config = chatglm_cpp._C.GenerationConfig(**config)
+        pipeline = self.chatglm_model
+        input_ids = list(pipeline.tokenizer.encode(prompt, gen_config.max_context_length))
+        n_ctx = len(input_ids)
+        # at least last token of prompt is evaluated to get logits
+        n_past = common_prefix(self.past_ids, input_ids, n_ctx - 1)
+        # ChatGLM3 ends responses with <|user|> or <|observation|> as well
+        eos_token_ids = {pipeline.model.config.eos_token_id,
+                         *getattr(pipeline.model.config, 'extra_eos_token_ids', [])}
+        timer = FirstTokenTimer()
+
+        token_cache = []
+        print_len = 0
+        while len(input_ids) < gen_config.max_length:
+            # KV cache is only valid up to n_past while model runs
+            self.past_ids = input_ids[:n_past]
+            next_token_id = pipeline.model.generate_next_token(input_ids, gen_config, n_past, n_ctx)
+            self.past_ids = list(input_ids)
+            if timer.seconds is None:
+                timer.token()
+                self.prefill = prefill_report(n_ctx, n_past, timer.seconds)
+            n_past = len(input_ids)
+            input_ids.append(next_token_id)
+
+            # same streaming of text as Pipeline
+            token_cache.append(next_token_id)
+            output = pipeline.tokenizer.decode(token_cache)
+            if output.endswith('\n'):
+                yield output[print_len:]
+                token_cache = []
+                print_len = 0
+            elif not output.endswith((',', '!', ':', ';', '?', '\ufffd')):
+                yield output[print_len:]
+                print_len = len(output)
+
+            if next_token_id in eos_token_ids:
+                break
+
+        output = pipeline.tokenizer.decode(token_cache)
+        if output[print_len:]:
+            yield output[print_len:]
 
 
     @property
@@ -0,0 +1,182 @@
+# =========================
+#  Module: Memory-mapped chunk store
+# =========================
+"""
+Text and metadata of chunks of a FAISS index, in the order of its vectors,
+read from a memory-mapped file instead of a pickled docstore.
+
+Files in the index folder:
+
+    chunks.bin          blocks of records, each record is a JSON object
+                        {"id": docstore id, "text": ..., "metadata": {...}},
+                        blocks are optionally compressed by zlib
+    chunks.blocks.npy   offset of every block in chunks.bin, and end of file
+    chunks.records.npy  block, start and end of every record in its block,
+                        row i is the chunk of vector i
+    chunks.json         compression and number of chunks
+
+Loading maps the files without reading them, and a search builds only the
+`Document` of every hit. Compressed blocks are decompressed on use and the
+last ones kept in a small cache.
+"""
+import json
+import mmap
+import os
+import zlib
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Iterator, Mapping, Tuple
+import numpy as np
+from langchain.docstore.base import Docstore
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+
+CHUNKS_FILE = 'chunks.bin'
+BLOCKS_FILE = 'chunks.blocks.npy'
+RECORDS_FILE = 'chunks.records.npy'
+SETTINGS_FILE = 'chunks.json'
+
+
+def write_chunks(path: str, chunks: Iterable[Tuple[str, Document]], compression: str = '',
+                 block_size: int = 65536) -> int:
+    """
+    Write chunks of vectors in order into folder path, replacing a previous
+    chunk store atomically file by file.
+
+    Parameters
+    ----------
+    path : str
+        folder of index.
+    chunks : Iterable[Tuple[str, Document]]
+        docstore id and document of every vector.
+    compression : str
+        '' for none, or 'zlib'.
+    block_size : int
+        bytes of records per block, the unit of compression.
+
+    Returns
+    -------
+    int
+        number of chunks written.
+
+    """
+    blocks, records = [0], []
+    block, offset = bytearray(), 0
+    tmp = os.path.join(path, f'{CHUNKS_FILE}.tmp')
+
+    def flush(f):
+        nonlocal block, offset
+        data = zlib.compress(bytes(block)) if compression == 'zlib' else bytes(block)
+        f.write(data)
+        offset += len(data)
+        blocks.append(offset)
+        block = bytearray()
+
+    with open(tmp, 'wb') as f:
+        for ref, doc in chunks:
+            record = json.dumps({'id': ref, 'text': doc.page_content, 'metadata': doc.metadata},
+                                ensure_ascii=False, default=str).encode('utf-8')
+            records.append((len(blocks) - 1, len(block), len(block) + len(record)))
+            block += record
+            if len(block) >= block_size:
+                flush(f)
+        if block:
+            flush(f)
+
+    for name, array in ((BLOCKS_FILE, np.array(blocks, dtype=np.int64)),
+                        (RECORDS_FILE, np.array(records, dtype=np.int64).reshape(-1, 3))):
+        with open(os.path.join(path, f'{name}.tmp'), 'wb') as f:
+            np.save(f, array)
+    with open(os.path.join(path, f'{SETTINGS_FILE}.tmp'), 'w', encoding='utf8') as f:
+        json.dump({'compression': compression, 'count': len(records)}, f)
+    for name in (BLOCKS_FILE, RECORDS_FILE, CHUNKS_FILE, SETTINGS_FILE):
+        os.replace(os.path.join(path, f'{name}.tmp'), os.path.join(path, name))
+    return len(records)
+
+
+class Positions(Mapping):
+    """ index_to_docstore_id of a chunk store, ids are positions of vectors
+    """
+
+    def __init__(self, count: int):
+        self.count = count
+
+
+    def __getitem__(self, i: int) -> int:
+        if not 0 <= i < self.count:
+            raise KeyError(i)
+        return int(i)
+
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(self.count))
+
+
+    def __len__(self) -> int:
+        return self.count
+
+
+class ChunkStore(Docstore):
+    """ read only docstore of chunks written by `write_chunks`, searched by
+    position of vector
+    """
+
+    def __init__(self, path: str, cached_blocks: int = 64):
+        with open(os.path.join(path, SETTINGS_FILE), 'r', encoding='utf8') as f:
+            self.compression = json.load(f).get('compression', '')
+        self.blocks = np.load(os.path.join(path, BLOCKS_FILE), mmap_mode='r')
+        self.records = np.load(os.path.join(path, RECORDS_FILE), mmap_mode='r')
+        with open(os.path.join(path, CHUNKS_FILE), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self._block = lru_cache(maxsize=cached_blocks)(self._read_block)
+
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+
+    def _read_block(self, block: int) -> bytes:
+        return zlib.decompress(self._data[self.blocks[block]:self.blocks[block + 1]])
+
+
+    def record(self, i: int) -> Dict[str, Any]:
+        block, start, end = (int(x) for x in self.records[i])
+        if self.compression == 'zlib':
+            data = self._block(block)[start:end]
+        else:
+            offset = int(self.blocks[block])
+            data = self._data[offset + start:offset + end]
+        return json.loads(data)
+
+
+    def search(self, search: Any) -> Any:
+        """ document of vector at position search
+        """
+        try:
+            i = int(search)
+        except (TypeError, ValueError):
+            i = -1
+        if not 0 <= i < len(self):
+            return f'ID {search} not found.'
+        record = self.record(i)
+        return Document(page_content=record['text'], metadata=record['metadata'])
+
+
+    def positions(self) -> Positions:
+        return Positions(len(self))
+
+
+    def materialize(self) -> Tuple[InMemoryDocstore, Dict[int, str]]:
+        """ in-memory docstore with docstore ids, to add or delete vectors
+        """
+        documents, ids = {}, {}
+        for i in range(len(self)):
+            record = self.record(i)
+            documents[record['id']] = Document(page_content=record['text'], metadata=record['metadata'])
+            ids[i] = record['id']
+        return InMemoryDocstore(documents), ids
+
+
+    def close(self) -> None:
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
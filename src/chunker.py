@@ -0,0 +1,91 @@
+# =========================
+#  Module: Offset based text splitter
+# =========================
+"""
+Chunks of `CharacterTextSplitter(separator, is_separator_regex=True,
+keep_separator=True)`, computed from offsets of separators instead of
+splitting text into a string per separator and merging them back.
+
+Every separator match starts a piece which runs to the next match. The
+langchain splitter packs consecutive pieces into a chunk while they fit in
+`chunk_size`, then keeps the last pieces of at most `chunk_overlap`
+characters for the next chunk. Since pieces are contiguous, a chunk is
+text between two piece boundaries, found by bisecting the boundaries.
+"""
+import re
+from bisect import bisect_left, bisect_right
+from typing import Any, List, Optional, Tuple
+from langchain.docstore.document import Document
+from langchain.text_splitter import TextSplitter
+
+
+class RegexTextSplitter(TextSplitter):
+    """ same chunks as CharacterTextSplitter with a regex separator kept in
+    chunks, with their character offset in `start_index` of metadata
+    """
+
+    def __init__(self, separator: str, is_separator_regex: bool = True, **kwargs: Any) -> None:
+        kwargs.pop('keep_separator', None)
+        super().__init__(keep_separator=True, **kwargs)
+        self._pattern = re.compile(separator if is_separator_regex else re.escape(separator))
+
+
+    def boundaries(self, text: str) -> List[int]:
+        """ start of every piece, and end of text
+        """
+        bounds = [0]
+        for m in self._pattern.finditer(text):
+            if m.start() > bounds[-1]:
+                bounds.append(m.start())
+        if len(text) > bounds[-1]:
+            bounds.append(len(text))
+        return bounds
+
+
+    def spans(self, text: str) -> List[Tuple[int, int]]:
+        """ (start, end) of chunks in text, before whitespace is stripped
+        """
+        bounds = self.boundaries(text)
+        last = len(bounds) - 1
+        if last < 1:
+            return []
+        size, overlap = self._chunk_size, self._chunk_overlap
+        spans = []
+        start = 0
+        while True:
+            # pieces which fit, at least one
+            end = max(bisect_right(bounds, bounds[start] + size) - 1, start + 1)
+            spans.append((bounds[start], bounds[end]))
+            if end == last:
+                return spans
+            # pieces kept for overlap: at most `overlap` characters, leaving
+            # room for the piece which didn't fit
+            start = max(start,
+                        bisect_left(bounds, bounds[end] - overlap),
+                        min(bisect_left(bounds, bounds[end + 1] - size), end))
+
+
+    def _strip(self, text: str, start: int, end: int) -> Optional[Tuple[str, int]]:
+        chunk = text[start:end]
+        if self._strip_whitespace:
+            stripped = chunk.lstrip()
+            start += len(chunk) - len(stripped)
+            chunk = stripped.rstrip()
+        return (chunk, start) if chunk else None
+
+
+    def split_text(self, text: str) -> List[str]:
+        chunks = (self._strip(text, start, end) for start, end in self.spans(text))
+        return [chunk for chunk, _ in filter(None, chunks)]
+
+
+    def create_documents(self, texts: List[str], metadatas: Optional[List[dict]] = None) -> List[Document]:
+        metadatas = metadatas or [{}] * len(texts)
+        documents = []
+        for text, metadata in zip(texts, metadatas):
+            for start, end in self.spans(text):
+                chunk = self._strip(text, start, end)
+                if chunk is not None:
+                    documents.append(Document(page_content=chunk[0],
+                                              metadata=dict(metadata, start_index=chunk[1])))
+        return documents
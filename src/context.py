@@ -0,0 +1,247 @@
+# =========================
+#  Module: Context budget
+# =========================
+"""
+Assemble retrieved chunks into the prompt: drop duplicates, overlaps and
+near duplicates, order by similarity to the question and trim to a token
+budget. Prefill time of an LLM on CPU grows with prompt tokens, so every
+token left out is time saved before the first token of the answer.
+"""
+import hashlib
+import re
+import threading
+import timeit
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import numpy as np
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.chains.combine_documents.stuff import StuffDocumentsChain
+from langchain.docstore.document import Document
+from src.tracing import span
+
+
+_SPACES = re.compile(r'\s+')
+_CJK = re.compile('[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]')
+
+
+def estimate_tokens(text: str) -> int:
+    """ about 4 characters per token, but a token per CJK character
+    """
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def token_counter(llm: Any) -> Callable[[str], int]:
+    """
+    Count tokens with tokenizer of LLM if it's loaded locally, estimate
+    otherwise, e.g. for models served by ollama.
+    """
+    # LLMPool, workers are instances of one model
+    workers = getattr(llm, 'workers', None)
+    if workers:
+        llm = workers[0]
+    # CTransformers
+    client = getattr(llm, 'client', None)
+    if hasattr(client, 'tokenize'):
+        return lambda text: len(client.tokenize(text))
+    # ChatGLM
+    tokenizer = getattr(llm, 'chatglm_tokenizer', None)
+    if hasattr(tokenizer, 'encode'):
+        return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+    # ChatGLMCPP
+    tokenizer = getattr(getattr(llm, 'chatglm_model', None), 'tokenizer', None)
+    if hasattr(tokenizer, 'encode'):
+        return lambda text: len(tokenizer.encode(text))
+    return estimate_tokens
+
+
+def strip_overlap(previous: str, text: str, max_overlap: int, min_overlap: int = 20) -> str:
+    """ text without its beginning repeated at the end of previous chunk
+    """
+    for n in range(min(len(previous), len(text), max_overlap), min_overlap - 1, -1):
+        if previous.endswith(text[:n]):
+            return text[n:].lstrip()
+    return text
+
+
+class PrefillTimer(BaseCallbackHandler):
+    """ time from start of LLM to its first token
+    """
+
+    def __init__(self):
+        self.start = None
+        self.seconds = None
+
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> None:
+        self.start = timeit.default_timer()
+
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if self.seconds is None and self.start is not None:
+            self.seconds = timeit.default_timer() - self.start
+
+
+class ContextStats:
+    """ tokens of prompts, and prefill time measured and saved
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.retrieved_tokens = 0
+        self.context_tokens = 0
+        self.prompt_tokens = 0
+        self.prefill_seconds = 0.0
+        self.prefill_tokens = 0
+        self.last: Dict[str, Any] = None
+
+
+    @property
+    def seconds_per_token(self) -> Optional[float]:
+        return self.prefill_seconds / self.prefill_tokens if self.prefill_tokens else None
+
+
+    def add(self, report: Dict[str, Any], prefill: Optional[float]) -> None:
+        with self.lock:
+            self.queries += 1
+            self.retrieved_tokens += report['retrieved_tokens']
+            self.context_tokens += report['context_tokens']
+            self.prompt_tokens += report['prompt_tokens']
+            if prefill is not None:
+                self.prefill_seconds += prefill
+                self.prefill_tokens += report['prompt_tokens']
+            saved = report['retrieved_tokens'] - report['context_tokens']
+            self.last = dict(report, prefill_seconds=prefill,
+                             saved_seconds=saved * self.seconds_per_token if self.seconds_per_token else None)
+
+
+    def summary(self) -> Dict[str, Any]:
+        saved = self.retrieved_tokens - self.context_tokens
+        return {'queries': self.queries,
+                'retrieved_tokens': self.retrieved_tokens,
+                'context_tokens': self.context_tokens,
+                'prompt_tokens': self.prompt_tokens,
+                'prefill_seconds_per_token': self.seconds_per_token,
+                'prefill_seconds_saved': saved * self.seconds_per_token if self.seconds_per_token else None}
+
+
+class ContextStuffDocumentsChain(StuffDocumentsChain):
+    """ 'stuff' chain which assembles chunks within a token budget first
+
+    Chunks are embedded again to score and compare them, `CachedEmbeddings`
+    answers that from cache for chunks embedded by db_build.py.
+    """
+
+    embeddings: Any = None
+    count_tokens: Any = None
+    max_tokens: int = 0
+    min_tokens: int = 32
+    dedup_similarity: float = 1.0
+    max_overlap: int = 0
+    stats: Any = None
+
+
+    def _count(self, text: str) -> int:
+        return (self.count_tokens or estimate_tokens)(text)
+
+
+    def assemble(self, docs: List[Document], question: str) -> Tuple[List[Document], Dict[str, Any]]:
+        """
+        Returns
+        -------
+        Tuple[List[Document], Dict[str, Any]]
+            chunks for prompt, most similar to question first, and report of
+            chunks and tokens retrieved and kept.
+
+        """
+        report = {'chunks': len(docs),
+                  'retrieved_tokens': sum(self._count(doc.page_content) for doc in docs)}
+
+        # exact duplicates
+        unique: Dict[str, Document] = {}
+        for doc in docs:
+            key = hashlib.sha1(_SPACES.sub(' ', doc.page_content).strip().encode('utf-8')).digest()
+            unique.setdefault(key, doc)
+        docs = list(unique.values())
+
+        # order by similarity to question, skip near duplicates of better chunks
+        if self.embeddings is not None and len(docs) > 1:
+            with span('embed', texts=len(docs) + 1):
+                vectors = np.array(self.embeddings.embed_documents([doc.page_content for doc in docs]),
+                                   dtype=np.float32)
+                query = np.array(self.embeddings.embed_query(question), dtype=np.float32)
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+            query /= np.linalg.norm(query) + 1e-12
+            kept: List[int] = []
+            for i in np.argsort(-(vectors @ query), kind='stable'):
+                if kept and self.dedup_similarity < 1 \
+                        and (vectors[kept] @ vectors[i]).max() >= self.dedup_similarity:
+                    continue
+                kept.append(int(i))
+            docs = [docs[i] for i in kept]
+
+        # text shared by neighbor chunks of a document
+        if self.max_overlap:
+            for i, doc in enumerate(docs):
+                text = doc.page_content
+                for other in docs[:i]:
+                    if other.metadata.get('source') == doc.metadata.get('source'):
+                        # other chunk is before or after this one
+                        text = strip_overlap(other.page_content, text, self.max_overlap)
+                        text = strip_overlap(other.page_content[::-1], text[::-1],
+                                             self.max_overlap)[::-1]
+                if text != doc.page_content:
+                    docs[i] = Document(page_content=text, metadata=doc.metadata)
+            docs = [doc for doc in docs if doc.page_content]
+
+        docs = self._trim(docs)
+        report['kept_chunks'] = len(docs)
+        report['context_tokens'] = sum(self._count(doc.page_content) for doc in docs)
+        return docs, report
+
+
+    def _trim(self, docs: List[Document]) -> List[Document]:
+        if not self.max_tokens:
+            return docs
+        result, used = [], 0
+        for doc in docs:
+            tokens = self._count(doc.page_content)
+            if used + tokens <= self.max_tokens:
+                result.append(doc)
+                used += tokens
+                continue
+            left = self.max_tokens - used
+            if left >= self.min_tokens:
+                # cut best chunk which doesn't fit, at a space if there's one near
+                text = doc.page_content
+                end = len(text) * left // tokens
+                while end > 0 and self._count(text[:end]) > left:
+                    end = end * 9 // 10
+                space = text.rfind(' ', 0, end)
+                end = space if space > end * 4 // 5 else end
+                if end > 0:
+                    result.append(Document(page_content=text[:end], metadata=doc.metadata))
+            break
+        return result
+
+
+    def combine_docs(self, docs: List[Document], callbacks: Any = None,
+                     **kwargs: Any) -> Tuple[str, dict]:
+        with span('context') as attrs:
+            docs, report = self.assemble(docs, kwargs.get('question', ''))
+            inputs = self._get_inputs(docs, **kwargs)
+            report['prompt_tokens'] = self._count(self.llm_chain.prompt.format(**inputs))
+            attrs.update(report)
+
+        timer = PrefillTimer()
+        if callbacks is None:
+            callbacks = [timer]
+        elif isinstance(callbacks, list):
+            callbacks = callbacks + [timer]
+        else:
+            # callback manager of parent chain
+            callbacks.add_handler(timer)
+        result = self.llm_chain.predict(callbacks=callbacks, **inputs)
+        if self.stats is not None:
+            self.stats.add(report, timer.seconds)
+        return result, {}
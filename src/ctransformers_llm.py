@@ -0,0 +1,41 @@
+# =========================
+#  Module: model running by ctransformers
+# =========================
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.llms import CTransformers
+from typing import Any, Dict, List, Optional
+from src.prefix_cache import FirstTokenTimer, common_prefix, prefill_report
+
+
+class PrefixCTransformers(CTransformers):
+    """ CTransformers which reports prompt tokens reused from last generation
+
+    ctransformers keeps tokens evaluated by the last generation in its
+    session and only evaluates tokens of the next prompt after those they
+    have in common, as long as the model isn't reset.
+    """
+
+    prefill: Optional[Dict[str, Any]] = None
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        # ctransformers before 0.2.27 doesn't keep context
+        past = getattr(self.client, '_context', None)
+        tokens = self.client.tokenize(prompt)
+        # at least last token of prompt is evaluated to get logits
+        reused = common_prefix(past, tokens, len(tokens) - 1) if past is not None else 0
+
+        timer = FirstTokenTimer()
+        text = []
+        for chunk in self.client(prompt, stop=stop, stream=True):
+            timer.token()
+            text.append(chunk)
+            if run_manager:
+                run_manager.on_llm_new_token(chunk, verbose=self.verbose)
+        self.prefill = prefill_report(len(tokens), reused, timer.seconds)
+        return ''.join(text)
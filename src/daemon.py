@@ -0,0 +1,144 @@
+# =========================
+#  Module: Resident query daemon
+# =========================
+"""
+Keep embeddings, index and LLM loaded in one process listening on a local
+socket, so one-shot `python main.py "<query>"` runs skip loading them.
+
+Requests and responses are JSON lines: the client sends `{"query": ...}`,
+the daemon answers with `{"token": ...}` lines while generating and one
+final line with the response and its trace, or with `{"error": ...}`.
+
+This module is imported by every run of main.py, keep it free of heavy
+imports.
+"""
+import json
+import os
+import socket
+import socketserver
+import threading
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Optional
+from src.tracing import Tracer
+
+
+def _send(wfile: Any, message: Dict[str, Any]) -> None:
+    wfile.write((json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8'))
+    wfile.flush()
+
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    """ answer one query per connection, as many at a time as the LLM has
+    workers
+    """
+
+    dbqa: Any = None
+    token_writer: Any = None
+    tracer: Tracer = None
+    trace_handler: Any = None
+    slots = threading.Semaphore(1)
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            with self.slots, self.tracer.trace('query', query=request['query']) as trace:
+                response = self.dbqa({'query': request['query']},
+                                     callbacks=[self.token_writer(self.wfile), self.trace_handler])
+        except Exception as e:
+            _send(self.wfile, {'error': f'{type(e).__name__}: {e}'})
+            return
+        _send(self.wfile, {
+            'result': response['result'],
+            'cached': response.get('cached', False),
+            'trace': trace.to_dict(),
+            'source_documents': [{'page_content': doc.page_content, 'metadata': doc.metadata}
+                                 for doc in response.get('source_documents', [])]})
+
+
+def serve(dbqa: Any, path: str, tracer: Optional[Tracer] = None) -> None:
+    """
+    Answer queries on unix socket `path` until interrupted.
+
+    Parameters
+    ----------
+    dbqa : Any
+        chain built by `setup_dbqa`.
+    path : str
+        path of unix socket, replaced if it exists.
+    tracer : Optional[Tracer]
+        records traces of queries.
+
+    """
+    from src.llm import pool_size
+    from src.utils import TokenWriter, build_trace_handler
+
+    if os.path.exists(path):
+        os.unlink(path)
+    handler = type('Handler', (QueryHandler,), {'dbqa': dbqa, 'token_writer': TokenWriter,
+                                                'tracer': tracer or Tracer(),
+                                                'trace_handler': build_trace_handler(dbqa),
+                                                'slots': threading.Semaphore(pool_size())})
+    server = socketserver.ThreadingUnixStreamServer(path, handler)
+    # queries and answers are private to the user
+    os.chmod(path, 0o600)
+    print(f'INFO: daemon listening on {path}, models are loaded')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def connect(path: str) -> Optional[socket.socket]:
+    """
+    Connect to daemon listening on unix socket `path`, None if no daemon is
+    running.
+    """
+    if not path or not hasattr(socket, 'AF_UNIX'):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    return sock
+
+
+def ask(sock: socket.socket, query: str, on_token: Callable[[str], None]) -> Dict[str, Any]:
+    """
+    Send query to daemon connected by `connect`, the connection is closed
+    afterwards.
+
+    Parameters
+    ----------
+    sock : socket.socket
+        connection to daemon.
+    query : str
+        user query.
+    on_token : Callable[[str], None]
+        called with every token of answer while it is generated.
+
+    Returns
+    -------
+    Dict[str, Any]
+        response like RetrievalQA's, with source documents and trace.
+
+    """
+    with sock, sock.makefile('rwb') as stream:
+        _send(stream, {'query': query})
+        for line in stream:
+            message = json.loads(line)
+            if 'token' in message:
+                on_token(message['token'])
+            elif 'error' in message:
+                raise RuntimeError(f'daemon failed to answer: {message["error"]}')
+            else:
+                message['query'] = query
+                # same attributes as langchain Document
+                message['source_documents'] = [SimpleNamespace(**doc)
+                                               for doc in message['source_documents']]
+                return message
+    raise RuntimeError('daemon closed connection without answer')
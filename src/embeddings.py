@@ -0,0 +1,268 @@
+# =========================
+#  Module: Embeddings with on-disk cache
+# =========================
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional
+import box
+import numpy as np
+import yaml
+from langchain.embeddings import HuggingFaceEmbeddings
+from langchain.schema.embeddings import Embeddings
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+
+_SPACES = re.compile(r'\s+')
+
+
+def cache_key(model: str, text: str) -> str:
+    """ key of a text embedded by model, insensitive to unicode form and spacing
+    """
+    text = _SPACES.sub(' ', unicodedata.normalize('NFKC', text)).strip()
+    return hashlib.sha1(f'{model}\0{text}'.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """ vectors in a memory-mapped float32 file, rows of keys in sqlite
+
+    Rows of evicted vectors are reused and growth is capped at `max_bytes`,
+    so `vectors.f32` only grows beyond it by the rows of one `put` above it.
+    """
+
+    GROW_ROWS = 4096
+
+    def __init__(self, path: str, max_bytes: int = 1 << 30):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(path, 'index.sqlite'),
+                                   timeout=60, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER);
+            CREATE TABLE IF NOT EXISTS vectors (key TEXT PRIMARY KEY, row INTEGER, used REAL);
+            CREATE INDEX IF NOT EXISTS vectors_used ON vectors (used);
+            CREATE TABLE IF NOT EXISTS free (row INTEGER PRIMARY KEY);
+        """)
+        self._file = os.path.join(path, 'vectors.f32')
+        self._vectors: Optional[np.memmap] = None
+        self.dim = self._meta('dim')
+
+
+    def _meta(self, name: str) -> Optional[int]:
+        row = self._db.execute('SELECT value FROM meta WHERE name=?', (name,)).fetchone()
+        return row[0] if row else None
+
+
+    def _map(self, rows: int) -> np.ndarray:
+        """ memory map with at least `rows` rows, the file may have been grown by others
+        """
+        if self._vectors is None or len(self._vectors) < rows:
+            size = os.path.getsize(self._file) if os.path.exists(self._file) else 0
+            capacity = size // (4 * self.dim)
+            if capacity < rows:
+                limit = self.max_bytes // (4 * self.dim)
+                capacity = max(rows, min(max(2 * capacity, self.GROW_ROWS), limit))
+                with open(self._file, 'ab') as f:
+                    f.truncate(capacity * 4 * self.dim)
+            self._vectors = np.memmap(self._file, dtype=np.float32, mode='r+',
+                                      shape=(capacity, self.dim))
+        return self._vectors
+
+
+    def get(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """ cached vectors of keys, misses are left out
+        """
+        if self.dim is None or not keys:
+            return {}
+        with self._lock:
+            found = {}
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                found.update(self._db.execute(
+                    f'SELECT key, row FROM vectors WHERE key IN ({",".join("?" * len(part))})',
+                    part).fetchall())
+            if not found:
+                return {}
+            vectors = self._map(max(found.values()) + 1)
+            now = time.time()
+            self._db.executemany('UPDATE vectors SET used=? WHERE key=?',
+                                 [(now, key) for key in found])
+            return {key: np.array(vectors[row]) for key, row in found.items()}
+
+
+    def put(self, keys: List[str], vectors: List[List[float]]) -> None:
+        if not keys:
+            return
+        with self._lock:
+            if self.dim is None:
+                self.dim = len(vectors[0])
+                self._db.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)', ('dim', self.dim))
+            now = time.time()
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                rows = []
+                for key in keys:
+                    free = self._db.execute('SELECT row FROM free LIMIT 1').fetchone()
+                    if free:
+                        self._db.execute('DELETE FROM free WHERE row=?', free)
+                        row = free[0]
+                    else:
+                        last = self._meta('last_row')
+                        row = 0 if last is None else last + 1
+                        self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                         ('last_row', row))
+                    rows.append(row)
+                    old = self._db.execute('SELECT row FROM vectors WHERE key=?', (key,)).fetchone()
+                    if old:
+                        self._db.execute('INSERT OR IGNORE INTO free VALUES (?)', old)
+                    self._db.execute('INSERT OR REPLACE INTO vectors VALUES (?, ?, ?)',
+                                     (key, row, now))
+                mapped = self._map(max(rows) + 1)
+                mapped[rows] = np.asarray(vectors, dtype=np.float32)
+                mapped.flush()
+                self._evict()
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+
+
+    def _evict(self) -> None:
+        """ drop least recently used vectors above size limit
+        """
+        limit = self.max_bytes // (4 * self.dim)
+        count = self._db.execute('SELECT COUNT(*) FROM vectors').fetchone()[0]
+        if count <= limit:
+            return
+        # evict down to 90% to amortize eviction
+        victims = self._db.execute('SELECT key, row FROM vectors ORDER BY used LIMIT ?',
+                                   (count - int(limit * 0.9),)).fetchall()
+        self._db.executemany('DELETE FROM vectors WHERE key=?', [(k,) for k, _ in victims])
+        self._db.executemany('INSERT OR IGNORE INTO free VALUES (?)', [(r,) for _, r in victims])
+
+
+class CachedEmbeddings(Embeddings):
+    """ embeddings looked up in `EmbeddingCache` before running the model
+
+    Queries are kept in memory, the last `query_entries` of them, so a query
+    writes nothing to disk and one-off queries don't evict vectors of chunks.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, model: str,
+                 query_entries: int = 1024):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model
+        self.query_entries = query_entries
+        self._queries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [cache_key(self.model, text) for text in texts]
+        found = self.cache.get(keys)
+
+        # embed each missing text once
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            self.cache.put(list(missing), vectors)
+            found.update(zip(missing, vectors))
+
+        return [np.asarray(found[key], dtype=np.float32).tolist() for key in keys]
+
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """ vectors of queries, least recently used ones are dropped from memory
+        """
+        keys = [cache_key(self.model, text) for text in texts]
+        with self._lock:
+            found = {key: self._queries[key] for key in keys if key in self._queries}
+            for key in found:
+                self._queries.move_to_end(key)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if missing:
+            # sentence transformers embed queries as documents
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            found.update((key, np.asarray(vector, dtype=np.float32).tolist())
+                         for key, vector in zip(missing, vectors))
+            with self._lock:
+                for key in missing:
+                    self._queries[key] = found[key]
+                    self._queries.move_to_end(key)
+                while len(self._queries) > self.query_entries:
+                    self._queries.popitem(last=False)
+
+        return [list(found[key]) for key in keys]
+
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_queries([text])[0]
+
+
+def embed_queries(embeddings: Embeddings, texts: List[str]) -> List[List[float]]:
+    """ vectors of queries, cached in memory only by `CachedEmbeddings`
+    """
+    if isinstance(embeddings, CachedEmbeddings):
+        return embeddings.embed_queries(texts)
+    return embeddings.embed_documents(texts)
+
+
+def embeddings_id(embeddings: Embeddings) -> str:
+    """ model and engine of vectors of embeddings, vectors of torch keep the
+    model name, onnx ones are int8 only if the quantized model was kept
+    """
+    if isinstance(embeddings, CachedEmbeddings):
+        return embeddings.model
+    if cfg.EMBEDDINGS_ENGINE == 'onnx':
+        return f'{cfg.EMBEDDINGS_MODEL}:onnx{"-int8" if getattr(embeddings, "quantized", False) else ""}'
+    return cfg.EMBEDDINGS_MODEL
+
+
+def build_model() -> Embeddings:
+    """ embedding model of EMBEDDINGS_ENGINE
+    """
+    if cfg.EMBEDDINGS_ENGINE == 'onnx':
+        from src.onnx_embeddings import load_onnx_embeddings
+        return load_onnx_embeddings(cfg.EMBEDDINGS_MODEL, cfg.EMBEDDINGS_ONNX_PATH,
+                                    quantize=cfg.EMBEDDINGS_QUANTIZE,
+                                    batch_size=cfg.EMBEDDINGS_BATCH_SIZE,
+                                    threads=cfg.EMBEDDINGS_THREADS,
+                                    min_cosine=cfg.EMBEDDINGS_MIN_COSINE)
+    if cfg.EMBEDDINGS_THREADS:
+        import torch
+        torch.set_num_threads(cfg.EMBEDDINGS_THREADS)
+    # sentence transformers sorts texts by length itself
+    return HuggingFaceEmbeddings(model_name=cfg.EMBEDDINGS_MODEL,
+                                 model_kwargs={'device': cfg.DEVICE},
+                                 encode_kwargs={'batch_size': cfg.EMBEDDINGS_BATCH_SIZE})
+
+
+def build_embeddings() -> Embeddings:
+    embeddings = build_model()
+    if not cfg.EMBEDDING_CACHE_PATH:
+        return embeddings
+
+    cache = EmbeddingCache(cfg.EMBEDDING_CACHE_PATH,
+                           max_bytes=cfg.EMBEDDING_CACHE_MAX_MB * 1024 * 1024)
+    return CachedEmbeddings(embeddings, cache, embeddings_id(embeddings),
+                            query_entries=cfg.EMBEDDING_CACHE_QUERIES)
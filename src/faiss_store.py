@@ -0,0 +1,480 @@
+# =========================
+#  Module: FAISS index types
+# =========================
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import box
+import faiss
+import numpy as np
+import yaml
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.schema.embeddings import Embeddings
+from langchain.vectorstores import FAISS
+from langchain.vectorstores.utils import maximal_marginal_relevance
+from src.bm25 import BM25Index
+from src.chunk_store import CHUNKS_FILE, ChunkStore, write_chunks
+from src.tracing import bind, span
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+
+def factory_string(index_type: str = 'Flat', nlist: int = 1024, pq_m: int = 48,
+                   hnsw_m: int = 32, sq: Optional[str] = None) -> str:
+    """
+    Parameters
+    ----------
+    index_type : str
+        Flat, IVFFlat, IVFPQ or HNSW.
+    nlist : int
+        number of inverted lists of IVF.
+    pq_m : int
+        number of sub-quantizers of PQ, must divide dimension.
+    hnsw_m : int
+        number of neighbors of HNSW.
+    sq : Optional[str]
+        scalar quantizer for Flat, IVFFlat and HNSW, e.g. SQ8 or SQfp16.
+
+    Returns
+    -------
+    str
+        description for faiss.index_factory.
+
+    """
+    if index_type == 'IVFFlat':
+        return f'IVF{nlist},{sq or "Flat"}'
+    if index_type == 'IVFPQ':
+        return f'IVF{nlist},PQ{pq_m}'
+    if index_type == 'HNSW':
+        return f'HNSW{hnsw_m},{sq}' if sq else f'HNSW{hnsw_m}'
+    return sq or 'Flat'
+
+
+def config_factory_string() -> str:
+    return factory_string(cfg.FAISS_INDEX_TYPE, cfg.FAISS_NLIST, cfg.FAISS_PQ_M,
+                          cfg.FAISS_HNSW_M, cfg.FAISS_SQ)
+
+
+def needs_training(description: str) -> bool:
+    return description.startswith('IVF') or 'SQ' in description
+
+
+def min_train_size(index: faiss.Index) -> int:
+    """ fewest vectors faiss can train index with
+    """
+    size = 1
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        size = ivf.nlist
+    if isinstance(index, faiss.IndexIVFPQ):
+        size = max(size, 1 << index.pq.nbits)
+    return size
+
+
+def tune_index(index: faiss.Index, nprobe: int = None, ef_search: int = None) -> None:
+    """ set search time parameters, ignored by index types without them
+    """
+    nprobe = nprobe or cfg.FAISS_NPROBE
+    ef_search = ef_search or cfg.FAISS_EF_SEARCH
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and nprobe:
+        ivf.nprobe = nprobe
+    if isinstance(index, faiss.IndexHNSW) and ef_search:
+        index.hnsw.efSearch = ef_search
+
+
+def supports_remove(index: faiss.Index) -> bool:
+    """ HNSW graphs can't remove vectors, and IVF keeps ids of the others
+    while langchain renumbers them as Flat does
+    """
+    return isinstance(index, faiss.IndexFlatCodes)
+
+
+def create_store(
+    embeddings: Embeddings,
+    texts: List[str],
+    vectors: List[List[float]],
+    metadatas: List[Dict],
+    ids: List[str],
+    description: Optional[str] = None,
+) -> FAISS:
+    """
+    Create FAISS vector store of configured index type, vectors given are
+    the training sample too.
+
+    Returns
+    -------
+    FAISS
+        vector store with texts added.
+
+    """
+    description = description or config_factory_string()
+    matrix = np.asarray(vectors, dtype=np.float32)
+    # same metric as FAISS.from_embeddings
+    index = faiss.index_factory(matrix.shape[1], description, faiss.METRIC_L2)
+    if not index.is_trained:
+        if len(matrix) < min_train_size(index):
+            print(f'INFO: {len(matrix)} vectors are too few to train {description}, use Flat')
+            index = faiss.IndexFlatL2(matrix.shape[1])
+        else:
+            index.train(matrix)
+    tune_index(index)
+
+    store = FAISS(embeddings, index, InMemoryDocstore(), {})
+    store.add_embeddings(zip(texts, vectors), metadatas, ids=ids)
+    return store
+
+
+class HybridFAISS(FAISS):
+    """ FAISS searched together with a BM25 keyword index
+
+    With search type KEYWORD_VECTOR or VECTOR_KEYWORD, keyword and vector
+    search run in parallel and their results are fused by reciprocal rank,
+    ties go to the search named first. Scores are fused ranks from 0 to 1,
+    higher is more relevant. VECTOR is plain FAISS, KEYWORD is BM25 only.
+    """
+
+    def __init__(self, *args: Any, keyword_index: Optional[BM25Index] = None,
+                 search_type: str = 'KEYWORD_VECTOR', fetch_k: int = 20,
+                 rrf_k: int = 60, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.keyword_index = keyword_index
+        self.search_type = search_type if keyword_index is not None else 'VECTOR'
+        self.fetch_k = fetch_k
+        self.rrf_k = rrf_k
+        self._executor = ThreadPoolExecutor(thread_name_prefix='vector-search')
+
+
+    def _embed_query(self, text: str) -> List[float]:
+        with span('embed'):
+            return super()._embed_query(text)
+
+
+    def _vector_search(self, embedding: List[float], k: int) -> List[int]:
+        vector = np.array([embedding], dtype=np.float32)
+        if self._normalize_L2:
+            faiss.normalize_L2(vector)
+        with span('vector_search', k=k):
+            _, positions = self.index.search(vector, k)
+        return [int(i) for i in positions[0] if i >= 0]
+
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4,
+                                               **kwargs: Any) -> List[Tuple[Document, float]]:
+        with span('vector_search', k=k):
+            return super().similarity_search_with_score_by_vector(embedding, k, **kwargs)
+
+
+    def _keyword_search(self, query: str, k: int) -> List[int]:
+        return [i for i, _ in self._keyword_hits(query, k)]
+
+
+    def _keyword_hits(self, query: str, k: int) -> List[Tuple[int, float]]:
+        with span('keyword_search', k=k):
+            return self.keyword_index.search(query, k)
+
+
+    def _embed_and_search(self, query: str, k: int) -> Tuple[List[float], List[int]]:
+        embedding = self._embed_query(query)
+        return embedding, self._vector_search(embedding, k)
+
+
+    def _fused(self, query: str, k: int) -> Tuple[List[Tuple[int, float]], Optional[List[float]]]:
+        """
+        Returns
+        -------
+        Tuple[List[Tuple[int, float]], Optional[List[float]]]
+            positions of at most k documents with fused scores, highest first,
+            and query embedding if vector search ran.
+
+        """
+        embedding, vector = None, None
+        if 'VECTOR' in self.search_type:
+            vector = self._executor.submit(bind(self._embed_and_search), query, k)
+        rankings = {'KEYWORD': self._keyword_search(query, k)}
+        if vector is not None:
+            embedding, rankings['VECTOR'] = vector.result()
+
+        return self._fuse(rankings, k), embedding
+
+
+    def _fuse(self, rankings: Dict[str, List[int]], k: int) -> List[Tuple[int, float]]:
+        return fuse(rankings, k, self.search_type, self.rrf_k)
+
+
+    def batch_hits(self, queries: List[Optional[str]], embeddings: Optional[List[List[float]]],
+                   k: int) -> List[Dict[str, List[Tuple[int, float]]]]:
+        """
+        Candidates of every search of search type with their scores, to be
+        merged with candidates of other indexes.
+
+        Parameters
+        ----------
+        queries : List[Optional[str]]
+            texts of queries, None for no keyword search.
+        embeddings : Optional[List[List[float]]]
+            embeddings of queries, None for no vector search.
+        k : int
+            candidates per search.
+
+        Returns
+        -------
+        List[Dict[str, List[Tuple[int, float]]]]
+            per query, positions with L2 distance under VECTOR, lower is
+            better, and with BM25 score under KEYWORD, higher is better.
+
+        """
+        hits = [{} for _ in queries]
+        if 'VECTOR' in self.search_type and embeddings is not None and queries:
+            matrix = np.array(embeddings, dtype=np.float32)
+            if self._normalize_L2:
+                faiss.normalize_L2(matrix)
+            with span('vector_search', k=k):
+                distances, rows = self.index.search(matrix, k)
+            for h, row, distance in zip(hits, rows, distances):
+                h['VECTOR'] = [(int(i), float(d)) for i, d in zip(row, distance) if i >= 0]
+        if 'KEYWORD' in self.search_type:
+            for h, query in zip(hits, queries):
+                if query is not None:
+                    h['KEYWORD'] = self._keyword_hits(query, k)
+        return hits
+
+
+    def batch_search(self, queries: List[str], embeddings: List[List[float]],
+                     k: int = 4) -> List[List[Document]]:
+        """
+        Search many queries at once, vector search of all of them is one
+        search of FAISS index.
+
+        Parameters
+        ----------
+        queries : List[str]
+            texts of queries, for keyword search.
+        embeddings : List[List[float]]
+            embeddings of queries.
+        k : int
+            number of documents per query.
+
+        Returns
+        -------
+        List[List[Document]]
+            documents of every query, same as similarity_search.
+
+        """
+        fetch_k = k if self.search_type == 'VECTOR' else max(k, self.fetch_k)
+        rows = [[] for _ in queries]
+        if 'VECTOR' in self.search_type and queries:
+            matrix = np.array(embeddings, dtype=np.float32)
+            if self._normalize_L2:
+                faiss.normalize_L2(matrix)
+            _, rows = self.index.search(matrix, fetch_k)
+
+        results = []
+        for query, row in zip(queries, rows):
+            positions = [int(i) for i in row if i >= 0]
+            if self.search_type == 'VECTOR':
+                fused = [(i, 0.0) for i in positions]
+            else:
+                rankings = {'KEYWORD': self._keyword_search(query, fetch_k)}
+                if 'VECTOR' in self.search_type:
+                    rankings['VECTOR'] = positions
+                fused = self._fuse(rankings, k)
+            results.append([doc for doc, _, _ in self._documents(fused)])
+        return results
+
+
+    def _documents(self, positions: List[Tuple[int, float]],
+                   filter: Optional[Dict[str, Any]] = None) -> List[Tuple[Document, float, int]]:
+        result = []
+        for i, score in positions:
+            doc = self.docstore.search(self.index_to_docstore_id[i])
+            if not isinstance(doc, Document):
+                raise ValueError(f'Could not find document for id {self.index_to_docstore_id[i]}, got {doc}')
+            if filter and any(doc.metadata.get(key) != value for key, value in filter.items()):
+                continue
+            result.append((doc, score, i))
+        return result
+
+
+    def similarity_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        filter: Optional[Dict[str, Any]] = None,
+        fetch_k: int = 20,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        if self.search_type == 'VECTOR':
+            return super().similarity_search_with_score(query, k, filter=filter,
+                                                        fetch_k=fetch_k, **kwargs)
+        positions, _ = self._fused(query, max(k, self.fetch_k))
+        return [(doc, score) for doc, score, _ in self._documents(positions, filter)[:k]]
+
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        if self.search_type == 'VECTOR':
+            return super()._select_relevance_score_fn()
+        # fused scores are already from 0 to 1
+        return lambda score: score
+
+
+    def max_marginal_relevance_search(
+        self,
+        query: str,
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        if self.search_type == 'VECTOR':
+            return super().max_marginal_relevance_search(query, k, fetch_k, lambda_mult,
+                                                         filter=filter, **kwargs)
+        positions, embedding = self._fused(query, fetch_k)
+        hits = self._documents(positions, filter)
+        if not hits:
+            return []
+        if embedding is None:
+            embedding = self._embed_query(query)
+        selected = maximal_marginal_relevance(np.array(embedding, dtype=np.float32),
+                                              self._reconstruct([i for _, _, i in hits]),
+                                              k=min(k, len(hits)), lambda_mult=lambda_mult)
+        return [hits[i][0] for i in selected]
+
+
+    def _reconstruct(self, positions: List[int]) -> np.ndarray:
+        try:
+            return np.vstack([self.index.reconstruct(i) for i in positions])
+        except RuntimeError:
+            # IVF indexes need a map from ids to inverted lists to reconstruct
+            faiss.extract_index_ivf(self.index).make_direct_map()
+            return np.vstack([self.index.reconstruct(i) for i in positions])
+
+
+def fuse(rankings: Dict[str, List[Any]], k: int, search_type: str,
+         rrf_k: int = 60) -> List[Tuple[Any, float]]:
+    """
+    Fuse rankings of searches by reciprocal rank.
+
+    Parameters
+    ----------
+    rankings : Dict[str, List[Any]]
+        ids of documents, best first, by search: KEYWORD or VECTOR.
+    k : int
+        number of documents.
+    search_type : str
+        KEYWORD_VECTOR or VECTOR_KEYWORD, search named first wins ties.
+    rrf_k : int
+        smoothing of ranks, 1 / (rrf_k + rank).
+
+    Returns
+    -------
+    List[Tuple[Any, float]]
+        ids of at most k documents with fused scores from 0 to 1, highest
+        first.
+
+    """
+    scores: Dict[Any, float] = {}
+    # search named first wins ties, sort is stable
+    for name in sorted(rankings, key=search_type.index):
+        for rank, i in enumerate(rankings[name]):
+            scores[i] = scores.get(i, 0.0) + 1 / (rrf_k + rank + 1)
+    best = len(rankings) / (rrf_k + 1)
+    fused = sorted(scores.items(), key=lambda item: -item[1])[:k]
+    return [(i, score / best) for i, score in fused]
+
+
+def build_keyword_index(store: FAISS) -> BM25Index:
+    """ BM25 index of all chunks in FAISS store, numbered by position in FAISS index
+    """
+    texts = (store.docstore.search(store.index_to_docstore_id[i]).page_content
+             for i in range(store.index.ntotal))
+    return BM25Index.build(texts, cfg.BM25_K1, cfg.BM25_B)
+
+
+def save_keyword_index(store: FAISS, path: str) -> None:
+    """
+    Build BM25 index of all chunks in FAISS store, numbered by position in
+    FAISS index, into folder `path`.
+    """
+    build_keyword_index(store).save(os.path.join(path, 'bm25.npz'))
+
+
+def save_store(store: FAISS, path: str) -> None:
+    """
+    Save FAISS index, its chunks in a chunk store and BM25 index of them
+    into folder `path`.
+    """
+    os.makedirs(path, exist_ok=True)
+    faiss.write_index(store.index, os.path.join(path, 'index.faiss'))
+    ids = (store.index_to_docstore_id[i] for i in range(store.index.ntotal))
+    write_chunks(path, ((ref, store.docstore.search(ref)) for ref in ids),
+                 compression=cfg.CHUNK_STORE_COMPRESSION,
+                 block_size=cfg.CHUNK_STORE_BLOCK_KB * 1024)
+    # pickled docstore of FAISS.save_local, replaced by chunk store
+    if os.path.exists(os.path.join(path, 'index.pkl')):
+        os.remove(os.path.join(path, 'index.pkl'))
+    # numbered by position in FAISS index, so built again from all chunks
+    save_keyword_index(store, path)
+
+
+def load_store(path: str, embeddings: Embeddings, mmap: bool = False,
+               search_type: str = 'VECTOR', writable: bool = False) -> HybridFAISS:
+    """
+    Load FAISS vector store saved by `save_store`, or by `FAISS.save_local`.
+
+    Parameters
+    ----------
+    path : str
+        folder of index.
+    embeddings : Embeddings
+        to embed queries.
+    mmap : bool
+        memory map inverted lists of IVF indexes instead of reading them,
+        the index is read only then.
+    search_type : str
+        VECTOR, KEYWORD, KEYWORD_VECTOR or VECTOR_KEYWORD, keyword index saved
+        by `save_keyword_index` is loaded for all but VECTOR.
+    writable : bool
+        read chunks into memory with their docstore ids, to add or delete
+        vectors. Otherwise chunks stay in the memory-mapped chunk store and
+        only those found are read.
+
+    Returns
+    -------
+    HybridFAISS
+        vector store tuned with FAISS_NPROBE and FAISS_EF_SEARCH.
+
+    """
+    index = faiss.read_index(os.path.join(path, 'index.faiss'),
+                             faiss.IO_FLAG_MMAP if mmap else 0)
+    tune_index(index)
+    if os.path.exists(os.path.join(path, CHUNKS_FILE)):
+        chunks = ChunkStore(path)
+        if len(chunks) != index.ntotal:
+            raise ValueError(f'chunk store of {len(chunks)} chunks doesn\'t match {index.ntotal} '
+                             f'vectors in {path}, run db_build.py --rebuild')
+        docstore, index_to_docstore_id = chunks.materialize() if writable \
+            else (chunks, chunks.positions())
+    else:
+        with open(os.path.join(path, 'index.pkl'), 'rb') as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+
+    keyword_index = None
+    keyword_path = os.path.join(path, 'bm25.npz')
+    if search_type != 'VECTOR':
+        if not os.path.exists(keyword_path):
+            print(f'INFO: no keyword index in {path}, run db_build.py for {search_type} search')
+        else:
+            keyword_index = BM25Index.load(keyword_path, cfg.BM25_K1, cfg.BM25_B)
+            if keyword_index.count != index.ntotal:
+                print(f'ERROR: keyword index of {keyword_index.count} chunks doesn\'t match '
+                      f'{index.ntotal} vectors, run db_build.py --rebuild')
+                keyword_index = None
+    return HybridFAISS(embeddings, index, docstore, index_to_docstore_id,
+                       keyword_index=keyword_index, search_type=search_type,
+                       fetch_k=cfg.HYBRID_FETCH_K, rrf_k=cfg.HYBRID_RRF_K)
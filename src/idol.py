@@ -1,13 +1,77 @@
 from __future__ import annotations
 
-from typing import Any, Dict, Iterable, List, Optional, Tuple
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
+import io
 import requests
 import json
+import numpy as np
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote
 
 from langchain.schema.document import Document
 from langchain.schema.embeddings import Embeddings
 from langchain.schema.vectorstore import VectorStore
+from langchain.vectorstores.utils import maximal_marginal_relevance
+from src.tracing import span
+
+
+def format_vectors(vectors: Any, precision: Optional[int] = None) -> List[str]:
+    """Format vectors as comma separated text, a row at a time by numpy.
+
+    Args:
+        vectors: vector, or list of vectors.
+        precision: significant digits, None for lossless float32 (9 digits).
+
+    Returns:
+        Text of each vector.
+    """
+    matrix = np.asarray(vectors, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix[None, :]
+    buffer = io.StringIO()
+    np.savetxt(buffer, matrix, fmt=f'%.{precision or 9}g', delimiter=',')
+    return buffer.getvalue().splitlines()
+
+
+class IndexReport:
+    """What was sent to IDOL Content by DREADDDATA.
+    """
+
+    def __init__(self):
+        self.batches = 0
+        self.documents = 0
+        self.bytes = 0
+        self.failed_batches = 0
+        self.failed_documents = 0
+        # references of documents in failed batches
+        self.failed_refs: List[str] = []
+        self.retries = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+
+    def add(self, documents: int, size: int, ok: bool, seconds: float,
+            refs: Optional[List[str]] = None) -> None:
+        with self._lock:
+            self.batches += 1
+            self.documents += documents
+            self.bytes += size
+            self.seconds += seconds
+            if not ok:
+                self.failed_batches += 1
+                self.failed_documents += documents
+                self.failed_refs.extend(refs or [])
+
+
+    def __str__(self) -> str:
+        return (f'{self.documents - self.failed_documents} documents indexed in '
+                f'{self.batches} batches ({self.bytes / 1024 / 1024:.1f} MB), '
+                f'{self.failed_documents} documents in {self.failed_batches} batches failed, '
+                f'{self.retries} retries, {self.seconds:.2f}s sending')
 
 
 class IDOL(VectorStore):
@@ -22,6 +86,12 @@ class IDOL(VectorStore):
         database: Optional[str] = 'DOCQA',
         index_batch_size: Optional[int] = 5*1204*1024,
         search_type: Optional[str] = 'KEYWORD_VECTOR',
+        index_concurrency: Optional[int] = 4,
+        timeout: Optional[float] = 60,
+        retries: Optional[int] = 3,
+        retry_backoff: Optional[float] = 0.5,
+        embed_batch_size: Optional[int] = 64,
+        vector_precision: Optional[int] = None,
     ):
         """Initialize with necessary components."""
         self.embedding = embedding
@@ -30,29 +100,135 @@ class IDOL(VectorStore):
         self.database = database
         self.index_batch_size = index_batch_size
         self.search_type = search_type
+        self.index_concurrency = index_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.embed_batch_size = embed_batch_size
+        self.vector_precision = vector_precision
+        self.report = IndexReport()
+
+        # keep-alive connections shared by all requests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=index_concurrency + 4)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # IDX not sent yet, and number of documents in it
+        self._buffer = io.StringIO()
+        self._buffered = 0
+        self._buffered_refs: List[str] = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: List[Future] = []
+        self._slots = threading.BoundedSemaphore(index_concurrency)
+
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self.embedding
+
+
+    def _request(self, method: str, action: str, **kwargs: Any) -> Optional[requests.Response]:
+        """
+        Send request to IDOL, retry with exponential backoff on connection
+        errors and server errors.
 
+        Returns
+        -------
+        Optional[requests.Response]
+            None if all attempts failed.
 
-    def _index(self, content: str):
         """
-        index to IDOL Content
+        for attempt in range(self.retries + 1):
+            if attempt:
+                with self.report._lock:
+                    self.report.retries += 1
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            try:
+                res = self.session.request(method, f'{self.url}/{action}',
+                                           timeout=self.timeout, **kwargs)
+            except requests.RequestException as e:
+                error = e
+                continue
+            if res.status_code < 500:
+                return res
+            error = res.text
+        print(f'ERROR: {error}')
+        return None
+
+
+    def _index(self, content: str, documents: int = 0, refs: Optional[List[str]] = None):
+        """
+        index to IDOL Content in background, at most `index_concurrency`
+        batches are sent at a time and the caller is blocked by further ones.
 
         Parameters
         ----------
         content : str
-            DESCRIPTION.
+            IDX of documents.
+        documents : int
+            number of documents in content.
+        refs : Optional[List[str]]
+            references of documents in content, reported if the batch fails.
 
         Returns
         -------
         None.
 
         """
+        self._slots.acquire()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.index_concurrency,
+                                                thread_name_prefix='idol-index')
+        future = self._executor.submit(self._post_index, content, documents, refs)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._pending.append(future)
+
+
+    def _post_index(self, content: str, documents: int, refs: Optional[List[str]] = None) -> None:
+        start = time.perf_counter()
         headers = {'Content-Type': 'text/plain; charset=UTF-8'}
         data = f'{content}\n#DREENDDATAREFERENCE'.encode('utf-8')
-        res = requests.post(f'{self.url}/DREADDDATA?CreateDatabase=true',
+        # same references replace each other, so retrying a batch is safe
+        res = self._request('POST', 'DREADDDATA?CreateDatabase=true&KillDuplicates=REFERENCE',
                             data = data,
                             headers = headers)
-        if res.status_code != 200:
+        ok = res is not None and res.status_code == 200
+        if res is not None and not ok:
             print(f'ERROR: {res.text}')
+        self.report.add(documents, len(data), ok, time.perf_counter() - start, refs)
+
+
+    def flush(self) -> IndexReport:
+        """
+        Send buffered documents, and wait for all batches being sent to
+        IDOL Content.
+        """
+        if self._buffered:
+            self._index(self._buffer.getvalue(), self._buffered, self._buffered_refs)
+            self._buffer = io.StringIO()
+            self._buffered = 0
+            self._buffered_refs = []
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+        return self.report
+
+
+    def _references(self, metadatas: Optional[List[Dict]], count: int) -> List[str]:
+        """
+        Default references "{source}#{section}".
+        """
+        refs = []
+        last_source = None
+        section = -1
+        for i in range(count):
+            metadata = metadatas[i] if metadatas else {}
+            source = metadata['source'] if 'source' in metadata else f'unkown_{i}'
+            section = section + 1 if source == last_source else 0
+            last_source = source
+            refs.append(f'{source}#{section}')
+        return refs
 
 
     def add_texts(
@@ -66,85 +242,124 @@ class IDOL(VectorStore):
         Args:
             texts: Iterable of strings to add to the vectorstore.
             metadatas: Optional list of metadatas associated with the texts.
+            ids: Optional list of references of the texts, default is
+                "{source}#{section}".
 
         Returns:
             List of ids from adding the texts into the vectorstore.
         """
+        texts = list(texts)
+        refs = kwargs.get('ids') or self._references(metadatas, len(texts))
+
+        # next batch is embedded while previous ones are sent
         ids = []
+        for i in range(0, len(texts), self.embed_batch_size):
+            part = texts[i:i + self.embed_batch_size]
+            embeddings = self.embedding.embed_documents(part)
+            ids += self.add_embeddings(zip(part, embeddings),
+                                       metadatas[i:i + self.embed_batch_size] if metadatas else None,
+                                       ids=refs[i:i + self.embed_batch_size])
+        return ids
 
-        embeddings = self.embedding.embed_documents(list(texts))
-        last_source = None
-        section = -1
-        index = ''
-        for i, text in enumerate(texts):
-            metadata = metadatas[i] if metadatas else {}
-            source = metadata['source'] if 'source' in metadata else f'unkown_{i}'
-            section = section + 1 if source == last_source else 0
-            if index and self.index_batch_size < len(index):
-                self._index(index)
-                index = ''
-            last_source = source
-            ids.append(f'{source}#{section}')
-            vector = ','.join([str(x) for x in embeddings[i]])
-            content = texts[i]
+
+    def add_embeddings(
+        self,
+        text_embeddings: Iterable[Tuple[str, List[float]]],
+        metadatas: Optional[List[Dict]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        """Add the given texts and embeddings to the vectorstore.
+
+        Args:
+            text_embeddings: Iterable pairs of string and embedding to
+                add to the vectorstore.
+            metadatas: Optional list of metadatas associated with the texts.
+            ids: Optional list of references of the texts, default is
+                "{source}#{section}".
+
+        Returns:
+            List of ids from adding the texts into the vectorstore.
+
+        Documents are buffered up to `index_batch_size`, call `flush` to
+        send the rest.
+        """
+        text_embeddings = list(text_embeddings)
+        if not text_embeddings:
+            return []
+        texts = [t for t, _ in text_embeddings]
+        vectors = format_vectors([e for _, e in text_embeddings], self.vector_precision)
+        ids = kwargs.get('ids') or self._references(metadatas, len(texts))
+
+        # appending to StringIO, size of buffer is its position
+        for ref, vector, content in zip(ids, vectors, texts):
+            if self._buffered and self.index_batch_size < self._buffer.tell():
+                self._index(self._buffer.getvalue(), self._buffered, self._buffered_refs)
+                self._buffer = io.StringIO()
+                self._buffered = 0
+                self._buffered_refs = []
             #no "#DRESECTION {section}"
-            index = f"""{index}
-#DREREFERENCE {source}#{section}
+            self._buffer.write(f"""
+#DREREFERENCE {ref}
 #DREFIELD {self.vector_field}="{vector}"
 #DREDBNAME {self.database}
 #DRECONTENT
 {content}
 #DREENDDOC
-"""
-        
-        if index:
-            self._index(index)
-            index = ''
+""")
+            self._buffered += 1
+            self._buffered_refs.append(ref)
 
         return ids
 
-    def similarity_search_with_score(
-        self,
-        query: str,
-        k: int = 4,
-    ) -> List[Tuple[Document, float]]:
-        """Return docs most similar to query.
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        """Delete documents by reference from IDOL Content.
 
         Args:
-            query: Text to look up documents similar to.
-            k: Number of Documents to return. Defaults to 4.
+            ids: List of references to delete.
 
         Returns:
-            List of documents most similar to the query with distance.
+            True if deletion is successful, False otherwise.
         """
-        docs_with_scores: List[Tuple[Document, float]] = []
-
-        # TODO: search doc and score from IDOL Content
-        #if self.vector_search:
-        #   query_embedding = self.embedding.embed_query(query)
-
-        return docs_with_scores
+        if not ids:
+            return True
+
+        # DREDELETEREF takes references separated by spaces, spaces inside
+        # a reference must be url encoded
+        data = {'Docs': ' '.join(quote(ref, safe='') for ref in ids),
+                'DREDbName': self.database}
+        res = self._request('POST', 'DREDELETEREF', data = data)
+        if res is None:
+            return False
+        if res.status_code != 200:
+            print(f'ERROR: {res.text}')
+            return False
+        return True
 
 
-    def similarity_search(
+    def _query(
         self,
         query: str,
         k: int = 4,
-        **kwargs: Any,
-    ) -> List[Document]:
-        """Return docs most similar to query.
+        query_embedding: Optional[List[float]] = None,
+        print_vectors: bool = False,
+    ) -> List[Tuple[Document, float, Optional[str]]]:
+        """Query IDOL Content.
 
         Args:
             query: Text to look up documents similar to.
             k: Number of Documents to return. Defaults to 4.
+            query_embedding: Embedding of query, computed if needed and missing.
+            print_vectors: Return text of vector field of documents too.
 
         Returns:
-            List of Documents most similar to the query.
+            List of documents, weights in 0 to 100 and text of vectors.
         """
         # search doc from IDOL Content
         if 'VECTOR' in self.search_type:
-            query_embedding = self.embedding.embed_query(query)
-            vector = ','.join([str(x) for x in query_embedding])
+            if query_embedding is None:
+                with span('embed'):
+                    query_embedding = self.embedding.embed_query(query)
+            vector = format_vectors(query_embedding, self.vector_precision)[0]
 
         if self.search_type == 'VECTOR':
             text = f'text=VECTOR{{{vector}}}:VECTOR'
@@ -155,13 +370,17 @@ class IDOL(VectorStore):
         else:
             #'KEYWORD'
             text = f'text={query}'
-        url = f'{self.url}/a=query&DetectLanguageType=true&anylanguage=true&ResponseFormat=json&maxresults={k}&{text}'
-
-        try:
-            res = requests.get(url)
-        except Exception as e:
-            print(f'ERROR: {e}')
-            return []
+        action = f'a=query&DetectLanguageType=true&anylanguage=true&ResponseFormat=json&maxresults={k}&{text}'
+        if print_vectors:
+            action = f'{action}&print=fields&printfields=DRECONTENT,{self.vector_field}'
+        url = f'{self.url}/{action}'
+
+        with span('idol_query', k=k) as attrs:
+            # retried with backoff as indexing is
+            res = self._request('GET', action)
+            if res is None:
+                return []
+            attrs['bytes'] = len(res.content)
 
         jres = json.loads(res.text)
         res_data = jres['autnresponse']['responsedata']
@@ -171,23 +390,106 @@ class IDOL(VectorStore):
         elif 0 == int(res_data['autn:numhits']['$']):
             return []
 
-        return [Document(page_content=c['DRECONTENT'][0]['$'],
-                         metadata={'source': hit['autn:reference']['$']})
+        return [(Document(page_content=c['DRECONTENT'][0]['$'],
+                          metadata={'source': hit['autn:reference']['$']}),
+                 float(hit['autn:weight']['$']),
+                 c[self.vector_field][0]['$'] if self.vector_field in c else None)
                 for hit in res_data['autn:hit']
                 for c in hit['autn:content']['DOCUMENT'] ]
 
 
+    def similarity_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        """Return docs most similar to query.
+
+        Args:
+            query: Text to look up documents similar to.
+            k: Number of Documents to return. Defaults to 4.
+
+        Returns:
+            List of documents most similar to the query with IDOL weight,
+            from 0 to 100, higher is more similar.
+        """
+        return [(doc, weight) for doc, weight, _ in self._query(query, k)]
+
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        """IDOL weights are percentages."""
+        return lambda weight: weight / 100
+
+
+    def similarity_search(
+        self,
+        query: str,
+        k: int = 4,
+        **kwargs: Any,
+    ) -> List[Document]:
+        """Return docs most similar to query.
+
+        Args:
+            query: Text to look up documents similar to.
+            k: Number of Documents to return. Defaults to 4.
+
+        Returns:
+            List of Documents most similar to the query.
+        """
+        return [doc for doc, _, _ in self._query(query, k)]
+
+
+    def max_marginal_relevance_search(
+        self,
+        query: str,
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        **kwargs: Any,
+    ) -> List[Document]:
+        """Return docs selected using the maximal marginal relevance.
+
+        Candidates and their vectors are fetched in one query, and re-ranked
+        locally.
+
+        Args:
+            query: Text to look up documents similar to.
+            k: Number of Documents to return. Defaults to 4.
+            fetch_k: Number of Documents to fetch to pass to MMR algorithm.
+            lambda_mult: Number between 0 and 1 that determines the degree
+                        of diversity among the results with 0 corresponding
+                        to maximum diversity and 1 to minimum diversity.
+                        Defaults to 0.5.
+
+        Returns:
+            List of Documents selected by maximal marginal relevance.
+        """
+        with span('embed'):
+            query_embedding = self.embedding.embed_query(query)
+        hits = self._query(query, fetch_k, query_embedding, print_vectors=True)
+        if not hits:
+            return []
+
+        # parse all vectors at once, documents without vector are never similar
+        dim = len(query_embedding)
+        zeros = ','.join(['0'] * dim)
+        vectors = np.loadtxt(io.StringIO('\n'.join(v or zeros for _, _, v in hits)),
+                             delimiter=',', dtype=np.float32, ndmin=2)
+        selected = maximal_marginal_relevance(np.array(query_embedding, dtype=np.float32),
+                                              vectors, k=min(k, len(hits)),
+                                              lambda_mult=lambda_mult)
+        return [hits[i][0] for i in selected]
+
+
     def _sync(
         self,
     ) -> None:
         """
         Flush all files of IDOL to disk.
         """
-        url = f'{self.url}/DRESYNC'
-        try:
-            requests.get(url)
-        except Exception as e:
-            print(f'ERROR: {e}')
+        self.flush()
+        self._request('GET', 'DRESYNC')
 
 
     @classmethod
@@ -201,6 +503,9 @@ class IDOL(VectorStore):
         database: Optional[str] = 'DOCQA',
         index_batch_size: Optional[int] = 5*1204*1024,
         search_type: Optional[str] = 'KEYWORD_VECTOR',
+        index_concurrency: Optional[int] = 4,
+        timeout: Optional[float] = 60,
+        retries: Optional[int] = 3,
         **kwargs: Any,
     ) -> IDOL:
         """Construct IDOL wrapper from raw documents.
@@ -210,7 +515,7 @@ class IDOL(VectorStore):
         This is intended to be a quick way to get started.
         """
         idol = cls(embedding, url, vector_field, database, index_batch_size,
-                   search_type);
+                   search_type, index_concurrency, timeout, retries);
         idol.add_texts(texts, metadatas)
         idol._sync()
         return idol
@@ -3,16 +3,13 @@
         Module: Open-source LLM Setup
 ===========================================
 '''
-from langchain.llms import CTransformers
 from langchain.callbacks.manager import CallbackManagerForLLMRun
 from langchain.llms.base import LLM
 from typing import Any, List, Mapping, Optional
 from dotenv import find_dotenv, load_dotenv
 import box
 import yaml
-from src.chatglm import ChatGLM
-from src.chatglm_cpp import ChatGLMCPP
-from src.ollama import Ollama
+from src.prompts import qa_template
 
 
 # Load environment variables from .env file
@@ -46,34 +43,88 @@ class SearchOnlyLLM(LLM):
 
 
 
+def prompt_prefix():
+    """
+    Beginning of qa_template shared by all prompts
+    """
+    return qa_template[:qa_template.index('{')]
+
+
+def pool_size():
+    """
+    Generations at a time of the model in this process
+    """
+    if cfg.SEARCH_ONLY or cfg.MODEL_TYPE == 'ollama':
+        return 1
+    return max(1, cfg.LLM_WORKERS)
+
+
+def build_model(threads=0):
+    """
+    One instance of the configured model, generating with `threads`
+    threads, 0 for the default of its backend
+    """
+    if cfg.MODEL_TYPE == 'chatglm':
+        from src.chatglm import ChatGLM
+        llm = ChatGLM(model=cfg.MODEL_BIN_PATH,
+                      config={
+                          'max_length': cfg.MAX_NEW_TOKENS,
+                          'temperature': cfg.TEMPERATURE},
+                      prefix=prompt_prefix() if cfg.LLM_PREFIX_CACHE else None,
+                      threads=threads,
+                      load_mode=cfg.CHATGLM_LOAD_MODE,
+                      low_cpu_mem_usage=cfg.CHATGLM_LOW_CPU_MEM_USAGE
+                      )
+    elif cfg.MODEL_TYPE == 'chatglm_cpp':
+        from src.chatglm_cpp import ChatGLMCPP
+        config = {'max_length': cfg.MAX_NEW_TOKENS,
+                  'temperature': cfg.TEMPERATURE}
+        if threads:
+            config['num_threads'] = threads
+        llm = ChatGLMCPP(model=cfg.MODEL_BIN_PATH,
+                         config=config,
+                         reuse_prefix=cfg.LLM_PREFIX_CACHE
+                         )
+    elif cfg.MODEL_TYPE == 'ollama':
+        from src.ollama import Ollama
+        llm = Ollama(model=cfg.MODEL_BIN_PATH,
+                         config={
+                             'max_length': cfg.MAX_NEW_TOKENS,
+                             'temperature': cfg.TEMPERATURE},
+                         keep_alive=cfg.OLLAMA_KEEP_ALIVE
+                         )
+    else:
+        # Local CTransformers model
+        from src.ctransformers_llm import PrefixCTransformers
+        config = {'max_new_tokens': cfg.MAX_NEW_TOKENS,
+                  'temperature': cfg.TEMPERATURE}
+        if threads:
+            config['threads'] = threads
+        llm = PrefixCTransformers(model=cfg.MODEL_BIN_PATH,
+                                  model_type=cfg.MODEL_TYPE,
+                                  config=config
+                                  )
+    return llm
+
+
 def build_llm():
+    # only the configured backend is imported, each pulls in heavy packages
     if cfg.SEARCH_ONLY:
-        llm = SearchOnlyLLM()
-    else:
-        if cfg.MODEL_TYPE == 'chatglm':
-            llm = ChatGLM(model=cfg.MODEL_BIN_PATH,
-                          config={
-                              'max_length': cfg.MAX_NEW_TOKENS,
-                              'temperature': cfg.TEMPERATURE}
-                          )
-        elif cfg.MODEL_TYPE == 'chatglm_cpp':
-            llm = ChatGLMCPP(model=cfg.MODEL_BIN_PATH,
-                             config={
-                                 'max_length': cfg.MAX_NEW_TOKENS,
-                                 'temperature': cfg.TEMPERATURE}
-                             )
-        elif cfg.MODEL_TYPE == 'ollama':
-            llm = Ollama(model=cfg.MODEL_BIN_PATH,
-                             config={
-                                 'max_length': cfg.MAX_NEW_TOKENS,
-                                 'temperature': cfg.TEMPERATURE}
-                             )
-        else:
-            # Local CTransformers model
-            llm = CTransformers(model=cfg.MODEL_BIN_PATH,
-                             model_type=cfg.MODEL_TYPE,
-                             config={'max_new_tokens': cfg.MAX_NEW_TOKENS,
-                                     'temperature': cfg.TEMPERATURE}
-                             )
+        return SearchOnlyLLM()
+    workers = pool_size()
+    if cfg.MODEL_TYPE == 'ollama' or (workers == 1 and not cfg.LLM_PIN_CORES and not cfg.LLM_WORKER_CORES):
+        return build_model(cfg.LLM_WORKER_THREADS)
 
-    return llm
+    from src.llm_pool import LLMPool, core_layout
+    threads, cores = core_layout(workers, cfg.LLM_WORKER_THREADS, cfg.LLM_PIN_CORES,
+                                 cfg.LLM_WORKER_CORES)
+    first = build_model(threads)
+    if cfg.MODEL_TYPE == 'chatglm':
+        # torch model is only read by generations, its workers share it
+        models = [first] + [first.copy(update={'prefix_cache': None}) for _ in range(workers - 1)]
+    else:
+        # chatglm_cpp and ctransformers llama models map their file, workers share its pages
+        models = [first] + [build_model(threads) for _ in range(workers - 1)]
+    print(f'INFO: {workers} LLM workers of {threads} threads' +
+          (f', on cores {cores}' if cores[0] else ''))
+    return LLMPool(workers=models, cores=cores)
@@ -0,0 +1,200 @@
+# =========================
+#  Module: LLM worker pool
+# =========================
+"""
+Several generation workers of one model in this process, so a CPU host
+runs as many generations at a time instead of one, each on its own cores.
+
+Every worker is an instance of the model with its own context (KV cache),
+generating with `threads` threads, optionally pinned to its own cores.
+Weights are shared where the backend allows it: ctransformers maps GGUF
+files and chatglm_cpp GGML files from disk, so every worker reads the same
+pages of the page cache, and ChatGLM workers share one torch model. A
+generation takes the first free worker, or waits for one.
+
+Every worker generates in a thread of its own, pinned to its cores when
+it starts, so threads a backend keeps for its caller, like the OpenMP team
+of torch, are created on those cores and stay there.
+"""
+import os
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.llms.base import LLM
+from langchain.schema.output import GenerationChunk
+from src.tracing import bind
+
+
+def available_cores() -> List[int]:
+    """ cores this process may run on
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def parse_cores(text: str) -> List[int]:
+    """ cores of a cpu list like '0-3,8,10-11'
+    """
+    cores = []
+    for part in str(text).split(','):
+        first, _, last = part.strip().partition('-')
+        cores.extend(range(int(first), int(last or first) + 1))
+    return cores
+
+
+def core_layout(workers: int, threads: int = 0, pin: bool = False,
+                cores: Sequence[str] = ()) -> Tuple[int, List[Optional[List[int]]]]:
+    """
+    Threads and cores of every worker.
+
+    Parameters
+    ----------
+    workers : int
+        number of workers.
+    threads : int
+        threads of every worker, 0 for available cores divided by workers.
+    pin : bool
+        pin every worker to its own block of `threads` cores, in order of
+        core ids, which on most hosts are distinct physical cores first.
+    cores : Sequence[str]
+        cpu list of every worker, e.g. ['0-3', '4-7'], instead of blocks.
+
+    Returns
+    -------
+    Tuple[int, List[Optional[List[int]]]]
+        threads of a worker, and cores of every worker, None if not pinned.
+
+    """
+    available = available_cores()
+    if cores:
+        layout = [parse_cores(cores[i % len(cores)]) for i in range(workers)]
+        return threads or len(layout[0]), layout
+    threads = threads or max(1, len(available) // workers)
+    if not pin:
+        return threads, [None] * workers
+    if workers * threads > len(available):
+        print(f'ERROR: {workers} workers of {threads} threads need more than {len(available)} cores, '
+              f'pinned workers share cores')
+    return threads, [[available[(i * threads + j) % len(available)] for j in range(threads)]
+                     for i in range(workers)]
+
+
+def pin(cores: Optional[List[int]]) -> None:
+    """ run calling thread, and threads it starts later, on cores only
+    """
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+
+class LLMPool(LLM):
+    """ LLM dispatching every generation to a free worker
+    """
+
+    workers: List[Any]
+    cores: List[Optional[List[int]]] = []
+    prefill: Optional[Dict[str, Any]] = None
+    free: Any = None  #: :meta private:
+    threads: Any = None  #: :meta private:
+
+    def __init__(self, **kwargs: Any) -> LLM:
+        """
+        Parameters
+        ----------
+        workers : List[LLM]
+            models generating concurrently, each used by one generation at
+            a time.
+        cores : List[Optional[List[int]]]
+            cores the thread of every worker is pinned to, None for any.
+
+        Returns
+        -------
+        LLM
+            pool of workers.
+
+        """
+        super().__init__(**kwargs)
+
+        self.free = queue.Queue()
+        self.threads = []
+        for i in range(len(self.workers)):
+            self.free.put(i)
+            cores = self.cores[i] if i < len(self.cores) else None
+            self.threads.append(ThreadPoolExecutor(1, thread_name_prefix=f'llm-worker-{i}',
+                                                   initializer=pin, initargs=(cores,)))
+
+
+    @property
+    def _llm_type(self) -> str:
+        return "llm-pool"
+
+
+    @property
+    def size(self) -> int:
+        return len(self.workers)
+
+
+    def _submit(self, fn: Callable[[Any], Any]) -> Future:
+        """ run fn with first free worker in the thread of the worker
+        """
+        i = self.free.get()
+
+        def run():
+            try:
+                return fn(self.workers[i])
+            finally:
+                self.prefill = getattr(self.workers[i], 'prefill', None)
+                self.free.put(i)
+        # callbacks of worker record spans into trace of caller
+        return self.threads[i].submit(bind(run))
+
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        return self._submit(lambda llm: llm._call(prompt, stop, run_manager, **kwargs)).result()
+
+
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[GenerationChunk]:
+        chunks = queue.Queue()
+
+        def produce(llm):
+            try:
+                if type(llm)._stream == LLM._stream:
+                    # streams through run_manager only
+                    chunks.put(GenerationChunk(text=llm._call(prompt, stop, run_manager, **kwargs)))
+                else:
+                    for chunk in llm._stream(prompt, stop, run_manager, **kwargs):
+                        chunks.put(chunk)
+            finally:
+                chunks.put(None)
+
+        future = self._submit(produce)
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            yield chunk
+        # error of worker
+        future.result()
+
+
+    @property
+    def _identifying_params(self) -> Mapping[str, Any]:
+        """Get the identifying parameters."""
+        return {
+            'workers': len(self.workers),
+            'cores': self.cores,
+            'model': self.workers[0]._identifying_params if self.workers else None
+        }
@@ -0,0 +1,183 @@
+# =========================
+#  Module: Index manifest
+# =========================
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+def file_hash(path: str, block_size: int = 1 << 20) -> str:
+    """ sha256 of file content
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def chunk_hash(text: str) -> str:
+    """ sha1 of chunk text
+    """
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class Manifest:
+    """ persistent record of indexed files and their chunks
+
+    Layout of `files`::
+
+        {source: {'hash': sha256, 'mtime': float, 'size': int,
+                  'chunks': [{'id': vector id, 'hash': sha1 of text}, ...]}}
+
+    `settings` records everything which changes the vectors of a chunk, a
+    manifest written with other settings is discarded and the index is
+    rebuilt from scratch.
+    """
+
+    def __init__(self, path: str, settings: Dict[str, Any]):
+        self.path = path
+        self.settings = settings
+        self.files: Dict[str, Dict[str, Any]] = {}
+        # files of a manifest written with other settings, still in the index
+        self.stale: Dict[str, Dict[str, Any]] = {}
+        self.build_id: Optional[str] = None
+
+
+    @classmethod
+    def load(cls, path: str, settings: Dict[str, Any]) -> 'Manifest':
+        """
+        Parameters
+        ----------
+        path : str
+            location of the manifest file.
+        settings : Dict[str, Any]
+            settings of current build.
+
+        Returns
+        -------
+        Manifest
+            previous manifest, or an empty one if it's missing or was
+            written with different settings, with files of the latter in
+            `stale`.
+
+        """
+        manifest = cls(path, settings)
+        if not os.path.exists(path):
+            return manifest
+
+        with open(path, 'r', encoding='utf8') as f:
+            data = json.load(f)
+        if data.get('settings') != settings:
+            print('INFO: index settings changed, rebuild all documents')
+            manifest.stale = data.get('files', {})
+            return manifest
+
+        manifest.files = data.get('files', {})
+        manifest.build_id = data.get('build_id')
+        return manifest
+
+
+    @property
+    def empty(self) -> bool:
+        return not self.files
+
+
+    def save(self) -> None:
+        """ write manifest atomically with a new build id
+        """
+        self.build_id = f'{time.time():.6f}'
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w', encoding='utf8') as f:
+            json.dump({'settings': self.settings,
+                       'build_id': self.build_id,
+                       'files': self.files}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+
+    def diff(self, sources: Iterable[str]) -> Tuple[List[Tuple[str, str]], List[str]]:
+        """
+        Compare sources on disk with manifest.
+
+        Parameters
+        ----------
+        sources : Iterable[str]
+            files currently in data path.
+
+        Returns
+        -------
+        Tuple[List[Tuple[str, str]], List[str]]
+            (source, file hash) of new or changed files, and removed files.
+
+        """
+        changed = []
+        sources = list(sources)
+        for source in sources:
+            stat = os.stat(source)
+            entry = self.files.get(source)
+            if entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                continue
+            digest = file_hash(source)
+            if entry and entry['hash'] == digest:
+                # touched only
+                entry['mtime'] = stat.st_mtime
+                continue
+            changed.append((source, digest))
+
+        current = set(sources)
+        removed = [s for s in self.files if s not in current]
+        return changed, removed
+
+
+    def chunks(self, source: str) -> List[Dict[str, str]]:
+        entry = self.files.get(source)
+        return entry['chunks'] if entry else []
+
+
+    def update(self, source: str, digest: str, chunks: List[Dict[str, str]]) -> None:
+        stat = os.stat(source)
+        self.files[source] = {'hash': digest,
+                              'mtime': stat.st_mtime,
+                              'size': stat.st_size,
+                              'chunks': chunks}
+
+
+    def invalidate(self, ids: Iterable[str]) -> List[str]:
+        """ mark chunks as not indexed, so the next build indexes their files
+        and chunks again, and return those files
+        """
+        ids = set(ids)
+        sources = []
+        for source, entry in self.files.items():
+            failed = [c for c in entry['chunks'] if c['id'] in ids]
+            if not failed:
+                continue
+            for chunk in failed:
+                chunk['hash'] = ''
+            entry['hash'] = ''
+            entry['mtime'] = None
+            sources.append(source)
+        return sources
+
+
+    def remove(self, source: str) -> List[str]:
+        """ forget a file and return its vector ids
+        """
+        entry = self.files.pop(source, None)
+        return [c['id'] for c in entry['chunks']] if entry else []
+
+
+
+def build_id(path: str) -> Optional[str]:
+    """ id of the last index build recorded in manifest, None if never built
+    """
+    try:
+        with open(path, 'r', encoding='utf8') as f:
+            return json.load(f).get('build_id')
+    except (OSError, ValueError):
+        return None
@@ -3,8 +3,10 @@
 # =========================
 from langchain.callbacks.manager import CallbackManagerForLLMRun
 from langchain.llms.base import LLM
-from typing import Any, Dict, List, Mapping, Optional
+from langchain.schema.output import GenerationChunk
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Union
 import ollama
+from src.prefix_cache import FirstTokenTimer, prefill_report
 
 
 class Ollama(LLM):
@@ -13,6 +15,8 @@ class Ollama(LLM):
     
     model: str = None
     config: Optional[Dict[str, Any]] = None
+    keep_alive: Optional[Union[float, str]] = None
+    prefill: Optional[Dict[str, Any]] = None
        
     def __init__(self, **kwargs: Any) -> LLM:
         """
@@ -20,6 +24,10 @@ class Ollama(LLM):
         ----------
         model : str
             The name of the model file in repo or directory.
+        keep_alive : Optional[Union[float, str]]
+            how long ollama keeps model loaded after a query, e.g. '30m' or
+            -1 for ever, together with the evaluated prompt it reuses the
+            beginning of.
 
         Returns
         -------
@@ -42,11 +50,54 @@ class Ollama(LLM):
         run_manager: Optional[CallbackManagerForLLMRun] = None,
         **kwargs: Any,
     ) -> str:
-        # TODO: pass self.config
-        response = ollama.generate(self.model
+        text = []
+        for chunk in self._stream(prompt, stop, run_manager, **kwargs):
+            text.append(chunk.text)
+        return ''.join(text)
+
+
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[GenerationChunk]:
+        timer = FirstTokenTimer()
+        for part in ollama.generate(self.model
                 , prompt
-                , options = self.config).response
-        return response
+                , options = self._options(stop)
+                , keep_alive = self.keep_alive
+                , stream = True):
+            if part.done:
+                self._report(part, timer)
+            token = part.response
+            if not token:
+                continue
+            timer.token()
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+            yield GenerationChunk(text=token)
+
+
+    def _options(self, stop: Optional[List[str]] = None) -> Dict[str, Any]:
+        """ config as options of ollama, max_length is max new tokens, num_predict
+        """
+        options = dict(self.config or {})
+        if 'max_length' in options:
+            options['num_predict'] = options.pop('max_length')
+        if stop:
+            options['stop'] = stop
+        return options
+
+
+    def _report(self, part: Any, timer: FirstTokenTimer) -> None:
+        # ollama evaluates only prompt tokens after those it still has in
+        # cache, context holds all tokens of prompt and response
+        evaluated = part.prompt_eval_count or 0
+        prompt_tokens = max(evaluated, len(part.context or []) - (part.eval_count or 0))
+        seconds = part.prompt_eval_duration / 1e9 if part.prompt_eval_duration else timer.seconds
+        self.prefill = prefill_report(prompt_tokens, prompt_tokens - evaluated, seconds)
 
 
     @property
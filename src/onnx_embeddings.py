@@ -0,0 +1,202 @@
+# =========================
+#  Module: ONNX embeddings
+# =========================
+"""
+Sentence transformers model run by onnxruntime on CPU, optionally with
+weights quantized to int8.
+
+The transformer of `EMBEDDINGS_MODEL` is exported once to a folder of
+`EMBEDDINGS_ONNX_PATH` with its tokenizer and pooling, and quantized by
+dynamic int8 quantization. Quantized vectors are compared with those of
+the original model on sample sentences, and the quantized model is only
+kept if they are at least `min_cosine` similar. `bench/embeddings.py`
+compares them on a corpus.
+
+Texts are tokenized once, sorted by number of tokens and embedded in
+batches of similar length, so batches are padded to few tokens.
+"""
+import json
+import os
+from typing import Any, Dict, List, Optional
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+
+
+# sentences to check quantized vectors with, of both languages of documents
+CHECK_TEXTS = [
+    'The quick brown fox jumps over the lazy dog.',
+    'Restart the service after changing the configuration file.',
+    'Maximum operating temperature is 85 degrees Celsius.',
+    'How do I reset my password?',
+    'Invoices are sent by email at the end of every month.',
+    '请在修改配置文件后重新启动服务。',
+    '设备的最高工作温度为85摄氏度。',
+    '如何重置我的密码？',
+    '每月月底通过电子邮件发送发票。',
+    'Le manuel décrit l\'installation du logiciel.',
+]
+
+
+def onnx_folder(model: str, path: str) -> str:
+    """ folder of exported model
+    """
+    return os.path.join(path, os.path.basename(os.path.normpath(model)))
+
+
+def cosine(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """ cosine similarity of rows of a and b
+    """
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    return (a * b).sum(1) / np.maximum(np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1), 1e-12)
+
+
+def export_onnx(model: str, folder: str, quantize: bool = True, min_cosine: float = 0.99) -> Dict[str, Any]:
+    """
+    Export transformer of a sentence transformers model to ONNX.
+
+    Parameters
+    ----------
+    model : str
+        name or folder of sentence transformers model.
+    folder : str
+        folder to write model.onnx, model.int8.onnx, tokenizer and
+        pooling.json to.
+    quantize : bool
+        quantize weights to int8 as well.
+    min_cosine : float
+        min cosine similarity of quantized vectors with original ones on
+        `CHECK_TEXTS`, the quantized model is dropped below it.
+
+    Returns
+    -------
+    Dict[str, Any]
+        settings written to pooling.json.
+
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer, models
+
+    st = SentenceTransformer(model, device='cpu')
+    transformer = st[0]
+    pooling = next(m for m in st if isinstance(m, models.Pooling))
+    settings = {'model': model,
+                'pooling': 'cls' if pooling.pooling_mode_cls_token
+                           else 'max' if pooling.pooling_mode_max_tokens else 'mean',
+                'normalize': any(isinstance(m, models.Normalize) for m in st),
+                'max_length': transformer.max_seq_length}
+    os.makedirs(folder, exist_ok=True)
+    transformer.tokenizer.save_pretrained(folder)
+
+    names = [name for name in ('input_ids', 'attention_mask', 'token_type_ids')
+             if name in transformer.tokenizer.model_input_names]
+    sample = transformer.tokenizer(CHECK_TEXTS[:2], padding=True, return_tensors='pt')
+    axes = {name: {0: 'batch', 1: 'tokens'} for name in names + ['last_hidden_state']}
+    with torch.no_grad():
+        torch.onnx.export(transformer.auto_model, ({name: sample[name] for name in names},),
+                          os.path.join(folder, 'model.onnx'), input_names=names,
+                          output_names=['last_hidden_state'], dynamic_axes=axes,
+                          opset_version=14)
+    with open(os.path.join(folder, 'pooling.json'), 'w', encoding='utf8') as f:
+        json.dump(settings, f)
+    print(f'INFO: exported {model} to {folder}')
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantized = os.path.join(folder, 'model.int8.onnx')
+        quantize_dynamic(os.path.join(folder, 'model.onnx'), quantized, weight_type=QuantType.QInt8)
+        similarity = cosine(st.encode(CHECK_TEXTS),
+                            OnnxEmbeddings(folder, quantized=True).embed_documents(CHECK_TEXTS))
+        settings['int8_min_cosine'] = float(similarity.min())
+        if similarity.min() < min_cosine:
+            print(f'ERROR: int8 vectors of {model} are only {similarity.min():.4f} cosine similar '
+                  f'to original ones, below {min_cosine}, use model without quantization')
+            os.remove(quantized)
+        else:
+            print(f'INFO: int8 vectors of {model} are at least {similarity.min():.4f} cosine similar')
+        with open(os.path.join(folder, 'pooling.json'), 'w', encoding='utf8') as f:
+            json.dump(settings, f)
+    return settings
+
+
+class OnnxEmbeddings(Embeddings):
+    """ embeddings of a model exported by `export_onnx`
+    """
+
+    def __init__(self, folder: str, quantized: bool = True, batch_size: int = 32, threads: int = 0):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(folder, 'pooling.json'), 'r', encoding='utf8') as f:
+            self.settings = json.load(f)
+        path = os.path.join(folder, 'model.int8.onnx')
+        self.quantized = quantized and os.path.exists(path)
+        if not self.quantized:
+            path = os.path.join(folder, 'model.onnx')
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.inputs = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(folder)
+        self.batch_size = batch_size
+
+
+    def _pool(self, hidden: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        if self.settings['pooling'] == 'cls':
+            pooled = hidden[:, 0]
+        elif self.settings['pooling'] == 'max':
+            pooled = np.where(mask[..., None] > 0, hidden, -1e9).max(1)
+        else:
+            pooled = (hidden * mask[..., None]).sum(1) / np.maximum(mask.sum(1, keepdims=True), 1e-9)
+        if self.settings['normalize']:
+            pooled = pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+        return pooled
+
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        encoded = self.tokenizer(list(texts), truncation=True,
+                                 max_length=self.settings['max_length'])['input_ids']
+        # batches of texts of similar length need little padding
+        order = sorted(range(len(texts)), key=lambda i: len(encoded[i]))
+        vectors: Optional[np.ndarray] = None
+        pad = self.tokenizer.pad_token_id or 0
+        for start in range(0, len(order), self.batch_size):
+            rows = order[start:start + self.batch_size]
+            width = max(len(encoded[i]) for i in rows)
+            ids = np.full((len(rows), width), pad, dtype=np.int64)
+            mask = np.zeros((len(rows), width), dtype=np.int64)
+            for row, i in enumerate(rows):
+                ids[row, :len(encoded[i])] = encoded[i]
+                mask[row, :len(encoded[i])] = 1
+            feeds = {'input_ids': ids, 'attention_mask': mask}
+            if 'token_type_ids' in self.inputs:
+                feeds['token_type_ids'] = np.zeros_like(ids)
+            hidden = self.session.run(None, {k: v for k, v in feeds.items() if k in self.inputs})[0]
+            pooled = self._pool(hidden, mask.astype(np.float32))
+            if vectors is None:
+                vectors = np.zeros((len(texts), pooled.shape[1]), dtype=np.float32)
+            vectors[rows] = pooled
+        return vectors.tolist()
+
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def load_onnx_embeddings(model: str, path: str, quantize: bool = True, batch_size: int = 32,
+                         threads: int = 0, min_cosine: float = 0.99) -> OnnxEmbeddings:
+    """ embeddings of model exported to a folder of path, exported first if missing
+    """
+    folder = onnx_folder(model, path)
+    exported = None
+    if os.path.exists(os.path.join(folder, 'pooling.json')):
+        with open(os.path.join(folder, 'pooling.json'), 'r', encoding='utf8') as f:
+            exported = json.load(f)
+    # not exported yet, of another model, or without quantization
+    if exported is None or exported.get('model') != model or \
+            (quantize and 'int8_min_cosine' not in exported):
+        export_onnx(model, folder, quantize, min_cosine)
+    return OnnxEmbeddings(folder, quantized=quantize, batch_size=batch_size, threads=threads)
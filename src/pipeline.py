@@ -0,0 +1,370 @@
+# =========================
+#  Module: Streaming ingestion pipeline
+# =========================
+import gzip
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import timeit
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+import pypdf
+from langchain.docstore.document import Document
+from langchain.document_loaders import PyPDFLoader, Docx2txtLoader
+
+
+LOADERS = {'.pdf': PyPDFLoader,
+           '.docx': Docx2txtLoader}
+
+# end of stream
+_DONE = object()
+
+
+def load_source(source: str) -> List[Any]:
+    """ parse one document, run in worker process
+    """
+    return LOADERS[Path(source).suffix.lower()](source).load()
+
+
+def load_pages(source: str, start: int, end: int) -> List[Any]:
+    """ parse pages start to end of a PDF, same documents as PyPDFLoader, run in worker process
+    """
+    reader = pypdf.PdfReader(source)
+    return [Document(page_content=reader.pages[i].extract_text(),
+                     metadata={'source': source, 'page': i})
+            for i in range(start, end)]
+
+
+def page_count(source: str) -> Optional[int]:
+    """ pages of a PDF, None for other documents
+    """
+    if Path(source).suffix.lower() != '.pdf':
+        return None
+    try:
+        return len(pypdf.PdfReader(source).pages)
+    except Exception:
+        # PyPDFLoader reports the error of broken file in a worker
+        return None
+
+
+class ParsedTextCache:
+    """ text extracted from documents, gzipped JSON per file hash
+
+    Documents are parsed again only when their content changes, not when
+    settings of chunks or embeddings do.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+
+
+    def _file(self, digest: str) -> str:
+        return os.path.join(self.path, f'{digest}.json.gz')
+
+
+    def get(self, digest: str, source: str) -> Optional[List[Any]]:
+        try:
+            with gzip.open(self._file(digest), 'rt', encoding='utf-8') as f:
+                pages = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # same content may have been parsed under another name
+        return [Document(page_content=page['page_content'], metadata=dict(page['metadata'], source=source))
+                for page in pages]
+
+
+    def put(self, digest: str, documents: List[Any]) -> None:
+        pages = [{'page_content': doc.page_content, 'metadata': doc.metadata} for doc in documents]
+        tmp = f'{self._file(digest)}.{os.getpid()}.tmp'
+        with gzip.open(tmp, 'wt', encoding='utf-8', compresslevel=6) as f:
+            json.dump(pages, f, ensure_ascii=False)
+        os.replace(tmp, self._file(digest))
+
+
+    def prune(self, digests: Set[str]) -> int:
+        """ remove text of files not in digests, returns number removed
+        """
+        removed = 0
+        for name in os.listdir(self.path):
+            if name.endswith('.json.gz') and name[:-len('.json.gz')] not in digests:
+                os.remove(os.path.join(self.path, name))
+                removed += 1
+        return removed
+
+
+class StageStats:
+    """ throughput of one pipeline stage
+    """
+
+    def __init__(self, name: str, unit: str):
+        self.name = name
+        self.unit = unit
+        self.count = 0
+        self.busy = 0.0
+        self.start = None
+        self.end = None
+
+
+    def add(self, count: int, busy: float) -> None:
+        self.count += count
+        self.busy += busy
+
+
+    @property
+    def elapsed(self) -> float:
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+
+    def __str__(self) -> str:
+        rate = self.count / self.elapsed if self.elapsed else 0.0
+        return (f'{self.name:<6} {self.count:>8} {self.unit:<7} '
+                f'{rate:10.1f} {self.unit}/s  busy {self.busy:8.2f}s  wall {self.elapsed:8.2f}s')
+
+
+class _Stage(threading.Thread):
+    """ worker thread of a stage, stops all stages on error
+    """
+
+    def __init__(self, pipeline: 'IngestPipeline', stats: StageStats,
+                 target: Callable[[], None]):
+        super().__init__(name=f'ingest-{stats.name}', daemon=True)
+        self.pipeline = pipeline
+        self.stats = stats
+        self.target = target
+
+
+    def run(self) -> None:
+        self.stats.start = timeit.default_timer()
+        try:
+            self.target()
+        except BaseException as e:
+            self.pipeline.fail(e)
+        finally:
+            self.stats.end = timeit.default_timer()
+
+
+class IngestPipeline:
+    """ load -> split -> embed -> write, connected by bounded queues
+
+    Documents are parsed in a process pool, large PDFs by ranges of
+    `pages_per_task` pages in parallel, every other stage is a thread. Pages
+    go to the splitter as soon as their range is parsed. At most
+    `queue_size` items wait between two stages, so memory doesn't grow with
+    the size of corpus.
+    """
+
+    def __init__(
+        self,
+        split: Callable[[str, str, List[Any], bool], Tuple[List[str], List[Tuple[str, Dict, str]]]],
+        embed: Callable[[List[str]], List[List[float]]],
+        delete: Callable[[List[str]], None],
+        add: Callable[[List[str], List[Dict], List[str], List[List[float]]], None],
+        workers: int = 0,
+        queue_size: int = 8,
+        batch_size: int = 64,
+        pages_per_task: int = 0,
+        cache: Optional[ParsedTextCache] = None,
+    ):
+        """
+        Parameters
+        ----------
+        split : Callable
+            split(source, digest, documents, last) returns (ids to delete,
+            [(text, metadata, id)]) of consecutive pages of one document,
+            last is True for its last pages.
+        embed : Callable
+            embed a batch of texts.
+        delete : Callable
+            delete vectors by ids.
+        add : Callable
+            add(texts, metadatas, ids, vectors) to vector store.
+        workers : int
+            processes to parse documents, 0 for cpu count.
+        queue_size : int
+            capacity of queue between stages.
+        batch_size : int
+            number of chunks to embed at a time.
+        pages_per_task : int
+            pages of PDF parsed by one worker, 0 to parse each file by one.
+        cache : Optional[ParsedTextCache]
+            text of documents parsed before, by file hash.
+
+        """
+        self.split = split
+        self.embed = embed
+        self.delete = delete
+        self.add = add
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.pages_per_task = pages_per_task
+        self.cache = cache
+        # pages parsed so far of documents to cache
+        self._parsed: Dict[str, List[Any]] = {}
+        # loaders return pages of PDFs, or parts of them, and one per other file
+        self.stats = [StageStats('load', 'pages'),
+                      StageStats('split', 'chunks'),
+                      StageStats('embed', 'vectors'),
+                      StageStats('write', 'vectors')]
+        self._stop = threading.Event()
+        self._error: Optional[BaseException] = None
+
+
+    def fail(self, error: BaseException) -> None:
+        if self._error is None:
+            self._error = error
+        self._stop.set()
+
+
+    def _put(self, q: queue.Queue, item: Any) -> None:
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+
+    def _get(self, q: queue.Queue) -> Any:
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+
+    def _tasks(self, pool: ProcessPoolExecutor, source: str, digest: str) -> List[Tuple[Future, bool]]:
+        """ futures of parts of a document, and whether it's parsed by them
+        """
+        documents = self.cache.get(digest, source) if self.cache else None
+        if documents is not None:
+            future = Future()
+            future.set_result(documents)
+            return [(future, False)]
+        pages = page_count(source) if self.pages_per_task else None
+        if not pages or pages <= self.pages_per_task:
+            return [(pool.submit(load_source, source), True)]
+        return [(pool.submit(load_pages, source, start, min(start + self.pages_per_task, pages)), True)
+                for start in range(0, pages, self.pages_per_task)]
+
+
+    def _load(self, sources: Iterable[Tuple[str, str]], out: queue.Queue) -> None:
+        stats = self.stats[0]
+        # spawn, forking a process holding torch threads may hang
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(self.workers, mp_context=context) as pool:
+            pending = deque()
+            for source, digest in sources:
+                tasks = self._tasks(pool, source, digest)
+                for i, (future, parsed) in enumerate(tasks):
+                    pending.append((source, digest, timeit.default_timer(), future,
+                                    parsed, i == len(tasks) - 1))
+                # bound parsed documents held in memory
+                while len(pending) >= self.workers + self.queue_size:
+                    self._put_loaded(pending.popleft(), out, stats)
+                if self._stop.is_set():
+                    return
+            for item in pending:
+                self._put_loaded(item, out, stats)
+        self._put(out, _DONE)
+
+
+    def _put_loaded(self, item, out: queue.Queue, stats: StageStats) -> None:
+        source, digest, start, future, parsed, last = item
+        documents = future.result()
+        stats.add(len(documents), timeit.default_timer() - start)
+        if parsed and self.cache is not None:
+            self._parsed.setdefault(source, []).extend(documents)
+            if last:
+                self.cache.put(digest, self._parsed.pop(source))
+        self._put(out, (source, digest, documents, last))
+
+
+    def _split(self, inq: queue.Queue, out: queue.Queue) -> None:
+        stats = self.stats[1]
+        while (item := self._get(inq)) is not _DONE:
+            start = timeit.default_timer()
+            deletes, chunks = self.split(*item)
+            stats.add(len(chunks), timeit.default_timer() - start)
+            # vectors of old chunks go before the new ones with same ids
+            if deletes:
+                self._put(out, ('delete', deletes))
+            for chunk in chunks:
+                self._put(out, ('add', chunk))
+        self._put(out, _DONE)
+
+
+    def _embed(self, inq: queue.Queue, out: queue.Queue) -> None:
+        stats = self.stats[2]
+        batch = []
+        while True:
+            item = self._get(inq)
+            if item is not _DONE:
+                kind, payload = item
+                if kind == 'delete':
+                    # ids are per document, no need to flush batch
+                    self._put(out, item)
+                    continue
+                batch.append(payload)
+            if batch and (item is _DONE or len(batch) >= self.batch_size):
+                start = timeit.default_timer()
+                texts, metadatas, ids = map(list, zip(*batch))
+                vectors = self.embed(texts)
+                stats.add(len(texts), timeit.default_timer() - start)
+                self._put(out, ('add', (texts, metadatas, ids, vectors)))
+                batch = []
+            if item is _DONE:
+                break
+        self._put(out, _DONE)
+
+
+    def _write(self, inq: queue.Queue) -> None:
+        stats = self.stats[3]
+        while (item := self._get(inq)) is not _DONE:
+            start = timeit.default_timer()
+            kind, payload = item
+            if kind == 'delete':
+                self.delete(payload)
+                stats.add(0, timeit.default_timer() - start)
+            else:
+                self.add(*payload)
+                stats.add(len(payload[0]), timeit.default_timer() - start)
+
+
+    def run(self, sources: Iterable[Tuple[str, str]]) -> List[StageStats]:
+        """
+        Parameters
+        ----------
+        sources : Iterable[Tuple[str, str]]
+            (source, file hash) of documents to index.
+
+        Returns
+        -------
+        List[StageStats]
+            throughput of every stage.
+
+        """
+        docs, chunks, vectors = (queue.Queue(self.queue_size) for _ in range(3))
+        stages = [_Stage(self, self.stats[0], lambda: self._load(sources, docs)),
+                  _Stage(self, self.stats[1], lambda: self._split(docs, chunks)),
+                  _Stage(self, self.stats[2], lambda: self._embed(chunks, vectors))]
+        for stage in stages:
+            stage.start()
+
+        # write in caller thread, vector stores are not thread safe
+        writer = _Stage(self, self.stats[3], lambda: self._write(vectors))
+        writer.run()
+        for stage in stages:
+            stage.join()
+
+        if self._error is not None:
+            raise self._error
+        return self.stats
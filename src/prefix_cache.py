@@ -0,0 +1,101 @@
+# =========================
+#  Module: Prompt prefix reuse
+# =========================
+"""
+Helpers for LLM wrappers which keep the evaluated state of the prompt
+prefix shared by queries, the instructions of `qa_template`, and only
+evaluate the rest of the next prompt.
+
+Every wrapper records `prefill`, a report of its last generation, with
+how many prompt tokens were reused and the prefill time saved by that,
+estimated from the time it took to evaluate the other prompt tokens.
+"""
+import timeit
+from typing import Any, Callable, Dict, Iterator, Optional, Sequence
+
+
+def common_prefix(past: Sequence[Any], tokens: Sequence[Any], limit: Optional[int] = None) -> int:
+    """ length of common beginning, at most `limit`
+    """
+    n = min(len(past), len(tokens))
+    if limit is not None:
+        n = min(n, limit)
+    i = 0
+    while i < n and past[i] == tokens[i]:
+        i += 1
+    return i
+
+
+def prefill_report(prompt_tokens: int, reused_tokens: int, seconds: Optional[float]) -> Dict[str, Any]:
+    """
+    Parameters
+    ----------
+    prompt_tokens : int
+        tokens of prompt.
+    reused_tokens : int
+        tokens of prompt not evaluated again.
+    seconds : Optional[float]
+        time to first token, None if there was none.
+
+    Returns
+    -------
+    Dict[str, Any]
+        the numbers given and `saved_seconds`, estimated prefill time of
+        tokens reused, None if unknown.
+
+    """
+    evaluated = prompt_tokens - reused_tokens
+    saved = None
+    if seconds is not None and evaluated > 0:
+        saved = reused_tokens * seconds / evaluated
+    return {'prompt_tokens': prompt_tokens,
+            'reused_tokens': reused_tokens,
+            'prefill_seconds': seconds,
+            'saved_seconds': saved}
+
+
+class FirstTokenTimer:
+    """ seconds from creation to first token
+    """
+
+    def __init__(self):
+        self.start = timeit.default_timer()
+        self.seconds = None
+
+
+    def token(self) -> None:
+        if self.seconds is None:
+            self.seconds = timeit.default_timer() - self.start
+
+
+def reuse_or_fallback(reusing: Iterator[Any], fallback: Callable[[], Iterator[Any]], name: str) -> Iterator[Any]:
+    """
+    Items of a generation reusing the prompt prefix, or of the generation
+    of the library if the former fails before its first item, e.g. as
+    internals it relies on changed in another version of the backend.
+
+    Parameters
+    ----------
+    reusing : Iterator[Any]
+        generation reusing the prompt prefix.
+    fallback : Callable[[], Iterator[Any]]
+        generation of the library, called if `reusing` fails.
+    name : str
+        backend, for the error printed.
+
+    Yields
+    ------
+    Any
+        items of one of the generations.
+
+    """
+    try:
+        first = next(reusing)
+    except StopIteration:
+        return
+    except Exception as e:
+        print(f'ERROR: reusing prompt prefix with {name} failed, generating without it: {e}')
+        yield from fallback()
+        return
+    yield first
+    yield from reusing
@@ -0,0 +1,253 @@
+# =========================
+#  Module: Query result cache
+# =========================
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Any, Dict, List, Optional
+import numpy as np
+from langchain.schema.document import Document
+from langchain.schema.embeddings import Embeddings
+from src.manifest import build_id
+from src.tracing import span
+
+
+_SPACES = re.compile(r'\s+')
+
+
+def normalize_query(query: str) -> str:
+    """ query with unicode form and spacing normalized, case is kept as
+    queries differing in case only may ask different things
+    """
+    return _SPACES.sub(' ', unicodedata.normalize('NFKC', query)).strip()
+
+
+class QueryCache:
+    """ responses of RetrievalQA persisted in sqlite
+
+    Entries expire after `ttl` seconds, the least recently used ones are
+    evicted above `max_entries`. The cache is emptied when `version`
+    changes, i.e. the vector store is rebuilt or settings of answers change.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        version: str,
+        ttl: float = 86400,
+        max_entries: int = 10000,
+        threshold: float = 0.0,
+    ):
+        """
+        Parameters
+        ----------
+        path : str
+            sqlite file of cache.
+        version : str
+            version of index and settings of answers.
+        ttl : float
+            seconds to keep an answer, 0 for ever.
+        max_entries : int
+            max number of answers.
+        threshold : float
+            min cosine similarity of query embeddings to reuse an answer of
+            another query, 0 for exact matches only.
+
+        """
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, vector BLOB,
+                                                response TEXT, created REAL, used REAL);
+            CREATE INDEX IF NOT EXISTS answers_used ON answers (used);
+        """)
+        self._keys: List[str] = []
+        self._vectors: Optional[np.ndarray] = None
+        self.set_version(version)
+
+
+    def set_version(self, version: str) -> None:
+        """ drop all answers if version changed
+        """
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE name='version'").fetchone()
+            if not row or row[0] != version:
+                self._db.execute('DELETE FROM answers')
+                self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                 ('version', version))
+            self.version = version
+            self._load_vectors()
+
+
+    def _load_vectors(self) -> None:
+        """ unit query vectors for semantic lookup
+        """
+        self._keys, vectors = [], []
+        if self.threshold:
+            for key, blob in self._db.execute('SELECT key, vector FROM answers '
+                                              'WHERE vector IS NOT NULL'):
+                self._keys.append(key)
+                vectors.append(np.frombuffer(blob, dtype=np.float32))
+        self._vectors = np.vstack(vectors) if vectors else None
+
+
+    @staticmethod
+    def _unit(vector: List[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+    def lookup(self, query: str, vector: Optional[List[float]] = None) -> Optional[Dict[str, Any]]:
+        """
+        Parameters
+        ----------
+        query : str
+            user query.
+        vector : Optional[List[float]]
+            embedding of query for semantic lookup.
+
+        Returns
+        -------
+        Optional[Dict[str, Any]]
+            cached response, None if missed.
+
+        """
+        keys = [hashlib.sha1(normalize_query(query).encode('utf-8')).hexdigest()]
+        with self._lock:
+            if vector is not None and self._vectors is not None:
+                scores = self._vectors @ self._unit(vector)
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    keys.append(self._keys[best])
+
+            now = time.time()
+            for key in keys:
+                row = self._db.execute('SELECT response, created FROM answers WHERE key=?',
+                                       (key,)).fetchone()
+                if not row:
+                    continue
+                if self.ttl and now - row[1] > self.ttl:
+                    self._delete([key])
+                    continue
+                self._db.execute('UPDATE answers SET used=? WHERE key=?', (now, key))
+                return self._loads(row[0])
+        return None
+
+
+    def store(self, query: str, response: Dict[str, Any],
+              vector: Optional[List[float]] = None) -> None:
+        key = hashlib.sha1(normalize_query(query).encode('utf-8')).hexdigest()
+        blob = self._unit(vector).tobytes() if vector is not None and self.threshold else None
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?)',
+                             (key, blob, self._dumps(response), now, now))
+            if blob is not None:
+                if key in self._keys:
+                    self._vectors[self._keys.index(key)] = np.frombuffer(blob, dtype=np.float32)
+                else:
+                    self._keys.append(key)
+                    row = np.frombuffer(blob, dtype=np.float32)[None, :]
+                    self._vectors = row if self._vectors is None else np.vstack([self._vectors, row])
+            self._evict(now)
+
+
+    def _evict(self, now: float) -> None:
+        victims = []
+        if self.ttl:
+            victims += [k for k, in self._db.execute('SELECT key FROM answers WHERE created<?',
+                                                     (now - self.ttl,))]
+        count = self._db.execute('SELECT COUNT(*) FROM answers').fetchone()[0] - len(victims)
+        if count > self.max_entries:
+            victims += [k for k, in self._db.execute(
+                'SELECT key FROM answers WHERE created>=? ORDER BY used LIMIT ?',
+                (now - self.ttl if self.ttl else 0, count - self.max_entries))]
+        if victims:
+            self._delete(victims)
+
+
+    def _delete(self, keys: List[str]) -> None:
+        self._db.executemany('DELETE FROM answers WHERE key=?', [(k,) for k in keys])
+        if self._vectors is not None and set(keys) & set(self._keys):
+            self._load_vectors()
+
+
+    @staticmethod
+    def _dumps(response: Dict[str, Any]) -> str:
+        response = dict(response)
+        if 'source_documents' in response:
+            response['source_documents'] = [{'page_content': d.page_content,
+                                             'metadata': d.metadata}
+                                            for d in response['source_documents']]
+        return json.dumps(response, ensure_ascii=False, default=str)
+
+
+    @staticmethod
+    def _loads(text: str) -> Dict[str, Any]:
+        response = json.loads(text)
+        if 'source_documents' in response:
+            response['source_documents'] = [Document(**d) for d in response['source_documents']]
+        return response
+
+
+class CachedRetrievalQA:
+    """ RetrievalQA chain answering repeated queries from `QueryCache`
+
+    The cache is emptied when the build id in `manifest` changes.
+    """
+
+    def __init__(self, chain: Any, cache: QueryCache, embeddings: Embeddings,
+                 manifest: str, settings: str):
+        self.chain = chain
+        self.cache = cache
+        self.embeddings = embeddings
+        self.manifest = manifest
+        self.settings = settings
+        self._mtime = None
+
+
+    def _check_version(self) -> None:
+        try:
+            mtime = os.stat(self.manifest).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self._mtime:
+            self._mtime = mtime
+            self.cache.set_version(f'{build_id(self.manifest)}:{self.settings}')
+
+
+    def __call__(self, inputs: Dict[str, Any], **kwargs: Any) -> Dict[str, Any]:
+        query = inputs['query']
+        self._check_version()
+        # query embedding comes from embedding cache again in retriever
+        with span('cache_lookup') as attrs:
+            vector = self.embeddings.embed_query(query) if self.cache.threshold else None
+            response = self.cache.lookup(query, vector)
+            attrs['hit'] = response is not None
+        if response is not None:
+            response['query'] = query
+            response['cached'] = True
+            return response
+
+        response = self.chain(inputs, **kwargs)
+        self.cache.store(query, response, vector)
+        return response
+
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.chain, name)
@@ -0,0 +1,395 @@
+# =========================
+#  Module: Sharded FAISS
+# =========================
+"""
+FAISS index split into shards by source document, searched concurrently.
+
+Every document goes to the shard picked by hash of its source, so its
+chunks are in one shard only and a change of a document rewrites only its
+shard. A shard is a folder `shard-NN` of the index snapshot, saved the same way
+as an unsharded index, with its own keyword index. db_build.py writes
+shards itself, `add_texts` and `from_texts` put chunks into shards in
+memory the same way, and `save_local` writes them.
+
+Searches run on all shards in parallel, each for as many candidates as the
+whole search, and candidates are merged: vector candidates by L2 distance,
+which is comparable across shards, keyword candidates by BM25 score, and
+both fused by reciprocal rank as in HybridFAISS. BM25 scores use term
+statistics of their shard, so keyword ranks are close to, not the same as,
+those of one index of all chunks.
+"""
+import hashlib
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+import box
+import numpy as np
+import yaml
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.vectorstore import VectorStore
+from langchain.vectorstores.utils import maximal_marginal_relevance
+from src.faiss_store import (HybridFAISS, build_keyword_index, create_store, fuse, load_store,
+                             save_store)
+from src.tracing import bind, span
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+
+def shard_of(source: str, shards: int) -> int:
+    """ shard of a document, stable across runs and machines
+    """
+    if shards <= 1:
+        return 0
+    return int(hashlib.sha1(source.encode('utf-8')).hexdigest()[:8], 16) % shards
+
+
+def shard_path(path: str, shard: int, shards: int) -> str:
+    """ folder of a shard, an index of one shard is the folder itself
+    """
+    return path if shards <= 1 else os.path.join(path, f'shard-{shard:02d}')
+
+
+class ShardedFAISS(VectorStore):
+    """ shards of FAISS searched as one vector store
+
+    A shard is loaded at its first search, or by `load`, and `reload` drops
+    one to read it again after it was rebuilt. Shards missing on disk have
+    no documents. Searches filtered by `source` read only its shard.
+    """
+
+    def __init__(self, embeddings: Embeddings, path: str, shards: int, mmap: bool = False,
+                 search_type: str = 'VECTOR', fetch_k: int = 20, rrf_k: int = 60):
+        self.embedding = embeddings
+        self.path = path
+        self.shards = shards
+        self.mmap = mmap
+        self.search_type = search_type
+        self.fetch_k = fetch_k
+        self.rrf_k = rrf_k
+        self._stores: Dict[int, Optional[HybridFAISS]] = {}
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self._executor = ThreadPoolExecutor(shards, thread_name_prefix='shard-search')
+
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self.embedding
+
+
+    def shard(self, shard: int) -> Optional[HybridFAISS]:
+        """ vector store of shard, None if it has no index
+        """
+        with self._locks[shard]:
+            if shard not in self._stores:
+                path = shard_path(self.path, shard, self.shards)
+                store = None
+                if os.path.exists(os.path.join(path, 'index.faiss')):
+                    with span('load_shard', shard=shard):
+                        store = load_store(path, self.embedding, mmap=self.mmap,
+                                           search_type=self.search_type)
+                self._stores[shard] = store
+            return self._stores[shard]
+
+
+    def load(self) -> None:
+        """ load all shards in parallel
+        """
+        list(self._executor.map(bind(self.shard), range(self.shards)))
+
+
+    def reload(self, shard: int) -> None:
+        """ read shard from disk again at its next search
+        """
+        with self._locks[shard]:
+            self._stores.pop(shard, None)
+
+
+    @property
+    def ntotal(self) -> int:
+        """ number of vectors of all shards
+        """
+        self.load()
+        return sum(store.index.ntotal for store in self._stores.values() if store is not None)
+
+
+    def _embed_query(self, text: str) -> List[float]:
+        with span('embed'):
+            return self.embedding.embed_query(text)
+
+
+    def _targets(self, filter: Optional[Dict[str, Any]]) -> List[int]:
+        if filter and 'source' in filter:
+            return [shard_of(filter['source'], self.shards)]
+        return list(range(self.shards))
+
+
+    def _shard_hits(self, shard: int, queries: List[Optional[str]],
+                    embeddings: Optional[List[List[float]]], k: int) -> List[Dict[str, List[Tuple[int, float]]]]:
+        with span('shard', shard=shard):
+            store = self.shard(shard)
+            if store is None:
+                return [{} for _ in queries]
+            return store.batch_hits(queries, embeddings, k)
+
+
+    def _search(
+        self,
+        queries: List[Optional[str]],
+        embeddings: Optional[List[List[float]]],
+        k: int,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[List[Tuple[Document, float, int, int]]]:
+        """
+        Search all shards and merge their candidates.
+
+        Parameters
+        ----------
+        queries : List[Optional[str]]
+            texts of queries, None for vector search only.
+        embeddings : Optional[List[List[float]]]
+            embeddings of queries, None for keyword search only.
+        k : int
+            number of documents per query.
+        filter : Optional[Dict[str, Any]]
+            metadata documents must have.
+
+        Returns
+        -------
+        List[List[Tuple[Document, float, int, int]]]
+            per query, documents with score, shard and position in shard.
+            Scores are L2 distances if only vector search ran, else fused
+            scores from 0 to 1.
+
+        """
+        fetch_k = k if self.search_type == 'VECTOR' and not filter else max(k, self.fetch_k)
+        shards = self._targets(filter)
+        futures = [self._executor.submit(bind(self._shard_hits), shard, queries, embeddings, fetch_k)
+                   for shard in shards]
+        hits = [future.result() for future in futures]
+
+        results = []
+        for q in range(len(queries)):
+            rankings: Dict[str, List[Tuple[Tuple[int, int], float]]] = {}
+            for shard, shard_hits in zip(shards, hits):
+                for name, candidates in shard_hits[q].items():
+                    rankings.setdefault(name, []).extend(((shard, i), score) for i, score in candidates)
+            for name, candidates in rankings.items():
+                # stable sort keeps order of shards on ties
+                candidates.sort(key=lambda item: item[1], reverse=name == 'KEYWORD')
+                del candidates[fetch_k:]
+            if set(rankings) == {'VECTOR'}:
+                scored = rankings['VECTOR']
+            else:
+                scored = fuse({name: [key for key, _ in candidates]
+                               for name, candidates in rankings.items()},
+                              fetch_k, self.search_type, self.rrf_k)
+            results.append(self._documents(scored, filter)[:k])
+        return results
+
+
+    def _documents(self, scored: Iterable[Tuple[Tuple[int, int], float]],
+                   filter: Optional[Dict[str, Any]] = None) -> List[Tuple[Document, float, int, int]]:
+        result = []
+        for (shard, i), score in scored:
+            store = self.shard(shard)
+            doc = store.docstore.search(store.index_to_docstore_id[i])
+            if not isinstance(doc, Document):
+                raise ValueError(f'Could not find document for id {store.index_to_docstore_id[i]}, got {doc}')
+            if filter and any(doc.metadata.get(key) != value for key, value in filter.items()):
+                continue
+            result.append((doc, score, shard, i))
+        return result
+
+
+    def _query_embedding(self, query: str) -> Optional[List[float]]:
+        return self._embed_query(query) if 'VECTOR' in self.search_type else None
+
+
+    def similarity_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        filter: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        embedding = self._query_embedding(query)
+        hits = self._search([query], None if embedding is None else [embedding], k, filter)[0]
+        return [(doc, score) for doc, score, _, _ in hits]
+
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[Dict[str, Any]] = None,
+                          **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+
+    def similarity_search_with_score_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        return [(doc, score) for doc, score, _, _ in self._search([None], [embedding], k, filter)[0]]
+
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4,
+                                    filter: Optional[Dict[str, Any]] = None,
+                                    **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, filter)]
+
+
+    def batch_search(self, queries: List[str], embeddings: List[List[float]],
+                     k: int = 4) -> List[List[Document]]:
+        """ search many queries at once, one search of every shard for all of them
+        """
+        if not queries:
+            return []
+        vectors = embeddings if 'VECTOR' in self.search_type else None
+        return [[doc for doc, _, _, _ in hits] for hits in self._search(queries, vectors, k)]
+
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        if self.search_type == 'VECTOR':
+            # same metric as shards
+            return self._euclidean_relevance_score_fn
+        # fused scores are already from 0 to 1
+        return lambda score: score
+
+
+    def _mmr(self, query: Optional[str], embedding: List[float], k: int, fetch_k: int,
+             lambda_mult: float, filter: Optional[Dict[str, Any]]) -> List[Document]:
+        hits = self._search([query], [embedding], fetch_k, filter)[0]
+        if not hits:
+            return []
+        vectors = np.zeros((len(hits), len(embedding)), dtype=np.float32)
+        by_shard: Dict[int, List[int]] = {}
+        for row, (_, _, shard, _) in enumerate(hits):
+            by_shard.setdefault(shard, []).append(row)
+        for shard, rows in by_shard.items():
+            vectors[rows] = self.shard(shard)._reconstruct([hits[row][3] for row in rows])
+        selected = maximal_marginal_relevance(np.array(embedding, dtype=np.float32), vectors,
+                                              k=min(k, len(hits)), lambda_mult=lambda_mult)
+        return [hits[i][0] for i in selected]
+
+
+    def max_marginal_relevance_search(
+        self,
+        query: str,
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        return self._mmr(query, self._embed_query(query), k, fetch_k, lambda_mult, filter)
+
+
+    def max_marginal_relevance_search_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        return self._mmr(None, embedding, k, fetch_k, lambda_mult, filter)
+
+
+    def _add_to_shard(self, shard: int, texts: List[str], vectors: List[List[float]],
+                      metadatas: List[dict], ids: List[str]) -> None:
+        with self._locks[shard]:
+            store = self._stores.get(shard)
+            path = shard_path(self.path, shard, self.shards)
+            if (shard not in self._stores or store is not None and
+                    not isinstance(store.docstore, InMemoryDocstore)) and \
+                    os.path.exists(os.path.join(path, 'index.faiss')):
+                # chunks of memory-mapped chunk store can't be added to
+                store = load_store(path, self.embedding, search_type=self.search_type, writable=True)
+            if store is None:
+                created = create_store(self.embedding, texts, vectors, metadatas, ids)
+                store = HybridFAISS(self.embedding, created.index, created.docstore,
+                                    created.index_to_docstore_id, fetch_k=self.fetch_k, rrf_k=self.rrf_k)
+            else:
+                store.add_embeddings(zip(texts, vectors), metadatas, ids=ids)
+            if self.search_type != 'VECTOR':
+                # numbered by position in FAISS index, so built again from all chunks
+                store.keyword_index = build_keyword_index(store)
+                store.search_type = self.search_type
+            self._stores[shard] = store
+
+
+    def add_embeddings(self, text_embeddings: Iterable[Tuple[str, List[float]]],
+                       metadatas: Optional[List[dict]] = None, ids: Optional[List[str]] = None,
+                       **kwargs: Any) -> List[str]:
+        """
+        Add chunks with their vectors to the shards of their documents, in
+        memory, as db_build.py does.
+
+        Parameters
+        ----------
+        text_embeddings : Iterable[Tuple[str, List[float]]]
+            texts of chunks and their vectors.
+        metadatas : Optional[List[dict]]
+            metadata of chunks, their shard is the one of `source`, or of
+            their id up to `#` without it.
+        ids : Optional[List[str]]
+            docstore ids of chunks, random ones by default.
+
+        Returns
+        -------
+        List[str]
+            ids of chunks added.
+
+        """
+        pairs = list(text_embeddings)
+        metadatas = metadatas or [{} for _ in pairs]
+        ids = ids or [str(uuid.uuid4()) for _ in pairs]
+        rows: Dict[int, List[int]] = {}
+        for row, (metadata, ref) in enumerate(zip(metadatas, ids)):
+            source = metadata.get('source', ref.rsplit('#', 1)[0])
+            rows.setdefault(shard_of(source, self.shards), []).append(row)
+        for shard, shard_rows in rows.items():
+            self._add_to_shard(shard, *([items[row] for row in shard_rows]
+                                        for items in ([text for text, _ in pairs],
+                                                      [vector for _, vector in pairs],
+                                                      metadatas, ids)))
+        return ids
+
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        with span('embed'):
+            vectors = self.embedding.embed_documents(texts)
+        return self.add_embeddings(zip(texts, vectors), metadatas, ids)
+
+
+    def save_local(self, folder_path: str) -> None:
+        """ save shards with chunks into folder_path, as db_build.py does
+        """
+        self.load()
+        for shard, store in self._stores.items():
+            if store is not None:
+                save_store(store, shard_path(folder_path, shard, self.shards))
+
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings,
+                   metadatas: Optional[List[dict]] = None, ids: Optional[List[str]] = None,
+                   path: str = '', shards: Optional[int] = None, **kwargs: Any) -> 'ShardedFAISS':
+        """ FAISS_SHARDS shards of texts in memory, or `shards`, `save_local`
+        writes them to a folder
+        """
+        shards = shards or max(cfg.FAISS_SHARDS, 1)
+        store = cls(embedding, path, shards, **kwargs)
+        # shards on disk at path aren't read
+        store._stores = {shard: None for shard in range(shards)}
+        store.add_texts(texts, metadatas, ids)
+        return store
@@ -0,0 +1,194 @@
+# =========================
+#  Module: Index snapshots
+# =========================
+"""
+Versions of the FAISS index folder, so a build never writes files a
+running process reads.
+
+    DB_FAISS_PATH/
+        CURRENT                 version of the published snapshot
+        snapshots/VERSION/      index of a version, or its shards
+        snapshots/.VERSION.tmp  snapshot being built
+        readers/VERSION@PID.N   process PID uses snapshot VERSION
+
+A build writes a new snapshot, with files of shards it didn't change
+hard-linked from the current one, renames it in place and replaces CURRENT
+atomically. Processes register the snapshot they load as reader until the
+vector store of it is garbage collected. Snapshots which are neither
+current nor read by a living process are removed by `collect`.
+
+An index written before snapshots, in DB_FAISS_PATH itself, is used while
+there is no CURRENT.
+"""
+import itertools
+import os
+import shutil
+import time
+import weakref
+from typing import Any, List, Optional, Tuple
+
+CURRENT_FILE = 'CURRENT'
+# reader of an index without snapshots
+LEGACY = 'legacy'
+# files of an index in DB_FAISS_PATH itself, before snapshots
+LEGACY_FILES = ('index.faiss', 'index.pkl', 'bm25.npz', 'chunks.bin', 'chunks.blocks.npy',
+                'chunks.records.npy', 'chunks.json')
+
+# readers of this process, a snapshot may be loaded more than once
+_readers = itertools.count()
+
+
+def alive(pid: int) -> bool:
+    if os.name == 'nt':
+        # no signal 0 on Windows, keep snapshots of any reader
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def release(reader: str) -> None:
+    """ unregister reader file of `Snapshots.open`
+    """
+    try:
+        os.remove(reader)
+    except FileNotFoundError:
+        pass
+
+
+def link_tree(source: str, target: str) -> None:
+    """ copy of folder source, files hard-linked where possible
+    """
+    def link(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+    shutil.copytree(source, target, copy_function=link)
+
+
+class Snapshots:
+    """ snapshots of index folder `path`
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.root = os.path.join(path, 'snapshots')
+        self.readers = os.path.join(path, 'readers')
+
+
+    def current(self) -> Optional[str]:
+        """ published version, None for an index without snapshots
+        """
+        try:
+            with open(os.path.join(self.path, CURRENT_FILE), 'r', encoding='utf8') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+
+    def folder(self, version: Optional[str]) -> str:
+        return self.path if version is None else os.path.join(self.root, version)
+
+
+    def versions(self) -> List[str]:
+        """ published snapshots, current or not collected yet
+        """
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root) if not name.startswith('.'))
+
+
+    def building(self, version: str) -> str:
+        return os.path.join(self.root, f'.{version}.tmp')
+
+
+    def create(self) -> str:
+        """ new version, to be written into `building(version)`
+        """
+        version = f'{time.strftime("%Y%m%d-%H%M%S")}.{time.time_ns() // 1000000 % 1000:03d}-{os.getpid()}'
+        os.makedirs(self.building(version))
+        return version
+
+
+    def publish(self, version: str) -> None:
+        """ make a built snapshot current
+        """
+        os.replace(self.building(version), self.folder(version))
+        tmp = os.path.join(self.path, f'{CURRENT_FILE}.tmp')
+        with open(tmp, 'w', encoding='utf8') as f:
+            f.write(version)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, CURRENT_FILE))
+
+
+    def open(self) -> Tuple[Optional[str], str]:
+        """ current version, and reader file registering it as read by this process
+        """
+        os.makedirs(self.readers, exist_ok=True)
+        while True:
+            version = self.current()
+            reader = os.path.join(self.readers, f'{version or LEGACY}@{os.getpid()}.{next(_readers)}')
+            open(reader, 'a').close()
+            # may have been collected after another build
+            if os.path.isdir(self.folder(version)):
+                return version, reader
+            release(reader)
+
+
+    @staticmethod
+    def hold(store: Any, reader: str) -> None:
+        """ release reader once store is garbage collected
+        """
+        weakref.finalize(store, release, reader)
+
+
+    def collect(self) -> List[str]:
+        """
+        Remove snapshots neither current nor read by a living process,
+        snapshots of builds which died, and files of an index before
+        snapshots.
+
+        Returns
+        -------
+        List[str]
+            versions removed.
+
+        """
+        current = self.current()
+        if current is None or not os.path.isdir(self.root):
+            return []
+        used = set()
+        if os.path.isdir(self.readers):
+            for name in os.listdir(self.readers):
+                version, _, pid = name.rpartition('@')
+                pid = pid.partition('.')[0]
+                if pid.isdigit() and alive(int(pid)):
+                    used.add(version)
+                else:
+                    os.remove(os.path.join(self.readers, name))
+
+        for name in os.listdir(self.root):
+            # build died
+            pid = name[1:-len('.tmp')].rpartition('-')[2]
+            if name.startswith('.') and pid.isdigit() and not alive(int(pid)):
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+        removed = []
+        for name in self.versions():
+            if name != current and name not in used:
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+                removed.append(name)
+
+        if LEGACY not in used:
+            for name in os.listdir(self.path):
+                legacy = os.path.join(self.path, name)
+                if name in LEGACY_FILES:
+                    os.remove(legacy)
+                elif name.startswith('shard-') and os.path.isdir(legacy):
+                    shutil.rmtree(legacy, ignore_errors=True)
+        return removed
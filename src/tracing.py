@@ -0,0 +1,231 @@
+# =========================
+#  Module: Tracing of queries
+# =========================
+"""
+Spans of a query: time spent in every stage, with token and chunk counts.
+
+A trace is started for a query by `Tracer.trace`. Code of every stage opens
+`span(name)`, which records into the trace of the current context and does
+nothing without one. Functions run in thread pools are wrapped by `bind` to
+record into the trace of the caller. Spans of retriever and LLM runs, for
+every LLM, are recorded from langchain callbacks by `TraceHandler` of
+src/utils.py.
+
+Finished traces are written as JSON lines, and summed up as Prometheus
+style metrics.
+
+This module is imported by every run of main.py, keep it free of heavy
+imports.
+"""
+import contextvars
+import json
+import threading
+import time
+import timeit
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+
+_trace: contextvars.ContextVar = contextvars.ContextVar('trace', default=None)
+_depth: contextvars.ContextVar = contextvars.ContextVar('depth', default=0)
+
+# upper bounds of latency histogram buckets, seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# counts of spans summed up as counters
+COUNTERS = ('chunks', 'kept_chunks', 'retrieved_tokens', 'context_tokens',
+            'prompt_tokens', 'reused_tokens', 'tokens', 'bytes')
+
+
+class Trace:
+    """ spans of one query
+    """
+
+    def __init__(self, name: str, **attrs: Any):
+        self.name = name
+        self.attrs = attrs
+        self.time = time.time()
+        self.start = timeit.default_timer()
+        self.seconds: Optional[float] = None
+        self.spans: List[Dict[str, Any]] = []
+        self.lock = threading.Lock()
+
+
+    def add(self, name: str, start: float, seconds: float, depth: int = 0, **attrs: Any) -> None:
+        """
+        Parameters
+        ----------
+        name : str
+            stage.
+        start : float
+            `timeit.default_timer()` at start of span.
+        seconds : float
+            duration.
+        depth : int
+            number of spans the span is nested in.
+        **attrs : Any
+            counts of stage, e.g. tokens or chunks.
+
+        """
+        with self.lock:
+            self.spans.append(dict(attrs, name=name, start=start - self.start,
+                                   seconds=seconds, depth=depth))
+
+
+    def finish(self) -> None:
+        self.seconds = timeit.default_timer() - self.start
+        self.spans.sort(key=lambda s: s['start'])
+
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'name': self.name, 'time': self.time, 'seconds': self.seconds,
+                'attrs': self.attrs, 'spans': self.spans}
+
+
+    def breakdown(self) -> str:
+        return breakdown(self.to_dict())
+
+
+def breakdown(trace: Dict[str, Any]) -> str:
+    """ table of spans of trace as dict, for REPL
+    """
+    lines = [f'{"stage":<24} {"start":>9} {"seconds":>9}']
+    for s in trace['spans']:
+        name = '  ' * s['depth'] + s['name']
+        counts = ' '.join(f'{key}={value}' for key, value in s.items()
+                          if key not in ('name', 'start', 'seconds', 'depth'))
+        lines.append(f'{name:<24} {s["start"]:>8.3f}s {s["seconds"]:>8.3f}s  {counts}'.rstrip())
+    if trace['seconds'] is not None:
+        lines.append(f'{"total":<24} {"":>9} {trace["seconds"]:>8.3f}s')
+    return '\n'.join(lines)
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Record time of block in current trace. Counts known at the end are set
+    in the dict yielded.
+    """
+    trace = _trace.get()
+    if trace is None:
+        yield attrs
+        return
+    depth = _depth.get()
+    token = _depth.set(depth + 1)
+    start = timeit.default_timer()
+    try:
+        yield attrs
+    finally:
+        _depth.reset(token)
+        trace.add(name, start, timeit.default_timer() - start, depth, **attrs)
+
+
+def bind(fn: Callable, trace: Optional[Trace] = None) -> Callable:
+    """ fn running in another thread records spans into trace, by default of caller
+    """
+    context = contextvars.copy_context()
+    if trace is not None:
+        context.run(_trace.set, trace)
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+def current() -> Optional[Trace]:
+    return _trace.get()
+
+
+def enter() -> Tuple[int, Any]:
+    """ depth of span started by a callback, and token to `leave` it
+    """
+    depth = _depth.get()
+    return depth, _depth.set(depth + 1)
+
+
+def leave(token: Any) -> None:
+    try:
+        _depth.reset(token)
+    except ValueError:
+        # span ended by a callback in another context
+        pass
+
+
+class Tracer:
+    """ traces of queries, written to JSON lines file and summed up as metrics
+    """
+
+    def __init__(self, path: Optional[str] = None, prefix: str = 'docqa'):
+        self.path = path
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.traces: Dict[str, int] = {}
+        # per stage: count, sum of seconds, counts of histogram buckets
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        # per stage and count, e.g. ('llm', 'tokens')
+        self.counters: Dict[Any, int] = {}
+        self.last: Optional[Trace] = None
+
+
+    @contextmanager
+    def trace(self, name: str = 'query', **attrs: Any) -> Iterator[Trace]:
+        trace = Trace(name, **attrs)
+        token = _trace.set(trace)
+        try:
+            yield trace
+        finally:
+            _trace.reset(token)
+            self.record(trace)
+
+
+    def record(self, trace: Trace) -> None:
+        """ finish trace, export and add it to metrics
+        """
+        trace.finish()
+        with self.lock:
+            self.last = trace
+            self.traces[trace.name] = self.traces.get(trace.name, 0) + 1
+            self._observe(trace.name, trace.seconds)
+            for s in trace.spans:
+                self._observe(s['name'], s['seconds'])
+                for key in COUNTERS:
+                    value = s.get(key)
+                    if isinstance(value, int):
+                        self.counters[s['name'], key] = self.counters.get((s['name'], key), 0) + value
+            if self.path:
+                try:
+                    with open(self.path, 'a', encoding='utf8') as f:
+                        f.write(json.dumps(trace.to_dict(), ensure_ascii=False, default=str) + '\n')
+                except OSError as e:
+                    print(f'ERROR: writing trace to {self.path}: {e}')
+
+
+    def _observe(self, stage: str, seconds: float) -> None:
+        stats = self.stages.setdefault(stage, {'count': 0, 'sum': 0.0,
+                                               'buckets': [0] * len(BUCKETS)})
+        stats['count'] += 1
+        stats['sum'] += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                stats['buckets'][i] += 1
+
+
+    def prometheus(self) -> str:
+        """ metrics in Prometheus text format
+        """
+        p = self.prefix
+        lines = [f'# TYPE {p}_traces_total counter']
+        with self.lock:
+            for name, count in sorted(self.traces.items()):
+                lines.append(f'{p}_traces_total{{name="{name}"}} {count}')
+
+            lines.append(f'# TYPE {p}_stage_seconds histogram')
+            for stage, stats in sorted(self.stages.items()):
+                for bound, count in zip(BUCKETS, stats['buckets']):
+                    lines.append(f'{p}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'{p}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {stats["count"]}')
+                lines.append(f'{p}_stage_seconds_sum{{stage="{stage}"}} {stats["sum"]}')
+                lines.append(f'{p}_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+
+            for key in sorted({key for _, key in self.counters}):
+                lines.append(f'# TYPE {p}_stage_{key}_total counter')
+                for (stage, k), value in sorted(self.counters.items()):
+                    if k == key:
+                        lines.append(f'{p}_stage_{key}_total{{stage="{stage}"}} {value}')
+        return '\n'.join(lines) + '\n'
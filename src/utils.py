@@ -4,21 +4,172 @@
 ===========================================
 '''
 import box
+import hashlib
+import json
+import threading
+import timeit
 import yaml
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+from uuid import UUID
 
+from langchain.callbacks.base import BaseCallbackHandler
 from langchain.prompts import PromptTemplate
-from langchain.chains import RetrievalQA
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.vectorstores import FAISS
+from langchain.chains import LLMChain, RetrievalQA
+from src.context import ContextStats, ContextStuffDocumentsChain, token_counter
+from src.embeddings import build_embeddings, embeddings_id
 from src.prompts import qa_template
 from src.llm import build_llm
-from src.idol import IDOL
+from src.manifest import build_id
+from src.query_cache import QueryCache, CachedRetrievalQA
+from src.tracing import current, enter, leave, span
 
 # Import config vars
 with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
     cfg = box.Box(yaml.safe_load(ymlfile))
 
 
+class TokenPrinter(BaseCallbackHandler):
+    """
+    Print tokens of answer as they are generated
+    """
+    def __init__(self):
+        self.start = timeit.default_timer()
+        self.first_token = None
+        self.tokens = 0
+
+    def on_llm_new_token(self, token, **kwargs):
+        if self.first_token is None:
+            self.first_token = timeit.default_timer()
+        self.tokens += 1
+        print(token, end='', flush=True)
+
+    @property
+    def time_to_first_token(self):
+        return None if self.first_token is None else self.first_token - self.start
+
+
+class TokenWriter(BaseCallbackHandler):
+    """
+    Write tokens of answer as JSON lines to a stream, e.g. socket of daemon client
+    """
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.wfile.write((json.dumps({'token': token}, ensure_ascii=False) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+
+class StartupProfile:
+    """
+    Seconds spent in each stage of startup
+    """
+    def __init__(self):
+        self.stages = []
+
+    def add(self, name, seconds):
+        self.stages.append((name, seconds))
+
+    @contextmanager
+    def stage(self, name):
+        start = timeit.default_timer()
+        try:
+            with span(name):
+                yield
+        finally:
+            self.add(name, timeit.default_timer() - start)
+
+    def __str__(self):
+        lines = [f'{name:>12}: {seconds:.3f}s' for name, seconds in self.stages]
+        lines.append(f'{"total":>12}: {sum(seconds for _, seconds in self.stages):.3f}s')
+        return '\n'.join(lines)
+
+
+class TraceHandler(BaseCallbackHandler):
+    """
+    Spans of retriever and LLM runs from langchain callbacks: retrieve with
+    chunks found, and llm with prompt tokens, split into prefill up to the
+    first token and decode of the tokens after.
+    """
+
+    def __init__(self, count_tokens: Optional[Callable[[str], int]] = None, llm: Any = None):
+        self.count_tokens = count_tokens
+        # LLM which reports prompt tokens reused from last query
+        self.llm = llm
+        self.runs: Dict[UUID, Dict[str, Any]] = {}
+
+
+    def _start(self, run_id: UUID, **attrs: Any) -> None:
+        trace = current()
+        if trace is None:
+            return
+        depth, token = enter()
+        self.runs[run_id] = dict(attrs, trace=trace, depth=depth, token=token,
+                                 start=timeit.default_timer())
+
+
+    def _end(self, run_id: UUID, name: str, **attrs: Any) -> Optional[Dict[str, Any]]:
+        run = self.runs.pop(run_id, None)
+        if run is None:
+            return None
+        leave(run['token'])
+        now = timeit.default_timer()
+        run['trace'].add(name, run['start'], now - run['start'], run['depth'], **attrs)
+        run['end'] = now
+        return run
+
+
+    def on_retriever_start(self, serialized: Dict[str, Any], query: str, *,
+                           run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id)
+
+
+    def on_retriever_end(self, documents: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, 'retrieve', chunks=len(documents))
+
+
+    def on_retriever_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, 'retrieve', error=type(error).__name__)
+
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *,
+                     run_id: UUID, **kwargs: Any) -> None:
+        prompt_tokens = sum(self.count_tokens(prompt) for prompt in prompts) \
+            if self.count_tokens else None
+        self._start(run_id, prompt_tokens=prompt_tokens, first_token=None, tokens=0,
+                    prefill=getattr(self.llm, 'prefill', None))
+
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self.runs.get(run_id)
+        if run is None:
+            return
+        if run['first_token'] is None:
+            run['first_token'] = timeit.default_timer()
+        run['tokens'] += 1
+
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self.runs.get(run_id)
+        if run is None:
+            return
+        attrs = {'prompt_tokens': run['prompt_tokens'], 'tokens': run['tokens']}
+        prefill = getattr(self.llm, 'prefill', None)
+        if prefill is not None and prefill is not run['prefill']:
+            attrs['reused_tokens'] = prefill['reused_tokens']
+        run = self._end(run_id, 'llm', **{k: v for k, v in attrs.items() if v is not None})
+        if run['first_token'] is not None:
+            trace, depth = run['trace'], run['depth'] + 1
+            trace.add('prefill', run['start'], run['first_token'] - run['start'], depth)
+            trace.add('decode', run['first_token'], run['end'] - run['first_token'], depth,
+                      tokens=run['tokens'])
+
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, 'llm', error=type(error).__name__)
+
+
 def set_qa_prompt():
     """
     Prompt template for QA retrieval for each vectorstore
@@ -28,30 +179,184 @@ def set_qa_prompt():
     return prompt
 
 
-def build_retrieval_qa(llm, prompt, vectordb):
+def build_retriever(vectordb):
+    """
+    Retriever of SEARCH_TYPE: similarity, mmr or similarity_score_threshold
+    """
+    search_kwargs = {'k': cfg.VECTOR_COUNT}
+    if cfg.SEARCH_TYPE == 'mmr':
+        search_kwargs.update(fetch_k=cfg.MMR_FETCH_K, lambda_mult=cfg.MMR_LAMBDA)
+    elif cfg.SEARCH_TYPE == 'similarity_score_threshold':
+        search_kwargs.update(score_threshold=cfg.SCORE_THRESHOLD)
+    return vectordb.as_retriever(search_type=cfg.SEARCH_TYPE,
+                                 search_kwargs=search_kwargs)
+
+
+def build_retrieval_qa(llm, prompt, vectordb, embeddings=None):
+    if cfg.CONTEXT_BUDGET:
+        return build_context_qa(llm, prompt, vectordb, embeddings)
     dbqa = RetrievalQA.from_chain_type(llm=llm,
                                        chain_type='stuff',
-                                       retriever=vectordb.as_retriever(search_kwargs={'k': cfg.VECTOR_COUNT}),
+                                       retriever=build_retriever(vectordb),
                                        return_source_documents=cfg.RETURN_SOURCE_DOCUMENTS,
                                        chain_type_kwargs={'prompt': prompt}
                                        )
     return dbqa
 
 
-def setup_dbqa():
-    embeddings = HuggingFaceEmbeddings(model_name=cfg.EMBEDDINGS_MODEL,
-                                       model_kwargs={'device': cfg.DEVICE})
+def build_context_qa(llm, prompt, vectordb, embeddings):
+    """
+    'stuff' chain which dedups, orders and trims chunks to CONTEXT_MAX_TOKENS
+    """
+    combine = ContextStuffDocumentsChain(llm_chain=LLMChain(llm=llm, prompt=prompt),
+                                         document_variable_name='context',
+                                         embeddings=embeddings,
+                                         count_tokens=token_counter(llm),
+                                         max_tokens=cfg.CONTEXT_MAX_TOKENS,
+                                         dedup_similarity=cfg.CONTEXT_DEDUP_SIMILARITY,
+                                         max_overlap=cfg.CHUNK_OVERLAP,
+                                         stats=ContextStats())
+    dbqa = RetrievalQA(combine_documents_chain=combine,
+                       retriever=build_retriever(vectordb),
+                       return_source_documents=cfg.RETURN_SOURCE_DOCUMENTS)
+    return dbqa
+
+
+def setup_dbqa(profile=None):
+    profile = profile or StartupProfile()
+    with profile.stage('embeddings'):
+        embeddings = build_embeddings()
+
+    with profile.stage('vector db'):
+        vectordb = build_vectordb(embeddings)
+
+    with profile.stage('llm'):
+        llm = build_llm()
+    qa_prompt = set_qa_prompt()
+    dbqa = build_retrieval_qa(llm, qa_prompt, vectordb, embeddings)
+
+    if cfg.QUERY_CACHE_PATH:
+        with profile.stage('query cache'):
+            dbqa = build_query_cache(dbqa, embeddings)
+
+    return dbqa
+
+
+def build_trace_handler(dbqa):
+    """
+    Callback handler recording spans of retriever and LLM of dbqa in traces
+    """
+    llm = dbqa.combine_documents_chain.llm_chain.llm
+    return TraceHandler(token_counter(llm), llm)
+
 
+def build_vectordb(embeddings):
+    # only the configured vector database is imported
     if cfg.VECTOR_DB == 'IDOL' :
+        from src.idol import IDOL
         vectordb = IDOL(embeddings, url = cfg.IDOL_SEARCH_URL,
                         vector_field = cfg.IDOL_VECTOR_FIELD,
                         database = cfg.IDOL_DATABASE,
-                        search_type = cfg.IDOL_SEARCH_TYPE)
+                        search_type = cfg.IDOL_SEARCH_TYPE,
+                        timeout = cfg.IDOL_TIMEOUT,
+                        retries = cfg.IDOL_RETRIES,
+                        vector_precision = cfg.IDOL_VECTOR_PRECISION)
     else:
-        vectordb = FAISS.load_local(cfg.DB_FAISS_PATH, embeddings)
+        # current snapshot of index, kept until the store is garbage collected
+        from src.snapshots import Snapshots
+        snapshots = Snapshots(cfg.DB_FAISS_PATH)
+        version, reader = snapshots.open()
+        if cfg.FAISS_SHARDS > 1:
+            from src.shards import ShardedFAISS
+            vectordb = ShardedFAISS(embeddings, snapshots.folder(version), cfg.FAISS_SHARDS,
+                                    mmap=cfg.FAISS_MMAP, search_type=cfg.FAISS_SEARCH_TYPE,
+                                    fetch_k=cfg.HYBRID_FETCH_K, rrf_k=cfg.HYBRID_RRF_K)
+            if not cfg.FAISS_LAZY_SHARDS:
+                vectordb.load()
+        else:
+            from src.faiss_store import load_store
+            vectordb = load_store(snapshots.folder(version), embeddings, mmap=cfg.FAISS_MMAP,
+                                  search_type=cfg.FAISS_SEARCH_TYPE)
+        vectordb.snapshot = version
+        snapshots.hold(vectordb, reader)
+    return vectordb
 
-    llm = build_llm()
-    qa_prompt = set_qa_prompt()
-    dbqa = build_retrieval_qa(llm, qa_prompt, vectordb)
 
-    return dbqa
+class IndexReloader(threading.Thread):
+    """
+    Load snapshots of FAISS index published by db_build.py in the background,
+    and swap the retriever of the chain for one of the new index. Queries
+    running keep the retriever they started with.
+    """
+    def __init__(self, dbqa, interval):
+        super().__init__(name='index-reloader', daemon=True)
+        self.chain = dbqa.chain if isinstance(dbqa, CachedRetrievalQA) else dbqa
+        self.interval = interval
+        self.stopped = threading.Event()
+        from src.snapshots import Snapshots
+        self.snapshots = Snapshots(cfg.DB_FAISS_PATH)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                print(f'ERROR: reloading index: {e}')
+
+    def check(self):
+        """ swap retriever if a new snapshot was published, returns whether it was """
+        vectorstore = self.chain.retriever.vectorstore
+        if self.snapshots.current() == getattr(vectorstore, 'snapshot', None):
+            # old snapshots are removed once their last queries are done
+            if len(self.snapshots.versions()) > 1:
+                self.snapshots.collect()
+            return False
+        start = timeit.default_timer()
+        vectordb = build_vectordb(vectorstore.embeddings)
+        # attribute assignment is atomic, old store is released with its last query
+        self.chain.retriever = build_retriever(vectordb)
+        print(f'INFO: index snapshot {vectordb.snapshot} loaded in {timeit.default_timer() - start:.2f}s')
+        return True
+
+    def stop(self):
+        self.stopped.set()
+
+
+def start_reloader(dbqa):
+    """
+    Reload FAISS index of dbqa when db_build.py publishes a new snapshot,
+    checked every INDEX_RELOAD_SECONDS
+    """
+    if cfg.VECTOR_DB == 'IDOL' or not cfg.INDEX_RELOAD_SECONDS:
+        return None
+    reloader = IndexReloader(dbqa, cfg.INDEX_RELOAD_SECONDS)
+    reloader.start()
+    return reloader
+
+
+# settings which don't change answers, cached answers are kept when they change
+ANSWER_NEUTRAL_SETTINGS = ('TIMING', 'TRACE_PATH', 'QUERY_CACHE_', 'SERVER_', 'BATCH_',
+                           'INDEX_RELOAD_SECONDS', 'DAEMON_SOCKET', 'LLM_WORKER', 'LLM_PIN_CORES',
+                           'OLLAMA_KEEP_ALIVE')
+
+
+def answer_settings():
+    """ settings of retrieval, context and generation of answers
+    """
+    return {name: value for name, value in cfg.items()
+            if not name.startswith(ANSWER_NEUTRAL_SETTINGS)}
+
+
+def build_query_cache(dbqa, embeddings):
+    """
+    Answer repeated queries from cache, until index or settings of answers are changed
+    """
+    settings = json.dumps([answer_settings(), embeddings_id(embeddings), qa_template],
+                          sort_keys=True, default=str)
+    settings = hashlib.sha1(settings.encode('utf-8')).hexdigest()
+    cache = QueryCache(cfg.QUERY_CACHE_PATH,
+                       version=f'{build_id(cfg.MANIFEST_PATH)}:{settings}',
+                       ttl=cfg.QUERY_CACHE_TTL,
+                       max_entries=cfg.QUERY_CACHE_MAX_ENTRIES,
+                       threshold=cfg.QUERY_CACHE_SIMILARITY)
+    return CachedRetrievalQA(dbqa, cache, embeddings, cfg.MANIFEST_PATH, settings)